@@ -29,10 +29,14 @@ from io import StringIO
 from glob import glob
 from optparse import OptionParser
 import os
+import shutil
 import string
 import struct
 import sys
 
+import file_transfer
+import profiling
+
 PROG_DESCRIPTION = '''
 Delete the slide label from an MRXS, NDPI, or SVS whole-slide image.
 '''.strip()
@@ -43,34 +47,286 @@ DEBUG = False
 ASCII = 2
 SHORT = 3
 LONG = 4
+UNDEFINED = 7
 FLOAT = 11
 DOUBLE = 12
 LONG8 = 16
+TYPE_FORMATS = {
+    ASCII: 's',
+    SHORT: 'H',
+    LONG: 'I',
+    UNDEFINED: 's',
+    FLOAT: 'f',
+    DOUBLE: 'd',
+    LONG8: 'Q',
+}
 
 # TIFF tags
+COMPRESSION = 259
 IMAGE_DESCRIPTION = 270
 STRIP_OFFSETS = 273
 STRIP_BYTE_COUNTS = 279
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+JPEG_TABLES = 347
 NDPI_MAGIC = 65420
 NDPI_SOURCELENS = 65421
 
 # Format headers
+TIFF_MAGICS = (b'II*\0', b'MM\0*', b'II+\0', b'MM\0+')
 LZW_CLEARCODE = b'\x80'
 JPEG_SOI = b'\xff\xd8'
 UTF8_BOM = b'\xef\xbb\xbf'
 
 # MRXS
 MRXS_HIERARCHICAL = 'HIERARCHICAL'
+MRXS_HIER_ROOT_OFFSET = 37
 MRXS_NONHIER_ROOT_OFFSET = 41
+MRXS_LABEL = ('Scan data layer', 'ScanDataLayer_SlideBarcode')
+MRXS_MACRO = ('Scan data layer', 'ScanDataLayer_SlidePreview')
+MRXS_THUMBNAIL = ('Scan data layer', 'ScanDataLayer_SlideThumbnail')
+
+# TIFF compression schemes, for checking what a deleted strip starts with
+LZW = 5
+JPEG = 7
+
+# Associated images a redaction policy can name
+POLICY_IMAGES = ('label', 'macro', 'thumbnail')
+
+# Label probe results
+LABEL_PRESENT = 'present'
+LABEL_REMOVED = 'removed'            # Deleted earlier, or never stored
+LABEL_UNDETECTABLE = 'undetectable'  # Unrecognized or unreadable file
 
 
 class UnrecognizedFile(Exception):
     pass
 
 
+class LabelNotFound(IOError):
+    # The file is a recognized format but has nothing to delete
+    pass
+
+
+class LabelProbe(object):
+    '''What the directory chain or MRXS index of a slide says about its
+    label, without reading any image data.'''
+
+    def __init__(self, format, label, macro=None, error=None):
+        self.format = format    # Format name, or None if unrecognized
+        self.label = label      # LABEL_PRESENT, LABEL_REMOVED or LABEL_UNDETECTABLE
+        self.macro = macro      # Whether a macro image is present, if known
+        self.error = error      # Why the label could not be detected
+
+    def as_dict(self):
+        return {'format': self.format, 'label': self.label,
+                'macro': self.macro, 'error': self.error}
+
+
+class RedactionPolicy(object):
+    '''What to delete from a slide, in one pass over its parsed structure.
+
+    @label, @macro and @thumbnail delete those associated images where
+    the format has them (the NDPI macro is its label).  @directories are
+    TIFF directory numbers and @mrxs_levels (layer name, level name) pairs
+    of MRXS non-hierarchical levels, deleted where present.'''
+
+    def __init__(self, label=True, macro=False, thumbnail=False,
+            directories=(), mrxs_levels=()):
+        self.label = label
+        self.macro = macro
+        self.thumbnail = thumbnail
+        self.directories = frozenset(directories)
+        self.mrxs_levels = tuple(mrxs_levels)
+
+    @property
+    def label_only(self):
+        return (self.label and not self.macro and not self.thumbnail and
+                not self.directories and not self.mrxs_levels)
+
+    def by_name(self):
+        # The same policy without directory numbers, which no longer refer
+        # to the same images once directories have been deleted
+        return RedactionPolicy(self.label, self.macro, self.thumbnail,
+                mrxs_levels=self.mrxs_levels)
+
+    def describe(self):
+        parts = [name for name in POLICY_IMAGES if getattr(self, name)]
+        parts.extend('directory %d' % n for n in sorted(self.directories))
+        parts.extend('%s/%s' % level for level in self.mrxs_levels)
+        return ', '.join(parts) or 'nothing'
+
+
+DEFAULT_POLICY = RedactionPolicy()
+
+
+def add_policy_options(parser):
+    # Options of the command-line tools that build a RedactionPolicy
+    parser.add_option('--delete', metavar='IMAGES', default='label',
+                      help='associated images to delete, comma-separated: '
+                      '%s [%%default]' % ', '.join(POLICY_IMAGES))
+    parser.add_option('--delete-directory', type='int', action='append',
+                      default=[], metavar='N',
+                      help='also delete TIFF directory N (a stripped image)')
+    parser.add_option('--delete-mrxs-level', action='append', default=[],
+                      metavar='LAYER:LEVEL',
+                      help='also delete an MRXS non-hierarchical level')
+
+
+def policy_from_options(parser, opts):
+    images = set(name.strip() for name in opts.delete.split(',') if name.strip())
+    unknown = images - set(POLICY_IMAGES)
+    if unknown:
+        parser.error('Unknown image to delete: %s' % ', '.join(sorted(unknown)))
+    if 0 in opts.delete_directory:
+        parser.error('The first directory cannot be deleted')
+    levels = []
+    for level in opts.delete_mrxs_level:
+        layer, sep, name = level.partition(':')
+        if not sep:
+            parser.error('MRXS levels are given as LAYER:LEVEL')
+        levels.append((layer, name))
+    return RedactionPolicy(**dict((name, name in images)
+            for name in POLICY_IMAGES),
+            directories=opts.delete_directory, mrxs_levels=levels)
+
+
+class FileEdits(object):
+    '''Byte-level edits that remove identifying data from one file.'''
+
+    def __init__(self):
+        self.zeros = []
+        self.patches = []
+        self.truncate = None
+        self.contents = None
+
+    def zero(self, offset, length):
+        self.zeros.append((offset, length))
+
+    def patch(self, offset, data):
+        self.patches.append((offset, data))
+
+    def apply(self, path, sparse=False):
+        # Edit @path in place
+        if self.contents is not None:
+            with open(path, 'wb') as fh:
+                fh.write(self.contents)
+            return
+        with open(path, 'r+b') as fh:
+            self.write_to(fh, sparse)
+
+    def write_to(self, fh, sparse=False):
+        # With @sparse, punch holes for the zeroed ranges where possible
+        for offset, length in self.zeros:
+            if DEBUG:
+                print('Zeroing', offset, 'for', length)
+            file_transfer.zero_range(fh, offset, length, sparse)
+        for offset, data in self.patches:
+            fh.seek(offset)
+            fh.write(data)
+        if self.truncate is not None:
+            if DEBUG:
+                print('Truncating to', self.truncate)
+            fh.truncate(self.truncate)
+
+    def copy(self, src, dst, sparse=False):
+        # Stream @src to @dst once, writing zeros (or leaving holes, if
+        # @sparse) for the redacted ranges and patching pointers after.
+        # Returns the transfer mechanism that was used.
+        if self.contents is not None:
+            with open(dst, 'wb') as fh:
+                fh.write(self.contents)
+            return file_transfer.BUFFERED
+        if file_transfer.clone_file(src, dst):
+            # The copy shares extents with the source, so only the
+            # redacted bytes are actually written
+            with open(dst, 'r+b') as fh:
+                self.write_to(fh, sparse)
+            return file_transfer.REFLINK
+        size = os.path.getsize(src)
+        if self.truncate is not None:
+            size = min(size, self.truncate)
+        method = file_transfer.COPY_FILE_RANGE
+        with open(src, 'rb') as src_fh, open(dst, 'wb') as dst_fh:
+            pos = 0
+            for offset, length in sorted(self.zeros):
+                end = min(offset + length, size)
+                if end <= pos:
+                    continue
+                if offset > pos:
+                    method = file_transfer.copy_range(src_fh, dst_fh, pos,
+                            offset - pos, method)
+                    pos = offset
+                if DEBUG:
+                    print('Zeroing', dst, 'at', pos, 'for', end - pos)
+                if sparse:
+                    dst_fh.seek(end)
+                else:
+                    file_transfer.write_zeros(dst_fh, end - pos)
+                pos = end
+            if pos < size:
+                method = file_transfer.copy_range(src_fh, dst_fh, pos,
+                        size - pos, method)
+            dst_fh.truncate(size)
+            for offset, data in self.patches:
+                dst_fh.seek(offset)
+                dst_fh.write(data)
+        return method
+
+
+class RedactionPlan(object):
+    '''Edits for every file making up a slide, keyed by source path.'''
+
+    def __init__(self, filename, format):
+        self.filename = filename
+        self.format = format
+        self.edits = {}
+        self.transfers = []
+
+    def edits_for(self, path):
+        return self.edits.setdefault(path, FileEdits())
+
+    def apply(self, sparse=False):
+        for path, edits in self.edits.items():
+            edits.apply(path, sparse)
+
+    def files(self):
+        # Source files of the slide, paired with their path relative to
+        # the slide's destination
+        files = [(self.filename, None)]
+        if self.format == 'MRXS':
+            dirname = os.path.splitext(self.filename)[0]
+            for name in sorted(os.listdir(dirname)):
+                path = os.path.join(dirname, name)
+                if os.path.isfile(path):
+                    files.append((path, name))
+        return files
+
+    def outputs(self, dst):
+        # Source files of the slide, paired with where copy(@dst) puts them
+        dst_dir = os.path.splitext(dst)[0]
+        return [(path, dst if name is None else os.path.join(dst_dir, name))
+                for path, name in self.files()]
+
+    def copy(self, dst, sparse=False):
+        # Write a de-identified copy of the slide to @dst, leaving the
+        # source untouched
+        for path, out in self.outputs(dst):
+            out_dir = os.path.dirname(out)
+            if out != dst and not os.path.isdir(out_dir):
+                os.makedirs(out_dir)
+            edits = self.edits.get(path, FileEdits())
+            method = edits.copy(path, out, sparse=sparse)
+            if edits.contents is None:
+                shutil.copystat(path, out)
+            if DEBUG:
+                print('Copied', path, 'to', out, 'using', method)
+            self.transfers.append((path, out, method))
+
+
 class TiffFile(object):
-    def __init__(self, path):
-        self._fh = open(path, 'r+b')
+    def __init__(self, path, readonly=False):
+        self._fh = open(path, 'rb' if readonly else 'r+b')
         self._file_size = os.path.getsize(path)
         
         # Check header, decide endianness
@@ -102,11 +358,9 @@ class TiffFile(object):
 
         # Read directories
         self.directories = []
-        while True:
-            in_pointer_offset = self._fh.tell()
-            directory_offset = self.read_fmt('D')
-            if directory_offset == 0:
-                break
+        in_pointer_offset = self._fh.tell()
+        directory_offset = self.read_fmt('D')
+        while directory_offset != 0:
             self._fh.seek(directory_offset)
             directory = TiffDirectory(self, len(self.directories),
                     in_pointer_offset)
@@ -119,6 +373,8 @@ class TiffFile(object):
                         print('Enabling NDPI mode.')
                     self._ndpi = True
             self.directories.append(directory)
+            in_pointer_offset = directory._out_pointer_offset
+            directory_offset = directory.next_offset()
         if not self.directories:
             raise IOError('No directories')
 
@@ -126,6 +382,9 @@ class TiffFile(object):
         return self
 
     def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
         self._fh.close()
 
     def _convert_format(self, fmt):
@@ -176,21 +435,63 @@ class TiffFile(object):
         fmt = self._convert_format(fmt)
         self._fh.write(struct.pack(fmt, *args))
 
+    def plan_delete_directories(self, edits, deletions):
+        # Record the edits that delete several directories at once, without
+        # writing.  @deletions maps directory numbers to the prefix their
+        # strips must start with, or None.  Each run of adjacent deleted
+        # directories is unlinked with a single pointer patch, since the
+        # in-pointer of a directory after a deleted one lies in the
+        # directory being unlinked.
+        for number in sorted(deletions):
+            if number == 0:
+                raise ValueError('The first directory cannot be deleted')
+            self.directories[number].plan_wipe(edits, deletions[number])
+        numbers = sorted(deletions)
+        i = 0
+        while i < len(numbers):
+            first = last = self.directories[numbers[i]]
+            while i + 1 < len(numbers) and numbers[i + 1] == last._number + 1:
+                i += 1
+                last = self.directories[numbers[i]]
+            if DEBUG:
+                print('Deleting directories', first._number, 'to', last._number)
+            edits.patch(first._in_pointer_offset,
+                    struct.pack(self._convert_format('D'), last.next_offset()))
+            i += 1
+
 
 class TiffDirectory(object):
     def __init__(self, tf, number, in_pointer_offset):
-        self.entries = {}
+        # Read the whole entry table, plus room for the largest next-IFD
+        # pointer, in one call and decode it in one pass
         count = tf.read_fmt('Y')
-        for _ in range(count):
-            entry = TiffEntry(tf)
-            self.entries[entry.tag] = entry
+        start = tf._fh.tell()
+        entry_fmt = tf._convert_format('HHZZ')
+        entry_size = struct.calcsize(entry_fmt)
+        buf = tf._fh.read(count * entry_size + 8)
+        if len(buf) < count * entry_size:
+            raise IOError('Short read')
+        self.entries = {}
+        for i, (tag, type, n, value_offset) in enumerate(
+                struct.iter_unpack(entry_fmt, buf[:count * entry_size])):
+            self.entries[tag] = TiffEntry(tf, start + i * entry_size, tag,
+                    type, n, value_offset)
+        self._next_buf = buf[count * entry_size:]
         self._in_pointer_offset = in_pointer_offset
-        self._out_pointer_offset = tf._fh.tell()
+        self._out_pointer_offset = start + count * entry_size
         self._number = number
         self._tf = tf
 
+    def next_offset(self):
+        # The pointer width depends on NDPI mode, which may only be known
+        # after this directory has been read
+        fmt = self._tf._convert_format('D')
+        if len(self._next_buf) < struct.calcsize(fmt):
+            raise IOError('Short read')
+        return struct.unpack_from(fmt, self._next_buf)[0]
 
-    def delete(self, expected_prefix=None):
+    def plan_wipe(self, edits, expected_prefix=None):
+        # Record the edits that blank this directory's strips
         # Get strip offsets/lengths
         try:
             offsets = self.entries[STRIP_OFFSETS].value()
@@ -201,69 +502,93 @@ class TiffDirectory(object):
         # Wipe strips
         for offset, length in zip(offsets, lengths):
             offset = self._tf.near_pointer(self._out_pointer_offset, offset)
-            if DEBUG:
-                print('Zeroing', offset, 'for', length)
-            self._tf._fh.seek(offset)
             if expected_prefix:
+                self._tf._fh.seek(offset)
                 buf = self._tf._fh.read(len(expected_prefix))
                 if buf != expected_prefix:
                     raise IOError('Unexpected data in image strip')
-                self._tf._fh.seek(offset)
-            self._tf._fh.write(b'\0' * length)
+            edits.zero(offset, length)
 
-        # Remove directory
-        if DEBUG:
-            print('Deleting directory', self._number)
-        self._tf._fh.seek(self._out_pointer_offset)
-        out_pointer = self._tf.read_fmt('D')
-        self._tf._fh.seek(self._in_pointer_offset)
-        self._tf.write_fmt('D', out_pointer)
+    def plan_delete(self, edits, expected_prefix=None):
+        # Record the edits that delete this directory, without writing
+        self._tf.plan_delete_directories(edits,
+                {self._number: expected_prefix})
+
+    def strip_prefix(self):
+        # What each strip must start with, judging by the compression
+        try:
+            compression = self.entries[COMPRESSION].value()[0]
+        except KeyError:
+            return None
+        return {LZW: LZW_CLEARCODE, JPEG: JPEG_SOI}.get(compression)
+
+    def delete(self, expected_prefix=None, sparse=False):
+        edits = FileEdits()
+        self.plan_delete(edits, expected_prefix)
+        edits.write_to(self._tf._fh, sparse)
 
 
 class TiffEntry(object):
-    def __init__(self, tf):
-        self.start = tf._fh.tell()
-        self.tag, self.type, self.count, self.value_offset = \
-                tf.read_fmt('HHZZ')
+    __slots__ = ('start', 'tag', 'type', 'count', 'value_offset', '_tf')
+
+    def __init__(self, tf, start, tag, type, count, value_offset):
+        self.start = start
+        self.tag = tag
+        self.type = type
+        self.count = count
+        self.value_offset = value_offset
         self._tf = tf
 
-    def value(self):
-        if self.type == ASCII:
-            item_fmt = 'c'
-        elif self.type == SHORT:
-            item_fmt = 'H'
-        elif self.type == LONG:
-            item_fmt = 'I'
-        elif self.type == LONG8:
-            item_fmt = 'Q'
-        elif self.type == FLOAT:
-            item_fmt = 'f'
-        elif self.type == DOUBLE:
-            item_fmt = 'd'
-        else:
+    def _item_format(self):
+        try:
+            return TYPE_FORMATS[self.type]
+        except KeyError:
             raise ValueError('Unsupported type')
 
+    def _is_inline(self, item_fmt):
+        fmt = '%d%s' % (self.count, item_fmt)
+        return self._tf.fmt_size(fmt) <= self._tf.fmt_size('Z')
+
+    def value(self):
+        item_fmt = self._item_format()
         fmt = '%d%s' % (self.count, item_fmt)
-        len = self._tf.fmt_size(fmt)
-        if len <= self._tf.fmt_size('Z'):
-            # Inline value
-            self._tf._fh.seek(self.start + self._tf.fmt_size('HHZ'))
+        if self._is_inline(item_fmt):
+            # Inline value, already read as the value/offset field
+            buf = struct.pack(self._tf._convert_format('Z'), self.value_offset)
+            items = struct.unpack_from(self._tf._convert_format(fmt), buf)
         else:
             # Out-of-line value
             self._tf._fh.seek(self._tf.near_pointer(self.start, self.value_offset))
-        items = self._tf.read_fmt(fmt, force_list=True)
+            items = self._tf.read_fmt(fmt, force_list=True)
         if self.type == ASCII:
-            if items[-1] != b'\x00':
+            if items[0][-1:] != b'\x00':
                 raise ValueError('String not null-terminated')
-            #print(b''.join(items[:-1]).decode('utf-8'))
-            return b''.join(items[:-1]).decode('utf-8')
+            return items[0][:-1].decode('utf-8')
+        elif self.type == UNDEFINED:
+            return items[0]
         else:
             return items
 
+    def items(self, indices):
+        # Read only the elements at @indices of a numeric array, without
+        # loading the whole array
+        item_fmt = self._item_format()
+        if self._is_inline(item_fmt):
+            values = self.value()
+            return [values[i] for i in indices]
+        base = self._tf.near_pointer(self.start, self.value_offset)
+        size = self._tf.fmt_size(item_fmt)
+        items = []
+        for i in indices:
+            self._tf._fh.seek(base + i * size)
+            items.append(self._tf.read_fmt(item_fmt))
+        return items
+
 
 class MrxsFile(object):
     def __init__(self, filename):
         # Split filename
+        self._filename = filename
         dirname, ext = os.path.splitext(filename)
         if ext != '.mrxs':
             raise UnrecognizedFile
@@ -274,12 +599,13 @@ class MrxsFile(object):
         self._dat.optionxform = str
         try:
             with open(self._slidedatfile, 'rb') as fh:
-                self._have_bom = (fh.read(len(UTF8_BOM)) == UTF8_BOM)
-                if not self._have_bom:
-                    fh.seek(0)
-                self._dat.readfp(fh)
+                buf = fh.read()
         except IOError:
             raise UnrecognizedFile
+        self._have_bom = buf.startswith(UTF8_BOM)
+        if self._have_bom:
+            buf = buf[len(UTF8_BOM):]
+        self._dat.read_string(buf.decode('utf-8'))
 
         # Get file paths
         self._indexfile = os.path.join(dirname,
@@ -342,9 +668,35 @@ class MrxsFile(object):
             fileno = self._read_int32(fh)
             return (self._datafiles[fileno], position, size)
 
-    def _zero_record(self, record):
+    def _get_hier_data_locations(self, record, limit=None):
+        # Data locations of the tiles of hierarchical record @record, up
+        # to @limit of them
+        locations = []
+        with open(self._indexfile, 'rb') as fh:
+            fh.seek(MRXS_HIER_ROOT_OFFSET)
+            table_base = self._read_int32(fh)
+            fh.seek(table_base + record * 4)
+            list_head = self._read_int32(fh)
+            fh.seek(list_head)
+            self._assert_int32(fh, 0)
+            page = self._read_int32(fh)
+            while page != 0:
+                fh.seek(page)
+                count = self._read_int32(fh)
+                page = self._read_int32(fh)
+                for _ in range(count):
+                    if limit is not None and len(locations) >= limit:
+                        return locations
+                    buf = fh.read(16)
+                    if len(buf) != 16:
+                        raise IOError('Short read')
+                    _, position, size, fileno = struct.unpack('<4i', buf)
+                    locations.append((self._datafiles[fileno], position, size))
+        return locations
+
+    def _zero_record(self, plan, record):
         path, offset, length = self._get_data_location(record)
-        with open(path, 'r+b') as fh:
+        with open(path, 'rb') as fh:
             fh.seek(0, 2)
             do_truncate = (fh.tell() == offset + length)
             if DEBUG:
@@ -356,30 +708,34 @@ class MrxsFile(object):
             buf = fh.read(len(JPEG_SOI))
             if buf != JPEG_SOI:
                 raise IOError('Unexpected data in nonhier image')
-            if do_truncate:
-                fh.truncate(offset)
-            else:
-                fh.seek(offset)
-                fh.write('\0' * length)
+        edits = plan.edits_for(path)
+        if do_truncate:
+            if edits.truncate is None or offset < edits.truncate:
+                edits.truncate = offset
+        else:
+            edits.zero(offset, length)
 
-    def _delete_index_record(self, record):
+    def _delete_index_records(self, plan, records):
+        # Close up the nonhier table over all deleted @records in one patch
         if DEBUG:
-            print('Deleting record', record)
-        with open(self._indexfile, 'r+b') as fh:
-            entries_to_move = len(self._level_list) - record - 1
-            if entries_to_move == 0:
-                return
+            print('Deleting records', sorted(records))
+        first = min(records)
+        entries = len(self._level_list)
+        if first == entries - 1:
+            return
+        with open(self._indexfile, 'rb') as fh:
             # get base of table
             fh.seek(MRXS_NONHIER_ROOT_OFFSET)
             table_base = self._read_int32(fh)
             # read tail of table
-            fh.seek(table_base + (record + 1) * 4)
-            buf = fh.read(entries_to_move * 4)
-            if len(buf) != entries_to_move * 4:
+            fh.seek(table_base + first * 4)
+            buf = fh.read((entries - first) * 4)
+            if len(buf) != (entries - first) * 4:
                 raise IOError('Short read')
-            # overwrite the target record
-            fh.seek(table_base + record * 4)
-            fh.write(buf)
+        kept = b''.join(buf[i * 4:(i + 1) * 4]
+                for i in range(entries - first) if first + i not in records)
+        # overwrite from the first deleted record
+        plan.edits_for(self._indexfile).patch(table_base + first * 4, kept)
 
     def _hier_keys_for_level(self, level):
         ret = []
@@ -422,23 +778,48 @@ class MrxsFile(object):
             print('Deleting [%s] %s' % (section, key))
         self._dat.remove_option(section, key)
 
-    def _write(self):
+    def _write(self, plan):
         buf = StringIO()
         self._dat.write(buf)
-        with open(self._slidedatfile, 'wb') as fh:
-            if self._have_bom:
-                fh.write(UTF8_BOM)
-            fh.write(buf.getvalue().replace('\n', '\r\n'))
+        contents = buf.getvalue().replace('\n', '\r\n').encode('utf-8')
+        if self._have_bom:
+            contents = UTF8_BOM + contents
+        plan.edits_for(self._slidedatfile).contents = contents
+
+    def has_level(self, layer_name, level_name):
+        return (layer_name, level_name) in self._levels
+
+    def delete_level(self, layer_name, level_name, plan=None, sparse=False):
+        # With @plan, only record the edits; otherwise apply them now
+        self.delete_levels([(layer_name, level_name)], plan, sparse)
+
+    def delete_levels(self, names, plan=None, sparse=False):
+        # Delete the (layer name, level name) levels in @names together.
+        # With @plan, only record the edits; otherwise apply them now
+        levels = set(self._levels[name] for name in names)
+        apply_now = plan is None
+        if apply_now:
+            plan = RedactionPlan(self._filename, 'MRXS')
+
+        # Zero image data and close up the nonhier table in index, both by
+        # the records of the original file
+        for level in levels:
+            self._zero_record(plan, level.record)
+        self._delete_index_records(plan, set(level.record for level in levels))
+
+        # Update slidedat from the last level back, so the levels still to
+        # be deleted keep their numbers
+        for level in sorted(levels, key=lambda level: -level.record):
+            self._delete_slidedat_level(level)
+            self._make_levels()
 
-    def delete_level(self, layer_name, level_name):
-        level = self._levels[(layer_name, level_name)]
-        record = level.record
-
-        # Zero image data
-        self._zero_record(record)
+        # Write slidedat
+        self._write(plan)
+        if apply_now:
+            plan.apply(sparse)
 
-        # Delete pointer from nonhier table in index
-        self._delete_index_record(record)
+    def _delete_slidedat_level(self, level):
+        record = level.record
 
         # Remove slidedat keys
         for k in self._hier_keys_for_level(level):
@@ -466,12 +847,6 @@ class MrxsFile(object):
         count_v = self._dat.getint(MRXS_HIERARCHICAL, count_k)
         self._set_key(MRXS_HIERARCHICAL, count_k, count_v - 1)
 
-        # Write slidedat
-        self._write()
-
-        # Refresh metadata
-        self._make_levels()
-
 
 class MrxsNonHierLevel(object):
     def __init__(self, dat, layer_id, level_id, record):
@@ -491,56 +866,223 @@ def accept(filename, format):
         print(filename + ':', format)
 
 
-def do_aperio_svs(filename):
-    with TiffFile(filename) as tf:
-        # Check for SVS file
-        try:
-            desc0 = tf.directories[0].entries[IMAGE_DESCRIPTION].value()
-            if not desc0.startswith('Aperio'):
-                raise UnrecognizedFile
-        except KeyError:
-            raise UnrecognizedFile
-        accept(filename, 'SVS')
+def is_aperio_svs(filename, tf):
+    if tf is None:
+        return False
+    try:
+        desc0 = tf.directories[0].entries[IMAGE_DESCRIPTION].value()
+    except KeyError:
+        return False
+    return desc0.startswith('Aperio')
+
+
+def _nothing_to_delete(format, policy):
+    if policy.label_only:
+        return LabelNotFound('No label in %s file' % format)
+    return LabelNotFound('Nothing to delete (%s) in %s file' %
+            (policy.describe(), format))
+
+
+def _plan_directories(filename, tf, format, policy, deletions):
+    # Add the directories @policy names by number to @deletions and plan
+    # them all, so the directory chain is relinked in one batch
+    for number in policy.directories:
+        if number < len(tf.directories):
+            deletions.setdefault(number, tf.directories[number].strip_prefix())
+    if not deletions:
+        raise _nothing_to_delete(format, policy)
+    plan = RedactionPlan(filename, format)
+    tf.plan_delete_directories(plan.edits_for(filename), deletions)
+    return plan
+
+
+def plan_aperio_svs(filename, tf, policy=DEFAULT_POLICY):
+    # Find label, macro and thumbnail (the stripped second directory)
+    deletions = {}
+    for directory in tf.directories:
+        kind = _svs_image_type(directory)
+        if kind == 'label':
+            if policy.label:
+                deletions[directory._number] = LZW_CLEARCODE
+        elif kind == 'macro':
+            if policy.macro:
+                deletions[directory._number] = directory.strip_prefix()
+        elif (directory._number == 1 and policy.thumbnail and
+                TILE_OFFSETS not in directory.entries):
+            deletions[directory._number] = directory.strip_prefix()
+    return _plan_directories(filename, tf, 'SVS', policy, deletions)
+
+
+def _svs_image_type(directory):
+    # Second line of an SVS image description names associated images
+    try:
+        lines = directory.entries[IMAGE_DESCRIPTION].value().splitlines()
+    except KeyError:
+        return None
+    if len(lines) >= 2:
+        return lines[1].split(' ', 1)[0]
+    return None
 
-        # Find and delete label
-        for directory in tf.directories:
-            lines = directory.entries[IMAGE_DESCRIPTION].value().splitlines()
-            if len(lines) >= 2 and lines[1].startswith('label '):
-                directory.delete(expected_prefix=LZW_CLEARCODE)
-                break
-        else:
-            raise IOError("No label in SVS file")
 
+def probe_aperio_svs(filename, tf):
+    types = [_svs_image_type(directory) for directory in tf.directories]
+    return LabelProbe('SVS', LABEL_PRESENT if 'label' in types else LABEL_REMOVED,
+            macro='macro' in types)
 
-def do_hamamatsu_ndpi(filename):
-    with TiffFile(filename) as tf:
-        # Check for NDPI file
-        if NDPI_MAGIC not in tf.directories[0].entries:
-            raise UnrecognizedFile
-        accept(filename, 'NDPI')
 
-        # Find and delete macro image
+def is_hamamatsu_ndpi(filename, tf):
+    return tf is not None and NDPI_MAGIC in tf.directories[0].entries
+
+
+def plan_hamamatsu_ndpi(filename, tf, policy=DEFAULT_POLICY):
+    # Find macro image, which shows the label
+    deletions = {}
+    if policy.label or policy.macro:
         for directory in tf.directories:
             if directory.entries[NDPI_SOURCELENS].value()[0] == -1:
-                directory.delete(expected_prefix=JPEG_SOI)
+                deletions[directory._number] = JPEG_SOI
                 break
-        else:
-            raise IOError("No label in NDPI file")
+    return _plan_directories(filename, tf, 'NDPI', policy, deletions)
+
 
+def probe_hamamatsu_ndpi(filename, tf):
+    # The macro image is what carries the label
+    macro = any(NDPI_SOURCELENS in directory.entries and
+            directory.entries[NDPI_SOURCELENS].value()[0] == -1
+            for directory in tf.directories)
+    return LabelProbe('NDPI', LABEL_PRESENT if macro else LABEL_REMOVED,
+            macro=macro)
 
-def do_3dhistech_mrxs(filename):
-    mrxs = MrxsFile(filename)
+
+def is_3dhistech_mrxs(filename, tf):
+    return tf is None and os.path.splitext(filename)[1] == '.mrxs'
+
+
+def plan_3dhistech_mrxs(filename, tf, policy=DEFAULT_POLICY):
     try:
-        mrxs.delete_level('Scan data layer', 'ScanDataLayer_SlideBarcode')
-    except KeyError:
-        raise IOError('No label in MRXS file')
+        mrxs = MrxsFile(filename)
+    except UnrecognizedFile:
+        raise IOError('Missing or unreadable Slidedat.ini')
+    names = [name for wanted, name in ((policy.label, MRXS_LABEL),
+            (policy.macro, MRXS_MACRO), (policy.thumbnail, MRXS_THUMBNAIL))
+            if wanted]
+    names.extend(policy.mrxs_levels)
+    names = [name for name in set(names) if mrxs.has_level(*name)]
+    if not names:
+        raise _nothing_to_delete('MRXS', policy)
+    plan = RedactionPlan(filename, 'MRXS')
+    mrxs.delete_levels(names, plan)
+    return plan
+
+
+def probe_3dhistech_mrxs(filename, tf):
+    try:
+        mrxs = MrxsFile(filename)
+    except UnrecognizedFile:
+        return LabelProbe('MRXS', LABEL_UNDETECTABLE,
+                error='Missing or unreadable Slidedat.ini')
+    return LabelProbe('MRXS',
+            LABEL_PRESENT if MRXS_LABEL in mrxs._levels else LABEL_REMOVED,
+            macro=MRXS_MACRO in mrxs._levels)
+
+
+class SlideFormat(object):
+    # @detect(filename, tf), @plan(filename, tf, policy) and
+    # @probe(filename, tf) receive the TiffFile parsed by
+    # open_slide_file(), or None if the file is not a TIFF.  @detect must
+    # only look at what is already parsed, and @probe must not read image
+    # data.  @plan deletes what the RedactionPolicy names and raises
+    # LabelNotFound if the slide has none of it.
+    def __init__(self, name, detect, plan, probe=None):
+        self.name = name
+        self.detect = detect
+        self.plan = plan
+        self.probe = probe
+
+
+slide_formats = []
+
+
+def register_format(name, detect, plan, probe=None):
+    # Formats are tried in registration order
+    fmt = SlideFormat(name, detect, plan, probe)
+    slide_formats.append(fmt)
+    return fmt
+
+
+register_format('SVS', is_aperio_svs, plan_aperio_svs, probe_aperio_svs)
+register_format('NDPI', is_hamamatsu_ndpi, plan_hamamatsu_ndpi,
+        probe_hamamatsu_ndpi)
+register_format('MRXS', is_3dhistech_mrxs, plan_3dhistech_mrxs,
+        probe_3dhistech_mrxs)
+
+
+def open_slide_file(filename):
+    # Parse @filename once if it has a TIFF header; None otherwise
+    with open(filename, 'rb') as fh:
+        magic = fh.read(4)
+    if magic not in TIFF_MAGICS:
+        return None
+    try:
+        return TiffFile(filename, readonly=True)
+    except UnrecognizedFile:
+        return None
 
 
-format_handlers = [
-    do_aperio_svs,
-    do_hamamatsu_ndpi,
-    do_3dhistech_mrxs,
-]
+def detect_format(filename, tf):
+    for fmt in slide_formats:
+        if fmt.detect(filename, tf):
+            accept(filename, fmt.name)
+            return fmt
+    raise IOError('Unrecognized file type')
+
+
+def probe_format(filename, tf, fmt):
+    # Probe an already parsed slide of format @fmt
+    if fmt.probe is None:
+        return LabelProbe(fmt.name, LABEL_UNDETECTABLE,
+                error='No label probe for %s' % fmt.name)
+    try:
+        return fmt.probe(filename, tf)
+    except (IOError, ValueError, struct.error) as e:
+        return LabelProbe(fmt.name, LABEL_UNDETECTABLE,
+                error=str(e) or type(e).__name__)
+
+
+def probe_label(filename):
+    # Whether @filename still has a label, from its directory chain or
+    # MRXS index alone
+    try:
+        tf = open_slide_file(filename)
+    except (IOError, ValueError, struct.error) as e:
+        return LabelProbe(None, LABEL_UNDETECTABLE,
+                error=str(e) or type(e).__name__)
+    try:
+        try:
+            fmt = detect_format(filename, tf)
+        except IOError as e:
+            return LabelProbe(None, LABEL_UNDETECTABLE, error=str(e))
+        return probe_format(filename, tf, fmt)
+    finally:
+        if tf is not None:
+            tf.close()
+
+
+def plan_redaction(filename, policy=DEFAULT_POLICY):
+    # Work out what to delete from @filename without modifying it
+    tf = open_slide_file(filename)
+    try:
+        return detect_format(filename, tf).plan(filename, tf, policy)
+    finally:
+        if tf is not None:
+            tf.close()
+
+
+def copy_redacted(src, dst, sparse=False, policy=DEFAULT_POLICY):
+    # De-identify @src into @dst in a single pass over the data
+    plan = plan_redaction(src, policy)
+    plan.copy(dst, sparse=sparse)
+    return plan
 
 
 def _main(args=None):
@@ -554,30 +1096,57 @@ def _main(args=None):
                           description=PROG_DESCRIPTION, version=PROG_VERSION)
     parser.add_option('-d', '--debug', action='store_true',
                       help='show debugging information')
+    parser.add_option('-s', '--sparse', action='store_true',
+                      help='punch holes for deleted images where supported')
+    parser.add_option('-p', '--probe', action='store_true',
+                      help="only report whether each file's label is present")
+    add_policy_options(parser)
+    parser.add_option('--profile', action='store_true',
+                      help='save cProfile/pstats output next to the first file')
+    parser.add_option('--profile-sample', type='int', metavar='N', default=1,
+                      help='with --profile, profile every Nth file [%default]')
     opts, args = parser.parse_args(args)  # Parse provided arguments
     if not args:
         parser.error('Specify at least one file')
 
     DEBUG = opts.debug
+    policy = policy_from_options(parser, opts)
 
     filenames = args
 
+    if opts.probe:
+        for filename in filenames:
+            probe = probe_label(filename)
+            line = '%s: %s' % (filename, probe.label)
+            if probe.format:
+                line += ' (%s%s)' % (probe.format,
+                        ', with macro' if probe.macro else '')
+            if probe.error:
+                line += ': ' + probe.error
+            print(line)
+        return 0
+
+    def redact(filename):
+        plan_redaction(filename, policy).apply(sparse=opts.sparse)
+
+    profiler = None
+    if opts.profile:
+        profiler = profiling.BatchProfiler(profiling.profile_dir_for(
+                os.path.join(os.path.dirname(os.path.abspath(filenames[0])),
+                'anonymize')), opts.profile_sample)
+        redact = profiler.wrap(redact)
+
     exit_code = 0
     for filename in filenames:
         try:
-            for handler in format_handlers:
-                try:
-                    handler(filename)
-                    break
-                except UnrecognizedFile:
-                    pass
-            else:
-                raise IOError('Unrecognized file type')
+            redact(filename)
         except Exception as e:
             if DEBUG:
                 raise
             print(f'{filename}: {str(e)}', file=sys.stderr)
             exit_code = 1
+    if profiler is not None:
+        print('Profile saved to', profiler.save(), file=sys.stderr)
     return exit_code  # Return the exit code instead of calling sys.exit()
 
 
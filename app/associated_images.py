@@ -0,0 +1,211 @@
+"""
+Label and macro images of slides, decoded once.
+
+The same associated images are shown as previews in the slide list, at
+full size in the macro viewer and again, shrunk, in the secure data mapping
+file.  This service decodes each one once and keeps it at full resolution
+and at display size (the size previews and the mapping file use) in a
+least-recently-used memory cache with a byte budget.  Full-size images
+evicted from memory can be spilled to a temporary folder as raw pixels, so
+reading them back costs a file read instead of a JPEG/LZW decode; the folder
+holds label images, so it is removed when the cache is closed.
+"""
+from collections import OrderedDict
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+from broker_writer import fit_to_display
+from preview_cache import file_key
+
+ASSOCIATED_NAMES = ('label', 'macro')
+DEFAULT_MAX_BYTES = 256 << 20
+DEFAULT_MAX_SPILL_BYTES = 2 << 30
+
+FULL = 'full'
+DISPLAY = 'display'
+
+# Cached result for slides without the image
+_MISSING = object()
+
+
+def image_bytes(image):
+    """Memory held by the pixels of a PIL image."""
+    return image.width * image.height * len(image.getbands())
+
+
+class AssociatedImages:
+    """
+    Thread-safe cache of associated images, opening slides through
+    `pool` (a `slide_pool.SlidePool`) or with tiffslide.  With `spill_dir`,
+    full-size images evicted from memory are kept on disk there, up to
+    `max_spill_bytes`.
+    """
+    def __init__(self, pool=None, max_bytes=DEFAULT_MAX_BYTES, spill_dir=None,
+                 max_spill_bytes=DEFAULT_MAX_SPILL_BYTES):
+        self.pool = pool
+        self.max_bytes = max_bytes
+        self.max_spill_bytes = max_spill_bytes
+        self._lock = threading.Lock()
+        self._images = OrderedDict()  # (file key, name, kind) -> image or _MISSING
+        self._bytes = 0
+        self._loading = {}            # (file key, name) -> Event while decoding
+        self._spill_dir = None
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            self._spill_dir = tempfile.mkdtemp(prefix='associated_', dir=spill_dir)
+        self._spilled = OrderedDict()  # (file key, name) -> (path, size)
+        self._spill_bytes = 0
+
+    def full(self, filepath, name):
+        """`name` image of the slide at full resolution, or None."""
+        key = file_key(filepath)
+        image = self._get((key, name, FULL))
+        if image is None:
+            image = self._load(filepath, key, name)
+        return None if image is _MISSING else image
+
+    def display(self, filepath, name):
+        """`name` image shrunk to its display size, in RGB, or None."""
+        key = file_key(filepath)
+        image = self._get((key, name, DISPLAY))
+        if image is None:
+            full = self.full(filepath, name)
+            image = _MISSING if full is None else fit_to_display(full).convert('RGB')
+            self._put((key, name, DISPLAY), image)
+        return None if image is _MISSING else image
+
+    def display_pair(self, filepath):
+        """Display-size label and macro of a slide (either may be None)."""
+        return self.display(filepath, 'label'), self.display(filepath, 'macro')
+
+    def _get(self, cache_key):
+        with self._lock:
+            image = self._images.get(cache_key)
+            if image is not None:
+                self._images.move_to_end(cache_key)
+            return image
+
+    def _load(self, filepath, key, name):
+        # One thread decodes; others asking for the same image wait for it
+        while True:
+            with self._lock:
+                image = self._images.get((key, name, FULL))
+                if image is not None:
+                    return image
+                event = self._loading.get((key, name))
+                if event is None:
+                    event = self._loading[(key, name)] = threading.Event()
+                    break
+            event.wait()
+        try:
+            image = self._unspill(key, name)
+            if image is None:
+                image = self._decode(filepath, name)
+            self._put((key, name, FULL), image)
+            return image
+        finally:
+            with self._lock:
+                del self._loading[(key, name)]
+            event.set()
+
+    def _decode(self, filepath, name):
+        if self.pool is not None:
+            with self.pool.slide(filepath) as slide:
+                image = slide.associated_images.get(name)
+        else:
+            import tiffslide
+            with tiffslide.TiffSlide(filepath) as slide:
+                image = slide.associated_images.get(name)
+        if image is None:
+            return _MISSING
+        image.load()
+        return image
+
+    def _put(self, cache_key, image):
+        size = 0 if image is _MISSING else image_bytes(image)
+        evicted = []
+        with self._lock:
+            old = self._images.pop(cache_key, None)
+            if old is not None and old is not _MISSING:
+                self._bytes -= image_bytes(old)
+            self._images[cache_key] = image
+            self._bytes += size
+            while self._bytes > self.max_bytes and len(self._images) > 1:
+                old_key, old = self._images.popitem(last=False)
+                if old is not _MISSING:
+                    self._bytes -= image_bytes(old)
+                    evicted.append((old_key, old))
+        for (key, name, kind), old in evicted:
+            if kind == FULL:
+                self._spill(key, name, old)
+
+    def _spill_path(self, key, name):
+        digest = hashlib.sha1(f'{key}|{name}'.encode()).hexdigest()
+        return os.path.join(self._spill_dir, digest + '.raw')
+
+    def _spill(self, key, name, image):
+        if self._spill_dir is None:
+            return
+        with self._lock:
+            if (key, name) in self._spilled:
+                return
+        path = self._spill_path(key, name)
+        header = f'{image.mode} {image.width} {image.height}\n'.encode()
+        data = image.tobytes()
+        try:
+            with open(path, 'wb') as fh:
+                fh.write(header)
+                fh.write(data)
+        except OSError:
+            return
+        removed = []
+        with self._lock:
+            self._spilled[(key, name)] = (path, len(data))
+            self._spill_bytes += len(data)
+            while self._spill_bytes > self.max_spill_bytes and len(self._spilled) > 1:
+                _, (old_path, old_size) = self._spilled.popitem(last=False)
+                self._spill_bytes -= old_size
+                removed.append(old_path)
+        for old_path in removed:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+    def _unspill(self, key, name):
+        with self._lock:
+            spilled = self._spilled.get((key, name))
+            if spilled is not None:
+                self._spilled.move_to_end((key, name))
+        if spilled is None:
+            return None
+        from PIL import Image
+        try:
+            with open(spilled[0], 'rb') as fh:
+                mode, width, height = fh.readline().decode().split()
+                return Image.frombytes(mode, (int(width), int(height)), fh.read())
+        except (OSError, ValueError):
+            return None
+
+    def clear(self):
+        """Drop every cached image, in memory and on disk."""
+        with self._lock:
+            self._images.clear()
+            self._bytes = 0
+            spilled = [path for path, _ in self._spilled.values()]
+            self._spilled.clear()
+            self._spill_bytes = 0
+        for path in spilled:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def close(self):
+        self.clear()
+        if self._spill_dir is not None:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
@@ -0,0 +1,712 @@
+"""
+Headless batch de-identification.
+
+Runs the same steps as the "Anonymize All Slides" button -- MD5 renaming,
+single-pass copy-and-redact into a `<folder>_DEID` directory and the secure
+data mapping (honest broker) workbook -- as a pipeline whose copy, image
+capture and verification stages overlap across slides, and writes one JSON
+line per file describing the result.  Progress is journaled so that an
+interrupted batch picks up where it stopped when it is run again.
+"""
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+from optparse import OptionParser
+import hashlib
+import json
+import os
+import sys
+import time
+
+import anonymize_functions
+from anonymize_functions import DEFAULT_POLICY
+from batch_journal import (BROKER_RECORDED, FAILED, REDACTED, VERIFIED,
+                           BatchJournal, journal_path_for)
+from batch_metrics import NULL_METRICS, Metrics, write_prometheus
+from batch_pipeline import Pipeline, Stage
+import profiling
+from broker_writer import BROKER_FORMATS, check_broker_format, fit_to_display, open_broker_writer
+from redaction_verifier import verify_output
+from slide_discovery import iter_slides
+
+PROG_DESCRIPTION = '''
+De-identify whole-slide images in folders or file lists without the GUI.
+'''.strip()
+
+# Jobs held back to interleave source devices while folders are scanned
+INTERLEAVE_WINDOW = 64
+
+# What to do with slides whose label is already gone: copy them without
+# redacting, leave them out, or fail them
+UNLABELED_COPY = 'copy'
+UNLABELED_SKIP = 'skip'
+UNLABELED_FAIL = 'fail'
+UNLABELED_ACTIONS = (UNLABELED_COPY, UNLABELED_SKIP, UNLABELED_FAIL)
+
+
+def deid_folder_for(folder_path):
+    """Output folder used for slides from `folder_path`."""
+    return os.path.normpath(folder_path) + "_DEID"
+
+
+def deid_filename(filename, encrypt_filename=True):
+    """
+    New name of a slide: MD5 of the stem, keeping the extension.  Slides
+    in subfolders are named from their path relative to the folder being
+    de-identified, so same-named slides of different cases do not collide.
+    """
+    name, ext = os.path.splitext(filename.replace(os.sep, '/'))
+    if not encrypt_filename:
+        return name.replace('/', '_') + ext
+    return hashlib.md5(name.encode()).hexdigest() + ext
+
+
+def read_associated_images(slide):
+    """
+    Label and macro of an open TiffSlide as RGB PIL images (or None),
+    shrunk to the size they are shown at in the broker workbook.
+    """
+    label_img = slide.associated_images.get('label')
+    macro_img = slide.associated_images.get('macro')
+    label_pil = fit_to_display(label_img).convert('RGB') if label_img else None
+    macro_pil = fit_to_display(macro_img).convert('RGB') if macro_img else None
+    return label_pil, macro_pil
+
+
+def iter_jobs(paths, output_dir=None, encrypt_filename=True, recursive=True,
+              include=(), exclude=(), scan_workers=1):
+    """
+    Expand folders and files into (src_path, dst_path, name) jobs, yielded
+    as folders are scanned (see `slide_discovery.iter_slides`).  `name` is
+    the path of the slide relative to the folder given.  Without
+    `output_dir`, slides go to the `_DEID` folder of the folder given, or
+    of the parent of a file given.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            root = os.path.abspath(path)
+            sources = iter_slides(root, recursive, include, exclude, scan_workers)
+        else:
+            root = os.path.dirname(os.path.abspath(path))
+            sources = [path]
+        folder = output_dir or deid_folder_for(root)
+        for src_path in sources:
+            name = os.path.relpath(src_path, root)
+            yield (src_path, os.path.join(folder, deid_filename(name, encrypt_filename)),
+                   name)
+
+
+def interleave_by_device(jobs, window=INTERLEAVE_WINDOW):
+    """
+    Round-robin jobs across source devices so workers spread over disks.
+    Up to `window` jobs are held back, so jobs still stream from a scan.
+    """
+    by_device = {}
+    devices = []  # round-robin order
+    held = 0
+    for job in jobs:
+        try:
+            device = os.stat(job[0]).st_dev
+        except OSError:
+            device = None
+        if device not in by_device:
+            by_device[device] = deque()
+            devices.append(device)
+        by_device[device].append(job)
+        held += 1
+        if held >= window:
+            device = devices.pop(0)
+            queue = by_device[device]
+            yield queue.popleft()
+            held -= 1
+            if queue:
+                devices.append(device)
+            else:
+                del by_device[device]
+    while devices:
+        device = devices.pop(0)
+        queue = by_device[device]
+        yield queue.popleft()
+        if queue:
+            devices.append(device)
+
+
+class SlideJob:
+    """
+    One slide moving through the batch pipeline.  With a `journal`, each
+    step is recorded as it completes and steps an earlier run already
+    completed for the same source are skipped.  `name` is the original
+    name recorded in the mapping file; it defaults to the filename.
+    """
+    def __init__(self, src_path, dst_path, journal=None, name=None):
+        self.src_path = src_path
+        self.dst_path = dst_path
+        self.journal = journal
+        self.name = name or os.path.basename(src_path)
+        self.key = None
+        self.done = set()
+        self.plan = None
+        self.label = None
+        self.macro = None
+        self.result = {
+            'source': os.path.abspath(src_path),
+            'destination': os.path.abspath(dst_path),
+            'status': 'ok',
+            'format': None,
+            'label': None,
+            'transfer': None,
+            'verified': False,
+            'resumed': None,
+            'error': None,
+            'seconds': None,
+        }
+        self._start = time.perf_counter()
+
+    @property
+    def ok(self):
+        return self.result['status'] == 'ok'
+
+    def resume(self):
+        """Look up what earlier runs finished for this slide."""
+        if self.journal is None:
+            return
+        self.key = self.journal.source_key(self.src_path)
+        self.done = self.journal.states(self.src_path, self.dst_path, self.key)
+        if self.done:
+            self.result['resumed'] = sorted(self.done)
+            self.result['verified'] = VERIFIED in self.done
+            details = self.journal.details(self.src_path, self.dst_path, self.key)
+            for field in ('format', 'label', 'transfer'):
+                if field in details:
+                    self.result[field] = details[field]
+
+    def record(self, state, **extra):
+        if self.journal is not None:
+            self.journal.record(self.src_path, self.dst_path, self.key, state, **extra)
+
+    def fail(self, error):
+        self.result['status'] = 'error'
+        self.result['error'] = str(error)
+        self.record(FAILED, error=str(error))
+
+    def skip(self, reason):
+        self.result['status'] = 'skipped'
+        self.result['skipped'] = reason
+
+    def finish(self):
+        self.result['seconds'] = round(time.perf_counter() - self._start, 3)
+        return self
+
+
+def plan_volume(plan):
+    """Bytes of label data `plan` blanks, and bytes its copy writes."""
+    label_bytes = copy_bytes = 0
+    for path, _ in plan.files():
+        edits = plan.edits.get(path)
+        size = os.path.getsize(path)
+        if edits is None:
+            copy_bytes += size
+            continue
+        if edits.contents is not None:
+            copy_bytes += len(edits.contents)
+            continue
+        if edits.truncate is not None and edits.truncate < size:
+            label_bytes += size - edits.truncate
+            size = edits.truncate
+        label_bytes += sum(max(0, min(offset + length, size) - offset)
+                           for offset, length in edits.zeros)
+        copy_bytes += size
+    return label_bytes, copy_bytes
+
+
+def plan_slide(src_path, unlabeled=UNLABELED_COPY, policy=DEFAULT_POLICY):
+    """
+    Probe the label of `src_path` and plan what `policy` (an
+    `anonymize_functions.RedactionPolicy`) deletes from it, from one parse
+    of its headers.  Returns the `anonymize_functions.LabelProbe` and the
+    plan.  For a slide with nothing left to delete, the plan is a plain
+    copy, None to skip it, or LabelNotFound is raised, according to
+    `unlabeled`; with the default policy, the probe alone decides.
+    """
+    tf = anonymize_functions.open_slide_file(src_path)
+    try:
+        fmt = anonymize_functions.detect_format(src_path, tf)
+        probe = anonymize_functions.probe_format(src_path, tf, fmt)
+        if (probe.label != anonymize_functions.LABEL_REMOVED or not policy.label_only
+                or unlabeled == UNLABELED_FAIL):
+            try:
+                return probe, fmt.plan(src_path, tf, policy)
+            except anonymize_functions.LabelNotFound:
+                if unlabeled == UNLABELED_FAIL:
+                    raise
+        if unlabeled == UNLABELED_SKIP:
+            return probe, None
+        return probe, anonymize_functions.RedactionPlan(src_path, fmt.name)
+    finally:
+        if tf is not None:
+            tf.close()
+
+
+def redact_stage(job, sparse=False, metrics=NULL_METRICS, unlabeled=UNLABELED_COPY,
+                 policy=DEFAULT_POLICY):
+    """
+    Plan the redaction `policy` and write the de-identified copy.  Slides
+    without a label are handled according to `unlabeled` before anything
+    is copied.
+    """
+    job.resume()
+    if REDACTED in job.done:
+        return job
+    try:
+        with metrics.span('parse', job.dst_path) as span:
+            probe, plan = plan_slide(job.src_path, unlabeled, policy)
+            span['label'] = probe.label
+        job.result['format'] = probe.format
+        job.result['label'] = probe.label
+        if plan is None:
+            job.skip('No label to remove')
+            return job
+        os.makedirs(os.path.dirname(job.dst_path), exist_ok=True)
+        with metrics.span('copy', job.dst_path, format=plan.format) as span:
+            plan.copy(job.dst_path, sparse=sparse)
+            label_bytes, copy_bytes = plan_volume(plan)
+            span.update(bytes_read=copy_bytes, bytes_written=copy_bytes,
+                        label_bytes=label_bytes,
+                        transfer=sorted({method for _, _, method in plan.transfers}))
+        job.plan = plan
+        job.result['transfer'] = sorted({method for _, _, method in plan.transfers})
+        job.record(REDACTED, format=plan.format, label=probe.label,
+                   transfer=job.result['transfer'])
+    except Exception as e:
+        job.fail(e)
+    return job
+
+
+def capture_images(src_path, images=None):
+    """
+    Original label and macro of a slide, or (None, None).  With an
+    `associated_images.AssociatedImages`, images it already decoded (for
+    previews, say) are reused.
+    """
+    try:
+        if images is not None:
+            return images.display_pair(src_path)
+        import tiffslide
+        with tiffslide.TiffSlide(src_path) as slide:
+            return read_associated_images(slide)
+    except Exception as e:
+        print(f"Error reading associated images for {src_path}: {str(e)}",
+              file=sys.stderr)
+        return (None, None)
+
+
+def capture_stage(job, executor=None, metrics=NULL_METRICS, images=None):
+    """Decode the source's label and macro for the broker workbook."""
+    if job.ok and BROKER_RECORDED not in job.done:
+        with metrics.span('capture', job.dst_path):
+            if executor is not None:
+                job.label, job.macro = executor.submit(capture_images, job.src_path).result()
+            else:
+                job.label, job.macro = capture_images(job.src_path, images)
+    return job
+
+
+def verify_stage(job, metrics=NULL_METRICS, policy=DEFAULT_POLICY):
+    """
+    Check that nothing `policy` deletes is reachable in the output, that
+    the ranges the redaction blanked are blank and that the slide still
+    reads.
+    """
+    if job.ok and VERIFIED not in job.done:
+        try:
+            # A resumed job redacted the (unchanged) source in an earlier run
+            plan = job.plan or plan_slide(job.src_path, policy=policy)[1]
+            with metrics.span('verify', job.dst_path):
+                problems = verify_output(job.dst_path, plan, policy=policy)
+        except Exception as e:
+            job.fail(f'Output could not be verified: {str(e)}')
+        else:
+            if problems:
+                job.fail('; '.join(problems))
+            else:
+                job.result['verified'] = True
+                job.record(VERIFIED)
+    job.plan = None
+    return job.finish()
+
+
+def make_pipeline(copy_workers=2, capture_workers=None, verify_workers=2,
+                  capture=True, sparse=False, capture_executor=None,
+                  metrics=NULL_METRICS, profiler=None, images=None,
+                  unlabeled=UNLABELED_COPY, policy=DEFAULT_POLICY):
+    """
+    Pipeline of redact -> capture -> verify stages, each with its own
+    workers.  Decoding can be sent to `capture_executor` (e.g. a process
+    pool) so it does not compete with copies for the GIL; otherwise images
+    come from `images` (an `associated_images.AssociatedImages`) if one is
+    given.  Stage timings go to `metrics`; with a
+    `profiling.BatchProfiler`, stage calls are profiled too.  `policy` is
+    what to delete from each slide and `unlabeled` what to do with slides
+    whose label is already gone.
+    """
+    if capture_workers is None:
+        capture_workers = os.cpu_count() or 1
+    wrap = profiler.wrap if profiler is not None else (lambda func: func)
+    stages = [Stage('redact', wrap(lambda job: redact_stage(job, sparse, metrics, unlabeled, policy)),
+                    copy_workers)]
+    if capture:
+        stages.append(Stage('capture', wrap(lambda job: capture_stage(job, capture_executor, metrics,
+                                                                      images)),
+                            capture_workers))
+    stages.append(Stage('verify', wrap(lambda job: verify_stage(job, metrics, policy)),
+                        verify_workers))
+    return Pipeline(stages)
+
+
+def _init_worker(debug):
+    anonymize_functions.DEBUG = debug
+
+
+def run_batch(jobs, copy_workers=2, capture_workers=None, verify_workers=2,
+              use_threads=False, create_honest_broker=True, sparse=False,
+              on_result=None, broker_format='xlsx', resume=True,
+              content_hash=False, metrics=NULL_METRICS, profiler=None,
+              broker_rotate=None, keep_results=True,
+              interleave_window=INTERLEAVE_WINDOW, unlabeled=UNLABELED_COPY,
+              policy=DEFAULT_POLICY):
+    """
+    De-identify `jobs`, (src_path, dst_path[, name]) tuples that may still
+    be arriving from a folder scan, through the staged pipeline.  Unless
+    `use_threads`, label/macro decoding runs in a process pool.
+    `on_result(result)` is called as each file finishes.  Returns the list
+    of results and the mapping files (of `broker_format`, see
+    `broker_writer`) that were written.
+
+    Progress is journaled next to each output folder.  With `resume`, slides
+    an earlier run finished are skipped and interrupted ones are picked up
+    where they stopped; `content_hash` also compares the ends of each source.
+    Stage timings and byte counts go to `metrics`, and stage calls and the
+    broker build are profiled by `profiler` if one is given.
+
+    For long-running batches, `broker_rotate` closes each mapping file
+    once it is that many seconds old and starts a new one with the next
+    slide, and `keep_results=False` stops results from being accumulated.
+    Up to `interleave_window` jobs are held back to spread the copies over
+    source devices; 1 starts every job as soon as it arrives.  What is
+    deleted from each slide is set by `policy`, and slides whose label is
+    already gone are copied, skipped or failed as `unlabeled` says, without
+    being copied first.  ValueError is raised before anything is written
+    if mapping files of `broker_format` cannot be.
+    """
+    if create_honest_broker:
+        check_broker_format(broker_format)
+    if capture_workers is None:
+        capture_workers = os.cpu_count() or 1
+    capture_executor = None
+    if create_honest_broker and not use_threads:
+        capture_executor = ProcessPoolExecutor(
+            max_workers=capture_workers, initializer=_init_worker,
+            initargs=(anonymize_functions.DEBUG,))
+    pipeline = make_pipeline(copy_workers, capture_workers, verify_workers,
+                             capture=create_honest_broker, sparse=sparse,
+                             capture_executor=capture_executor, metrics=metrics,
+                             profiler=profiler, unlabeled=unlabeled, policy=policy)
+    journals = {}
+
+    def slide_jobs():
+        for src, dst, *name in interleave_by_device(jobs, interleave_window):
+            deid_folder = os.path.dirname(os.path.abspath(dst))
+            journal = journals.get(deid_folder)
+            if journal is None:
+                os.makedirs(deid_folder, exist_ok=True)
+                journal = journals[deid_folder] = BatchJournal(
+                    journal_path_for(deid_folder), content_hash, restart=not resume)
+            yield SlideJob(src, dst, journal, *name)
+
+    results = []
+    brokers = {}
+    broker_paths = []
+    broker_opened = {}
+    # Jobs whose rows are in each mapping file; recorded once it is saved
+    broker_jobs = {}
+
+    def add_row(broker, *row):
+        broker.add_row(*row)
+
+    def close(broker):
+        broker.close()
+
+    def save_broker(deid_folder):
+        broker = brokers.pop(deid_folder)
+        with metrics.span('broker_save', broker.path) as span:
+            close(broker)
+            if os.path.isfile(broker.path):
+                span['bytes_written'] = os.path.getsize(broker.path)
+        for job in broker_jobs.pop(deid_folder):
+            job.record(BROKER_RECORDED, broker=broker.path)
+
+    with ExitStack() as stack:
+        if profiler is not None:
+            # Rows are added as slides finish, so the broker build spans the run
+            stack.enter_context(profiler.trace_memory('broker_build'))
+            add_row, close = profiler.wrap(add_row), profiler.wrap(close)
+        try:
+            for job in pipeline.run(slide_jobs()):
+                result = job.result
+                if keep_results:
+                    results.append(result)
+                if on_result is not None:
+                    on_result(result)
+                if create_honest_broker and job.ok and BROKER_RECORDED not in job.done:
+                    # One workbook per output folder, filled in as files finish
+                    deid_folder = os.path.dirname(result['destination'])
+                    broker = brokers.get(deid_folder)
+                    if (broker is not None and broker_rotate is not None
+                            and time.time() - broker_opened[deid_folder] >= broker_rotate):
+                        save_broker(deid_folder)
+                        broker = None
+                    if broker is None:
+                        broker = brokers[deid_folder] = open_broker_writer(deid_folder, broker_format)
+                        broker_paths.append(broker.path)
+                        broker_opened[deid_folder] = time.time()
+                        broker_jobs[deid_folder] = []
+                    with metrics.span('broker_encode', job.dst_path):
+                        add_row(broker, job.name,
+                                os.path.basename(result['destination']),
+                                job.label, job.macro)
+                    broker_jobs[deid_folder].append(job)
+                    job.label = job.macro = None
+        finally:
+            try:
+                if capture_executor is not None:
+                    capture_executor.shutdown()
+                for deid_folder in list(brokers):
+                    save_broker(deid_folder)
+            finally:
+                for journal in journals.values():
+                    journal.close()
+
+    return results, broker_paths
+
+
+def dry_run_slide(src_path, unlabeled=UNLABELED_COPY, policy=DEFAULT_POLICY):
+    """
+    What de-identifying `src_path` would do, worked out from its headers
+    without writing anything: format, whether it still has a label, bytes
+    of label data that would be blanked, bytes the copy would write, or why
+    it would fail or be skipped.
+    """
+    result = {
+        'source': os.path.abspath(src_path),
+        'status': 'ok',
+        'format': None,
+        'label': None,
+        'label_bytes': 0,
+        'copy_bytes': 0,
+        'error': None,
+    }
+    start = time.perf_counter()
+    try:
+        probe, plan = plan_slide(src_path, unlabeled, policy)
+        result['format'] = probe.format
+        result['label'] = probe.label
+        if plan is None:
+            result['status'] = 'skipped'
+            result['skipped'] = 'No label to remove'
+        else:
+            result['label_bytes'], result['copy_bytes'] = plan_volume(plan)
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = str(e) or type(e).__name__
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def dry_run(src_paths, workers=8, on_result=None, unlabeled=UNLABELED_COPY,
+            policy=DEFAULT_POLICY):
+    """
+    Plan every slide in parallel without writing anything and summarize:
+    counts per format, per label state and per expected failure or skip,
+    and bytes to be blanked and copied.  Returns the per-slide results and
+    the summary.
+    """
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for result in executor.map(lambda path: dry_run_slide(path, unlabeled, policy),
+                                   src_paths):
+            results.append(result)
+            if on_result is not None:
+                on_result(result)
+    ok = [r for r in results if r['status'] == 'ok']
+    summary = {
+        'files': len(results),
+        'ok': len(ok),
+        'skipped': sum(r['status'] == 'skipped' for r in results),
+        'formats': dict(Counter(r['format'] or 'unrecognized' for r in results)),
+        'labels': dict(Counter(r['label'] or 'unknown' for r in results)),
+        'failures': dict(Counter(r['error'] for r in results if r['status'] == 'error')),
+        'label_bytes': sum(r['label_bytes'] for r in ok),
+        'copy_bytes': sum(r['copy_bytes'] for r in ok),
+    }
+    return results, summary
+
+
+def format_summary(summary):
+    """Human-readable lines for a dry run summary."""
+    lines = [f"{summary['ok']} of {summary['files']} slides can be de-identified"]
+    for name, count in sorted(summary['formats'].items()):
+        lines.append(f"  {name}: {count}")
+    for state, count in sorted(summary['labels'].items()):
+        lines.append(f"  label {state}: {count}")
+    if summary['skipped']:
+        lines.append(f"  will be skipped (no label to remove): {summary['skipped']}")
+    for error, count in sorted(summary['failures'].items(), key=lambda item: -item[1]):
+        lines.append(f"  will fail ({count}): {error}")
+    lines.append(f"Label data to blank: {summary['label_bytes'] / (1 << 20):.1f} MiB")
+    lines.append(f"Data to copy: {summary['copy_bytes'] / (1 << 30):.2f} GiB")
+    return lines
+
+
+def timed_discovery(jobs, metrics=NULL_METRICS):
+    """
+    Pass `jobs` through, recording the time spent producing them as one
+    discovery span, without the time the consumer spends in between.
+    """
+    seconds = 0.0
+    count = 0
+    jobs = iter(jobs)
+    while True:
+        start = time.perf_counter()
+        try:
+            job = next(jobs)
+        except StopIteration:
+            break
+        finally:
+            seconds += time.perf_counter() - start
+        count += 1
+        yield job
+    metrics.record('discovery', seconds, files=count)
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = OptionParser(usage='%prog [options] folder|file [...]',
+                          description=PROG_DESCRIPTION,
+                          version=anonymize_functions.PROG_VERSION)
+    parser.add_option('-o', '--output', metavar='DIR',
+                      help='write all slides to DIR instead of <folder>_DEID')
+    parser.add_option('-j', '--jobs', type='int', metavar='N', default=2,
+                      help='number of parallel copies [%default]')
+    parser.add_option('--capture-workers', type='int', metavar='N',
+                      help='number of label/macro decoders [CPU count]')
+    parser.add_option('--verify-workers', type='int', metavar='N', default=2,
+                      help='number of output verifiers [%default]')
+    parser.add_option('--threads', action='store_true',
+                      help='decode images in threads instead of processes')
+    parser.add_option('--no-recurse', action='store_true',
+                      help='only de-identify slides directly inside each folder')
+    parser.add_option('--include', action='append', default=[], metavar='GLOB',
+                      help='only de-identify slides matching GLOB (repeatable)')
+    parser.add_option('--exclude', action='append', default=[], metavar='GLOB',
+                      help='skip slides and folders matching GLOB (repeatable)')
+    parser.add_option('--scan-workers', type='int', metavar='N', default=1,
+                      help='folders listed in parallel, for network filesystems [%default]')
+    parser.add_option('--keep-filenames', action='store_true',
+                      help='do not replace filenames with their MD5')
+    parser.add_option('--no-broker', action='store_true',
+                      help='do not write the secure data mapping file')
+    parser.add_option('--broker-format', type='choice', default='xlsx',
+                      choices=sorted(BROKER_FORMATS), metavar='FORMAT',
+                      help='mapping file format: %s [%%default]' % ', '.join(sorted(BROKER_FORMATS)))
+    parser.add_option('--unlabeled', type='choice', default=UNLABELED_COPY,
+                      choices=UNLABELED_ACTIONS, metavar='ACTION',
+                      help='for slides whose label is already gone: %s [%%default]'
+                      % ', '.join(UNLABELED_ACTIONS))
+    anonymize_functions.add_policy_options(parser)
+    parser.add_option('--restart', action='store_true',
+                      help='redo slides that an earlier run already finished')
+    parser.add_option('--hash', action='store_true',
+                      help='also compare source contents when resuming')
+    parser.add_option('-n', '--dry-run', action='store_true',
+                      help='only report what would be done, without writing')
+    parser.add_option('--metrics', metavar='FILE',
+                      help='append JSON-lines timings of every step to FILE')
+    parser.add_option('--prometheus', metavar='FILE',
+                      help='write per-stage totals to FILE as a Prometheus textfile')
+    parser.add_option('--profile', action='store_true',
+                      help='save cProfile/pstats and tracemalloc output next to the output')
+    parser.add_option('--profile-sample', type='int', metavar='N', default=1,
+                      help='with --profile, profile every Nth file [%default]')
+    parser.add_option('-r', '--report', metavar='FILE', default='-',
+                      help='write JSON-lines results to FILE [stdout]')
+    parser.add_option('-s', '--sparse', action='store_true',
+                      help='leave holes for deleted images where supported')
+    parser.add_option('-d', '--debug', action='store_true',
+                      help='show debugging information')
+    opts, args = parser.parse_args(args)
+    if not args:
+        parser.error('Specify at least one folder or file')
+
+    if not opts.no_broker and not opts.dry_run:
+        try:
+            check_broker_format(opts.broker_format)
+        except ValueError as e:
+            parser.error(str(e))
+
+    anonymize_functions.DEBUG = opts.debug
+    policy = anonymize_functions.policy_from_options(parser, opts)
+    metrics = Metrics(opts.metrics) if opts.metrics or opts.prometheus else NULL_METRICS
+    # Slides are processed while folders are still being scanned
+    jobs = timed_discovery(iter_jobs(
+        args, opts.output, not opts.keep_filenames, not opts.no_recurse,
+        opts.include, opts.exclude, opts.scan_workers), metrics)
+
+    profiler = None
+    if opts.profile:
+        first = os.path.abspath(args[0])
+        profiler = profiling.BatchProfiler(profiling.profile_dir_for(
+            opts.output or deid_folder_for(first if os.path.isdir(first)
+                                           else os.path.dirname(first))),
+            opts.profile_sample)
+
+    report = sys.stdout if opts.report == '-' else open(opts.report, 'w')
+    try:
+        def on_result(result):
+            report.write(json.dumps(result) + '\n')
+            report.flush()
+            if result['status'] == 'error':
+                print(f"{result['source']}: {result['error']}", file=sys.stderr)
+
+        if opts.dry_run:
+            # Headers only, so use more readers than copy workers
+            results, summary = dry_run((job[0] for job in jobs),
+                                       max(8, opts.jobs), on_result, opts.unlabeled, policy)
+            for line in format_summary(summary):
+                print(line, file=sys.stderr)
+            return 0 if summary['ok'] + summary['skipped'] == summary['files'] else 1
+
+        results, broker_paths = run_batch(
+            jobs, copy_workers=opts.jobs, capture_workers=opts.capture_workers,
+            verify_workers=opts.verify_workers, use_threads=opts.threads,
+            create_honest_broker=not opts.no_broker, sparse=opts.sparse,
+            on_result=on_result, broker_format=opts.broker_format,
+            resume=not opts.restart, content_hash=opts.hash, metrics=metrics,
+            profiler=profiler, unlabeled=opts.unlabeled, policy=policy)
+    finally:
+        if report is not sys.stdout:
+            report.close()
+        if opts.prometheus:
+            write_prometheus(opts.prometheus, metrics.totals())
+        metrics.close()
+        if profiler is not None:
+            print(f"Profile: {profiler.save()}", file=sys.stderr)
+
+    for broker_path in broker_paths:
+        print(f"Secure data mapping file: {broker_path}", file=sys.stderr)
+    return 0 if all(r['status'] != 'error' for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""
+Append-only journal of batch de-identification progress.
+
+Each state a slide reaches is appended as one JSON line and flushed at
+once, so after a crash or cancel the journal tells which outputs in the
+`_DEID` folder are finished.  A rerun skips slides whose source is
+unchanged (same size and modification time, optionally the same hash of
+its first and last megabyte) and redoes only the steps that are missing.
+"""
+import json
+import os
+import threading
+import time
+
+from preview_cache import file_key
+
+# States in the order a slide reaches them.  The copy and the redaction
+# happen in one pass, so a slide is never copied without being redacted.
+REDACTED = 'redacted'
+VERIFIED = 'verified'
+BROKER_RECORDED = 'broker-recorded'
+FAILED = 'failed'
+
+# Fields of every record; anything else is a detail of the state
+_RECORD_FIELDS = ('source', 'destination', 'key', 'state', 'time')
+
+
+def journal_path_for(deid_folder):
+    """Path of the journal of slides written to `deid_folder`.  It names
+    the original files, so it lives next to the folder like the mapping file."""
+    return f"{os.path.normpath(deid_folder)}_PHI_Journal.jsonl"
+
+
+class BatchJournal:
+    """Journal file shared by the workers of a batch."""
+    def __init__(self, path, content_hash=False, restart=False):
+        self.path = path
+        self.content_hash = content_hash
+        self._lock = threading.Lock()
+        # source -> (key, destination, set of states, details recorded with them)
+        self._states = {}
+        if not restart and os.path.exists(path):
+            self._load()
+        self._fh = open(path, 'w' if restart else 'a', encoding='utf-8')
+
+    def _load(self):
+        with open(self.path, encoding='utf-8') as fh:
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Partial line from a crash
+                    continue
+                self._update(record)
+
+    def _update(self, record):
+        source = record['source']
+        key, destination = record['key'], record['destination']
+        state = record['state']
+        entry = self._states.get(source)
+        if (entry is None or entry[0] != key or entry[1] != destination
+                or state in (REDACTED, FAILED)):
+            # A new copy supersedes everything recorded about older ones
+            entry = self._states[source] = (key, destination, set(), {})
+        if state != FAILED:
+            entry[2].add(state)
+            entry[3].update((name, value) for name, value in record.items()
+                            if name not in _RECORD_FIELDS)
+
+    def source_key(self, src_path):
+        """Identity of the current contents of `src_path`, or None."""
+        try:
+            return file_key(src_path, self.content_hash)
+        except OSError:
+            return None
+
+    def _entry(self, src_path, dst_path, key):
+        if key is None or not os.path.exists(dst_path):
+            return None
+        entry = self._states.get(os.path.abspath(src_path))
+        if (entry is None or entry[0] != key
+                or entry[1] != os.path.abspath(dst_path)):
+            return None
+        return entry
+
+    def states(self, src_path, dst_path, key):
+        """States already reached by the slide, if its source is unchanged
+        and its output is still there."""
+        with self._lock:
+            entry = self._entry(src_path, dst_path, key)
+            return set(entry[2]) if entry is not None else set()
+
+    def details(self, src_path, dst_path, key):
+        """Extra fields recorded with those states, such as the format."""
+        with self._lock:
+            entry = self._entry(src_path, dst_path, key)
+            return dict(entry[3]) if entry is not None else {}
+
+    def record(self, src_path, dst_path, key, state, **extra):
+        record = dict(source=os.path.abspath(src_path),
+                      destination=os.path.abspath(dst_path),
+                      key=key, state=state, time=time.time(), **extra)
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            self._fh.write(line)
+            self._fh.flush()
+            self._update(record)
+
+    def close(self):
+        with self._lock:
+            if not self._fh.closed:
+                self._fh.flush()
+                os.fsync(self._fh.fileno())
+                self._fh.close()
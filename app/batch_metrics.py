@@ -0,0 +1,161 @@
+"""
+Timing and byte-count metrics for loading and de-identifying slides.
+
+Work is measured in named spans (discovery, parse, copy, capture, verify,
+broker encoding, ...).  Every span can be streamed as a JSON line as it
+ends, and the per-stage totals can be written as a Prometheus textfile for
+node_exporter's textfile collector.  Paths recorded in events should be
+de-identified ones; original filenames do not belong in metrics.
+"""
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+METRIC_PREFIX = 'wsi_deid'
+
+
+class StageTotals:
+    """Aggregate of all spans of one stage."""
+    __slots__ = ('count', 'seconds', 'max_seconds', 'bytes_read',
+                 'bytes_written', 'errors')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.errors = 0
+
+
+class Metrics:
+    """Thread-safe span recorder, optionally streaming events to a file."""
+    def __init__(self, events_path=None):
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._events = None
+        if events_path:
+            self._events = open(events_path, 'a', encoding='utf-8')
+
+    @contextmanager
+    def span(self, stage, path=None, **fields):
+        """
+        Time the body of a `with` block as one span of `stage`.  The dict
+        yielded can be given `bytes_read`, `bytes_written` and any other
+        fields to record with the event.
+        """
+        start_time = time.time()
+        start = time.perf_counter()
+        failed = False
+        try:
+            yield fields
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            if failed:
+                fields['error'] = True
+            self.record(stage, time.perf_counter() - start, path=path,
+                        start=start_time, **fields)
+
+    def record(self, stage, seconds, path=None, bytes_read=0, bytes_written=0,
+               start=None, **extra):
+        """Record one span that was timed elsewhere."""
+        with self._lock:
+            totals = self._stages.get(stage)
+            if totals is None:
+                totals = self._stages[stage] = StageTotals()
+            totals.count += 1
+            totals.seconds += seconds
+            totals.max_seconds = max(totals.max_seconds, seconds)
+            totals.bytes_read += bytes_read
+            totals.bytes_written += bytes_written
+            if extra.get('error'):
+                totals.errors += 1
+            if self._events is not None:
+                event = dict(stage=stage, path=path,
+                             start=start if start is not None else time.time() - seconds,
+                             seconds=round(seconds, 6), bytes_read=bytes_read,
+                             bytes_written=bytes_written, **extra)
+                self._events.write(json.dumps(event, default=str) + '\n')
+                self._events.flush()
+
+    def totals(self):
+        """Copy of the per-stage totals, keyed by stage name."""
+        with self._lock:
+            totals = {}
+            for stage, stage_totals in self._stages.items():
+                copy = totals[stage] = StageTotals()
+                for name in StageTotals.__slots__:
+                    setattr(copy, name, getattr(stage_totals, name))
+            return totals
+
+    def close(self):
+        with self._lock:
+            if self._events is not None:
+                self._events.close()
+                self._events = None
+
+
+class _NullMetrics:
+    """Stand-in when nothing is being measured."""
+    @contextmanager
+    def span(self, stage, path=None, **fields):
+        yield fields
+
+    def record(self, stage, seconds, path=None, **fields):
+        pass
+
+    def totals(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+NULL_METRICS = _NullMetrics()
+
+
+_PROMETHEUS_METRICS = (
+    ('runs_total', 'counter', 'Spans recorded per stage.', 'count'),
+    ('seconds_total', 'counter', 'Time spent per stage.', 'seconds'),
+    ('seconds_max', 'gauge', 'Longest single span per stage.', 'max_seconds'),
+    ('bytes_read_total', 'counter', 'Bytes read per stage.', 'bytes_read'),
+    ('bytes_written_total', 'counter', 'Bytes written per stage.', 'bytes_written'),
+    ('errors_total', 'counter', 'Spans that ended in an error per stage.', 'errors'),
+)
+
+
+def format_prometheus(totals, prefix=METRIC_PREFIX):
+    """Prometheus text exposition of per-stage `totals`."""
+    lines = []
+    for suffix, kind, help_text, attr in _PROMETHEUS_METRICS:
+        name = f'{prefix}_stage_{suffix}'
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for stage in sorted(totals):
+            value = getattr(totals[stage], attr)
+            lines.append(f'{name}{{stage="{stage}"}} {value:g}'
+                         if isinstance(value, float) else
+                         f'{name}{{stage="{stage}"}} {value}')
+    name = f'{prefix}_last_run_timestamp_seconds'
+    lines.append(f'# HELP {name} When these metrics were written.')
+    lines.append(f'# TYPE {name} gauge')
+    lines.append(f'{name} {time.time():.3f}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path, totals, prefix=METRIC_PREFIX):
+    """Atomically write `totals` as a Prometheus textfile."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as fh:
+        fh.write(format_prometheus(totals, prefix))
+    os.replace(tmp_path, path)
+
+
+def metrics_paths_for(deid_folder):
+    """Events and textfile paths for metrics of a batch into `deid_folder`."""
+    base = os.path.normpath(deid_folder)
+    return f'{base}_metrics.jsonl', f'{base}_metrics.prom'
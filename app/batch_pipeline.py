@@ -0,0 +1,120 @@
+"""
+Staged pipeline with bounded queues between stages.
+
+Each stage runs its function on its own pool of threads, so I/O-bound and
+CPU-bound work on different items overlaps.  Queues between stages hold a
+fixed number of items: a slow stage blocks the ones before it instead of
+letting work pile up in memory.
+"""
+import queue
+import threading
+
+_DONE = object()
+
+
+class Stage:
+    """A step of the pipeline: `func(item)` returns the item passed on."""
+    def __init__(self, name, func, workers=1, queue_size=None):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        # Items allowed to wait in front of this stage
+        self.queue_size = queue_size or 2 * self.workers
+
+
+class Pipeline:
+    def __init__(self, stages):
+        self.stages = stages
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        """Stop feeding new items; items already in flight still finish."""
+        self._cancelled.set()
+
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def run(self, items, on_idle=None, idle_interval=0.1):
+        """
+        Push `items` through the stages and yield outputs as they complete;
+        as many outputs as the last stage's queue holds wait for the caller
+        before the stages stall.  While waiting, `on_idle()` is called every `idle_interval` seconds.
+        A stage function that raises ends the run with that exception.
+        """
+        queues = [queue.Queue(stage.queue_size) for stage in self.stages]
+        # Bounded too, so a slow consumer holds back the last stage
+        output = queue.Queue(self.stages[-1].queue_size)
+        queues.append(output)
+        errors = []
+        threads = []
+
+        def feed():
+            try:
+                for item in items:
+                    if self._cancelled.is_set():
+                        break
+                    if not _put(queues[0], item):
+                        break
+            finally:
+                _put(queues[0], _DONE, force=True)
+
+        def _put(q, item, force=False):
+            # Once a stage has failed, only end-of-input markers are still
+            # passed on; downstream workers keep draining so they get through
+            while True:
+                if errors and not force:
+                    return False
+                try:
+                    q.put(item, timeout=idle_interval)
+                    return True
+                except queue.Full:
+                    pass
+
+        def work(index, stage, remaining):
+            inbox, outbox = queues[index], queues[index + 1]
+            while True:
+                item = inbox.get()
+                if item is _DONE:
+                    # Let sibling workers see the end too; the last one to
+                    # finish passes it downstream
+                    inbox.put(_DONE)
+                    with remaining[1]:
+                        remaining[0] -= 1
+                        last = remaining[0] == 0
+                    if last:
+                        _put(outbox, _DONE, force=True)
+                    return
+                if errors:
+                    continue
+                try:
+                    result = stage.func(item)
+                except BaseException as e:
+                    errors.append(e)
+                    self._cancelled.set()
+                    continue
+                _put(outbox, result)
+
+        threads.append(threading.Thread(target=feed, name='pipeline-feed', daemon=True))
+        for index, stage in enumerate(self.stages):
+            remaining = [stage.workers, threading.Lock()]
+            for n in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=work, args=(index, stage, remaining),
+                    name=f'pipeline-{stage.name}-{n}', daemon=True))
+        for thread in threads:
+            thread.start()
+
+        while True:
+            try:
+                item = output.get(timeout=idle_interval)
+            except queue.Empty:
+                if on_idle is not None:
+                    on_idle()
+                continue
+            if item is _DONE:
+                break
+            yield item
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
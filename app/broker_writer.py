@@ -0,0 +1,262 @@
+"""
+Secure data mapping (honest broker) file writers.
+
+Rows are written as slides finish, so memory does not grow with the size
+of the batch: label and macro images are shrunk to the size they are shown
+at before encoding.  The Excel writer produces a workbook in openpyxl's
+write-only mode with each image kept in a temporary file until the workbook
+is saved.  The CSV and Parquet writers produce a plain index instead, with
+the images stored once each in a content-addressed folder next to it, which
+is much faster to write and to query for large batches.
+"""
+from datetime import datetime
+import csv
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import time
+
+BROKER_HEADERS = ['Original Filename', 'New Filename',
+                  'Original Label Image', 'Original Macro Image']
+
+# Box the label and macro images are displayed in, in pixels
+DISPLAY_SIZE = (300, 100)
+
+
+def broker_path_for(deid_folder, extension='.xlsx'):
+    """Timestamped path of the mapping file, next to `deid_folder`."""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return f"{os.path.normpath(deid_folder)}_PHI_Secure_Data_Mapping_File_{timestamp}{extension}"
+
+
+def display_size(width, height, box=DISPLAY_SIZE):
+    """Size of a `width` x `height` image scaled to fit `box`."""
+    scale_factor = min(box[0] / width, box[1] / height)
+    return max(1, int(width * scale_factor)), max(1, int(height * scale_factor))
+
+
+def fit_to_display(image, box=DISPLAY_SIZE):
+    """Downsample a PIL image to its display size; never enlarges it."""
+    if image is None:
+        return None
+    size = display_size(image.width, image.height, box)
+    if size[0] >= image.width or size[1] >= image.height:
+        return image
+    from PIL import Image
+    return image.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+
+class BrokerWriter:
+    """
+    Base class of mapping file writers.  `add_row()` is called once per
+    de-identified slide with its PIL label and macro (or None); `close()`
+    finishes the file.
+    """
+    extension = None
+
+    @classmethod
+    def check_available(cls):
+        """Raise ImportError if a library the writer needs cannot be loaded."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def add_row(self, original_filename, new_filename, label=None, macro=None):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class XlsxBrokerWriter(BrokerWriter):
+    """Excel workbook with embedded label and macro images, one row at a time."""
+    extension = '.xlsx'
+
+    @classmethod
+    def check_available(cls):
+        import openpyxl
+
+    def __init__(self, path):
+        from openpyxl import Workbook
+
+        super().__init__(path)
+        self._wb = Workbook(write_only=True)
+        self._ws = self._wb.create_sheet("secure data mapping file")
+        # Adjust column widths
+        for col in ['A', 'B', 'C', 'D']:
+            self._ws.column_dimensions[col].width = 40
+        self._ws.append(BROKER_HEADERS)
+        self._row = 1
+        # Encoded images wait here, next to the PHI file, until save
+        self._image_dir = tempfile.mkdtemp(prefix='.broker_images_',
+                                           dir=os.path.dirname(os.path.abspath(path)))
+
+    def add_row(self, original_filename, new_filename, label=None, macro=None):
+        from openpyxl.drawing.image import Image
+
+        self._row += 1
+        row_idx = self._row
+        for col, image in (('C', label), ('D', macro)):
+            if image is None:
+                continue
+            image = fit_to_display(image)
+            image_path = os.path.join(self._image_dir, f'{col}{row_idx}.png')
+            image.save(image_path, format='PNG')
+            img = Image(image_path)
+            # Scale image to reasonable size
+            img.width, img.height = display_size(img.width, img.height)
+            self._ws.add_image(img, f'{col}{row_idx}')
+            self._ws.row_dimensions[row_idx].height = max(75, img.height)
+        self._ws.append([original_filename, new_filename])
+
+    def close(self):
+        try:
+            self._wb.save(self.path)
+        finally:
+            shutil.rmtree(self._image_dir, ignore_errors=True)
+
+
+class _IndexBrokerWriter(BrokerWriter):
+    """
+    Tabular index whose image columns hold paths, relative to the index,
+    of PNGs named by the hash of their contents in `<index>_images/`.
+    """
+    def __init__(self, path):
+        super().__init__(path)
+        self.image_dir = os.path.splitext(path)[0] + '_images'
+        os.makedirs(self.image_dir, exist_ok=True)
+        self._image_prefix = os.path.basename(self.image_dir)
+
+    def _store_image(self, image):
+        if image is None:
+            return ''
+        buffer = io.BytesIO()
+        fit_to_display(image).save(buffer, format='PNG')
+        data = buffer.getvalue()
+        name = hashlib.sha256(data).hexdigest() + '.png'
+        image_path = os.path.join(self.image_dir, name)
+        # Identical images (e.g. blank labels) are stored once
+        if not os.path.exists(image_path):
+            tmp_path = image_path + '.tmp'
+            with open(tmp_path, 'wb') as fh:
+                fh.write(data)
+            os.replace(tmp_path, image_path)
+        return f'{self._image_prefix}/{name}'
+
+    def add_row(self, original_filename, new_filename, label=None, macro=None):
+        self._write_row([original_filename, new_filename,
+                         self._store_image(label), self._store_image(macro)])
+
+    def _write_row(self, row):
+        raise NotImplementedError
+
+
+class CsvBrokerWriter(_IndexBrokerWriter):
+    """CSV index; each row is on disk as soon as it is added."""
+    extension = '.csv'
+
+    def __init__(self, path):
+        super().__init__(path)
+        # Line buffered, so a crash loses at most the row being written
+        self._fh = open(path, 'w', newline='', encoding='utf-8', buffering=1)
+        self._writer = csv.writer(self._fh)
+        self._writer.writerow(BROKER_HEADERS)
+
+    def _write_row(self, row):
+        self._writer.writerow(row)
+
+    def close(self):
+        self._fh.close()
+
+
+class ParquetBrokerWriter(_IndexBrokerWriter):
+    """
+    Parquet index written one row group at a time; needs pyarrow.  Row
+    groups are written every `ROW_GROUP_SIZE` rows or, for slowly arriving
+    slides, with the first row after `FLUSH_SECONDS`, but Parquet keeps its
+    footer at the end: the file cannot be read until `close()`.  Long-running
+    services should rotate it (`--broker-rotate`) or use the CSV index.
+    """
+    extension = '.parquet'
+    ROW_GROUP_SIZE = 256
+    FLUSH_SECONDS = 60
+
+    @classmethod
+    def check_available(cls):
+        import pyarrow
+        import pyarrow.parquet
+
+    def __init__(self, path):
+        import pyarrow
+        import pyarrow.parquet
+
+        super().__init__(path)
+        self._pa = pyarrow
+        self._schema = pyarrow.schema([(header, pyarrow.string())
+                                       for header in BROKER_HEADERS])
+        self._writer = pyarrow.parquet.ParquetWriter(path, self._schema)
+        self._rows = []
+        self._flushed = time.monotonic()
+
+    def _write_row(self, row):
+        self._rows.append(row)
+        if (len(self._rows) >= self.ROW_GROUP_SIZE
+                or time.monotonic() - self._flushed >= self.FLUSH_SECONDS):
+            self._flush()
+
+    def _flush(self):
+        import pandas as pd
+
+        if not self._rows:
+            return
+        df = pd.DataFrame(self._rows, columns=BROKER_HEADERS)
+        self._writer.write_table(self._pa.Table.from_pandas(
+            df, schema=self._schema, preserve_index=False))
+        self._rows = []
+        self._flushed = time.monotonic()
+
+    def close(self):
+        try:
+            self._flush()
+        finally:
+            self._writer.close()
+
+
+BROKER_FORMATS = {
+    'xlsx': XlsxBrokerWriter,
+    'csv': CsvBrokerWriter,
+    'parquet': ParquetBrokerWriter,
+}
+
+
+def _writer_class(broker_format):
+    try:
+        return BROKER_FORMATS[broker_format]
+    except KeyError:
+        raise ValueError(f'Unknown mapping file format: {broker_format}')
+
+
+def check_broker_format(broker_format):
+    """
+    Raise ValueError unless mapping files of `broker_format` can be written,
+    so a batch fails before de-identifying anything rather than after.
+    """
+    writer_class = _writer_class(broker_format)
+    try:
+        writer_class.check_available()
+    except ImportError as e:
+        raise ValueError(f'Cannot write {broker_format} mapping files: {e}')
+
+
+def open_broker_writer(deid_folder, broker_format='xlsx'):
+    """New mapping file writer of `broker_format` for slides in `deid_folder`."""
+    writer_class = _writer_class(broker_format)
+    return writer_class(broker_path_for(deid_folder, writer_class.extension))
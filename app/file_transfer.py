@@ -0,0 +1,198 @@
+"""
+Fast file-to-file transfer for the de-identification copy step.
+
+Copies are attempted with the cheapest mechanism the platform offers:
+a reflink clone (btrfs/XFS), then kernel-side os.copy_file_range or
+os.sendfile, and finally large buffered reads and writes.  Redacted ranges
+can be deallocated with FALLOC_FL_PUNCH_HOLE instead of written as zeros.
+"""
+import ctypes
+import errno
+import os
+import shutil
+import sys
+
+REFLINK = 'reflink'
+COPY_FILE_RANGE = 'copy_file_range'
+SENDFILE = 'sendfile'
+BUFFERED = 'buffered'
+
+# Order in which range copies are attempted
+RANGE_METHODS = [COPY_FILE_RANGE, SENDFILE, BUFFERED]
+
+# Multiple of the page size so buffered copies stay aligned
+COPY_BUFSIZE = 8 << 20
+
+# Zeros are written from one shared buffer of this size
+ZERO_BUFSIZE = 1 << 20
+
+# Linux _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# Linux fallocate() modes
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+# Errors meaning "this mechanism does not work here", as opposed to real
+# I/O errors which should propagate
+_UNSUPPORTED_ERRNOS = {
+    errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EBADF, errno.ENOTTY,
+    errno.EPERM, errno.EOPNOTSUPP, getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP),
+}
+
+
+def clone_file(src_path, dst_path):
+    """Reflink `src_path` to `dst_path`; return False if unsupported."""
+    if not sys.platform.startswith('linux'):
+        return False
+    import fcntl
+    try:
+        with open(src_path, 'rb') as src_fh, open(dst_path, 'wb') as dst_fh:
+            fcntl.ioctl(dst_fh.fileno(), FICLONE, src_fh.fileno())
+        return True
+    except OSError as e:
+        if e.errno not in _UNSUPPORTED_ERRNOS:
+            raise
+        return False
+
+
+_zeros = None
+_fallocate = None
+
+
+def _get_fallocate():
+    global _fallocate
+    if _fallocate is None:
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            _fallocate = libc.fallocate
+            _fallocate.argtypes = [ctypes.c_int, ctypes.c_int,
+                                   ctypes.c_int64, ctypes.c_int64]
+            _fallocate.restype = ctypes.c_int
+        except (OSError, AttributeError):
+            _fallocate = False
+    return _fallocate
+
+
+def punch_hole(fh, offset, length):
+    """Deallocate a byte range so it reads as zeros; False if unsupported."""
+    if not sys.platform.startswith('linux'):
+        return False
+    fallocate = _get_fallocate()
+    if not fallocate:
+        return False
+    fh.flush()
+    ret = fallocate(fh.fileno(), FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+                    offset, length)
+    if ret != 0:
+        err = ctypes.get_errno()
+        if err not in _UNSUPPORTED_ERRNOS:
+            raise OSError(err, os.strerror(err))
+        return False
+    return True
+
+
+def write_zeros(fh, length):
+    """Write `length` zero bytes at the current position of `fh`."""
+    global _zeros
+    if _zeros is None:
+        _zeros = memoryview(bytes(ZERO_BUFSIZE))
+    while length > 0:
+        n = min(length, ZERO_BUFSIZE)
+        fh.write(_zeros[:n])
+        length -= n
+
+
+def zero_range(fh, offset, length, sparse=False):
+    """
+    Zero `length` bytes at `offset`.  With `sparse`, punch a hole where the
+    filesystem supports it; the file content is identical either way.
+    """
+    if sparse and punch_hole(fh, offset, length):
+        fh.seek(offset + length)
+        return
+    fh.seek(offset)
+    write_zeros(fh, length)
+
+
+def _copy_file_range(src_fd, dst_fd, offset, length):
+    while length > 0:
+        n = os.copy_file_range(src_fd, dst_fd, min(length, 1 << 30),
+                               offset, offset)
+        if n == 0:
+            raise IOError('Short read')
+        offset += n
+        length -= n
+
+
+def _sendfile(src_fd, dst_fd, offset, length):
+    # sendfile writes at the destination's file position
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    while length > 0:
+        n = os.sendfile(dst_fd, src_fd, offset, min(length, 1 << 30))
+        if n == 0:
+            raise IOError('Short read')
+        offset += n
+        length -= n
+
+
+def _buffered(src_fh, dst_fh, offset, length):
+    buf = bytearray(min(length, COPY_BUFSIZE))
+    view = memoryview(buf)
+    src_fh.seek(offset)
+    dst_fh.seek(offset)
+    while length > 0:
+        n = src_fh.readinto(view[:min(length, len(buf))])
+        if not n:
+            raise IOError('Short read')
+        dst_fh.write(view[:n])
+        length -= n
+
+
+def copy_range(src_fh, dst_fh, offset, length, method=COPY_FILE_RANGE):
+    """
+    Copy `length` bytes at `offset` from `src_fh` to the same offset in
+    `dst_fh`, leaving `dst_fh` positioned after them.  Mechanisms are tried
+    starting at `method`; the one that worked is returned so callers can
+    skip known-unsupported ones on the next range.
+    """
+    if length <= 0:
+        dst_fh.seek(offset)
+        return method
+    dst_fh.flush()
+    for candidate in RANGE_METHODS[RANGE_METHODS.index(method):]:
+        try:
+            if candidate == COPY_FILE_RANGE:
+                if not hasattr(os, 'copy_file_range'):
+                    continue
+                _copy_file_range(src_fh.fileno(), dst_fh.fileno(), offset,
+                                 length)
+            elif candidate == SENDFILE:
+                if not sys.platform.startswith('linux'):
+                    continue
+                _sendfile(src_fh.fileno(), dst_fh.fileno(), offset, length)
+            else:
+                _buffered(src_fh, dst_fh, offset, length)
+                return candidate
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+            # Nothing was written past what the kernel reported, so the
+            # next mechanism can safely redo the whole range
+            continue
+        dst_fh.seek(offset + length)
+        return candidate
+    return BUFFERED
+
+
+def copy_file(src_path, dst_path):
+    """Copy a whole file with metadata; return the mechanism used."""
+    if clone_file(src_path, dst_path):
+        method = REFLINK
+    else:
+        size = os.path.getsize(src_path)
+        with open(src_path, 'rb') as src_fh, open(dst_path, 'wb') as dst_fh:
+            method = copy_range(src_fh, dst_fh, 0, size)
+            dst_fh.truncate(size)
+    shutil.copystat(src_path, dst_path)
+    return method
@@ -1,8 +1,8 @@
 from PySide6.QtWidgets import (QMainWindow, QWidget, QVBoxLayout, 
                               QPushButton, QFileDialog, QMessageBox,
                               QDialog, QCheckBox, QLabel, QGridLayout,
-                              QProgressDialog)
-from PySide6.QtCore import Qt, QTimer
+                              QProgressDialog, QComboBox)
+from PySide6.QtCore import Qt
 from slide_list_widget import SlideListWidget
 import os
 
@@ -11,6 +11,7 @@ class MainWindow(QMainWindow):
         super().__init__()
         self.setWindowTitle("WSI De-identification Tool")
         self.setMinimumSize(800, 600)
+        self._load_progress = None
         
         # Create central widget and layout
         central_widget = QWidget()
@@ -64,6 +65,8 @@ class MainWindow(QMainWindow):
         # Connect signals
         self.open_folder_btn.clicked.connect(self.open_folder)
         self.anonymize_all_btn.clicked.connect(self.anonymize_all_slides)
+        self.slide_list.loadingProgress.connect(self._on_loading_progress)
+        self.slide_list.loadingFinished.connect(self._on_loading_finished)
         
     def open_folder(self):
         folder_path = QFileDialog.getExistingDirectory(self, "Select Folder")
@@ -71,12 +74,15 @@ class MainWindow(QMainWindow):
             try:
                 # Store the folder path for later use
                 self.current_folder = folder_path
+                self.slide_list.cancel_loading()
+                self.anonymize_all_btn.setEnabled(False)
                 
                 # Create and show progress dialog
-                progress = QProgressDialog("Loading slides...", None, 0, 0, self)
+                progress = QProgressDialog("Loading slides...", "Cancel", 0, 0, self)
                 progress.setWindowTitle("Please Wait")
-                progress.setWindowModality(Qt.WindowModal)
                 progress.setMinimumDuration(0)
+                progress.setAutoClose(False)
+                progress.setAutoReset(False)
                 progress.setValue(0)
                 progress.setStyleSheet("""
                     QProgressDialog {
@@ -87,21 +93,45 @@ class MainWindow(QMainWindow):
                         font-size: 14px;
                     }
                 """)
+                self._load_progress = progress
                 
-                # Use QTimer to allow the progress dialog to show
-                QTimer.singleShot(100, lambda: self._load_slides(folder_path, progress))
+                # Slides load in the background; rows appear as they finish
+                progress.canceled.connect(self._on_load_canceled)
+                self.slide_list.load_slides(folder_path)
                 
             except Exception as e:
+                self._close_load_progress()
                 QMessageBox.critical(self, "Error", f"Error loading slides: {str(e)}")
 
-    def _load_slides(self, folder_path, progress):
-        try:
-            self.slide_list.load_slides(folder_path)
-            self.anonymize_all_btn.setEnabled(True)
-            progress.close()
-        except Exception as e:
-            progress.close()
-            QMessageBox.critical(self, "Error", f"Error loading slides: {str(e)}")
+    def closeEvent(self, event):
+        self.slide_list.close_caches()
+        super().closeEvent(event)
+
+    def _on_loading_progress(self, done, total):
+        if self._load_progress is not None:
+            self._load_progress.setMaximum(total)
+            self._load_progress.setValue(done)
+            if total:
+                self._load_progress.setLabelText(f"Loading slides... ({done}/{total})")
+            else:
+                # Still scanning subfolders; rows are usable already
+                self._load_progress.setLabelText(f"Finding slides... ({done} found)")
+
+    def _on_loading_finished(self):
+        self._close_load_progress()
+        self.anonymize_all_btn.setEnabled(True)
+
+    def _on_load_canceled(self):
+        # Only the Cancel button; closing the dialog also emits canceled
+        if self._load_progress is not None and self._load_progress.wasCanceled():
+            self.slide_list.cancel_loading()
+
+    def _close_load_progress(self):
+        if self._load_progress is not None:
+            progress, self._load_progress = self._load_progress, None
+            progress.canceled.disconnect(self._on_load_canceled)
+            progress.hide()
+            progress.deleteLater()
     
     def anonymize_all_slides(self):
         # Show configuration dialog
@@ -158,10 +188,21 @@ class AnonymizationConfigDialog(QDialog):
         self.filename_md5_cb.setChecked(True)
         self.honest_broker_cb = QCheckBox("Create secure data mapping file (PHI, Recommended)")
         self.honest_broker_cb.setChecked(True)
+        self.broker_format_combo = QComboBox()
+        self.broker_format_combo.addItem("Excel workbook (.xlsx)", 'xlsx')
+        self.broker_format_combo.addItem("CSV index + image folder (large batches)", 'csv')
+        self.honest_broker_cb.toggled.connect(self.broker_format_combo.setEnabled)
+        self.macro_cb = QCheckBox("Also remove the macro image (it shows the label)")
+        self.macro_cb.setChecked(False)
+        self.profile_cb = QCheckBox("Save profiling data next to the output (for bug reports)")
+        self.profile_cb.setChecked(False)
         
         # Add checkboxes to layout (moved down to accommodate disclaimer)
         layout.addWidget(self.filename_md5_cb, 2, 0)
         layout.addWidget(self.honest_broker_cb, 3, 0)
+        layout.addWidget(self.broker_format_combo, 3, 1)
+        layout.addWidget(self.macro_cb, 4, 0)
+        layout.addWidget(self.profile_cb, 5, 0)
         
         # Add buttons
         self.ok_button = QPushButton("Proceed")
@@ -191,8 +232,8 @@ class AnonymizationConfigDialog(QDialog):
             }
         """)
         
-        layout.addWidget(self.ok_button, 4, 0)
-        layout.addWidget(self.cancel_button, 4, 1)
+        layout.addWidget(self.ok_button, 6, 0)
+        layout.addWidget(self.cancel_button, 6, 1)
         
         self.ok_button.clicked.connect(self.accept)
         self.cancel_button.clicked.connect(self.reject)
@@ -200,5 +241,8 @@ class AnonymizationConfigDialog(QDialog):
     def get_options(self):
         return {
             'encrypt_filename': self.filename_md5_cb.isChecked(),
-            'create_honest_broker': self.honest_broker_cb.isChecked()
+            'create_honest_broker': self.honest_broker_cb.isChecked(),
+            'broker_format': self.broker_format_combo.currentData(),
+            'remove_macro': self.macro_cb.isChecked(),
+            'profile': self.profile_cb.isChecked()
         }
\ No newline at end of file
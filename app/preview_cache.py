@@ -0,0 +1,177 @@
+"""
+Persistent cache of slide thumbnails and properties.
+
+Entries live in a SQLite database under the user cache directory and are
+keyed by absolute path, size and modification time (optionally plus a hash
+of the first and last megabyte), so a slide that changes on disk is simply
+a cache miss.  The least recently used entries are evicted once the stored
+images exceed a size budget.
+
+Label and macro images identify the patient, so they are never written
+here; `associated_images.AssociatedImages` keeps them in memory only.  The
+cache folder is private to the user, and databases from versions that did
+store labels are emptied when opened.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+APP_NAME = 'wsi_deidentifier'
+DEFAULT_MAX_BYTES = 512 << 20
+HASH_CHUNK = 1 << 20
+# Version 1 stored label and macro previews
+SCHEMA_VERSION = 2
+# Hits whose last-used time is written together
+TOUCH_BATCH = 256
+
+
+def default_cache_dir():
+    """Per-user cache directory for the application."""
+    if sys.platform.startswith('win'):
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser(r'~\AppData\Local')
+        return os.path.join(base, APP_NAME, 'Cache')
+    if sys.platform == 'darwin':
+        return os.path.join(os.path.expanduser('~/Library/Caches'), APP_NAME)
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, APP_NAME)
+
+
+def file_key(filepath, content_hash=False):
+    """Cache key of a file; changes whenever the file does."""
+    st = os.stat(filepath)
+    key = f"{os.path.abspath(filepath)}|{st.st_size}|{st.st_mtime_ns}"
+    if content_hash:
+        digest = hashlib.sha1()
+        with open(filepath, 'rb') as fh:
+            digest.update(fh.read(HASH_CHUNK))
+            if st.st_size > HASH_CHUNK:
+                fh.seek(max(HASH_CHUNK, st.st_size - HASH_CHUNK))
+                digest.update(fh.read(HASH_CHUNK))
+        key += '|' + digest.hexdigest()
+    return key
+
+
+class CachedPreview:
+    """Encoded thumbnail and properties of one slide."""
+    def __init__(self, properties, thumbnail):
+        self.properties = properties
+        self.thumbnail = thumbnail  # PNG bytes
+
+
+class PreviewCache:
+    """SQLite-backed preview cache; safe to share between threads."""
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES,
+                 content_hash=False):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.content_hash = content_hash
+        # Slide paths and thumbnails are not for other users to read
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        os.chmod(self.cache_dir, 0o700)
+        self._lock = threading.Lock()
+        self._touched = {}  # key -> last used, not yet written
+        self._db = sqlite3.connect(os.path.join(self.cache_dir, 'previews.sqlite'),
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        if self._db.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+            self._purge_old_schema()
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS previews (
+                key TEXT PRIMARY KEY,
+                properties TEXT NOT NULL,
+                thumbnail BLOB,
+                nbytes INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS previews_last_used '
+                         'ON previews (last_used)')
+        self._db.commit()
+        self._total_bytes = self._db.execute(
+            'SELECT COALESCE(SUM(nbytes), 0) FROM previews').fetchone()[0]
+
+    def _purge_old_schema(self):
+        # Drop label images stored by older versions and rewrite the file,
+        # so the deleted pages do not keep them either
+        self._db.execute('DROP TABLE IF EXISTS previews')
+        self._db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+        self._db.commit()
+        self._db.execute('VACUUM')
+        self._db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def key(self, filepath):
+        return file_key(filepath, self.content_hash)
+
+    def get(self, filepath):
+        """Cached previews of `filepath`, or None."""
+        try:
+            key = self.key(filepath)
+        except OSError:
+            return None
+        with self._lock:
+            row = self._db.execute(
+                'SELECT properties, thumbnail FROM previews '
+                'WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            # Hits are only reads; their last-used times are written in
+            # batches, or with the next put
+            self._touched[key] = time.time()
+            if len(self._touched) >= TOUCH_BATCH:
+                self._write_touched()
+                self._db.commit()
+        properties, thumbnail = row
+        return CachedPreview(json.loads(properties), thumbnail)
+
+    def _write_touched(self):
+        if self._touched:
+            self._db.executemany('UPDATE previews SET last_used = ? WHERE key = ?',
+                                 [(used, key) for key, used in self._touched.items()])
+            self._touched.clear()
+
+    def put(self, filepath, preview):
+        try:
+            key = self.key(filepath)
+        except OSError:
+            return
+        nbytes = len(preview.thumbnail or b'')
+        with self._lock:
+            self._touched.pop(key, None)
+            self._write_touched()
+            old = self._db.execute('SELECT nbytes FROM previews WHERE key = ?',
+                                   (key,)).fetchone()
+            self._db.execute(
+                'INSERT OR REPLACE INTO previews VALUES (?, ?, ?, ?, ?)',
+                (key, json.dumps(preview.properties, default=str),
+                 preview.thumbnail, nbytes, time.time()))
+            self._total_bytes += nbytes - (old[0] if old else 0)
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        # Drop least recently used entries down to 90% of the budget
+        if self._total_bytes <= self.max_bytes:
+            return
+        target = self.max_bytes * 9 // 10
+        for key, nbytes in self._db.execute(
+                'SELECT key, nbytes FROM previews ORDER BY last_used').fetchall():
+            if self._total_bytes <= target:
+                break
+            self._db.execute('DELETE FROM previews WHERE key = ?', (key,))
+            self._total_bytes -= nbytes
+
+    def clear(self):
+        with self._lock:
+            self._touched.clear()
+            self._db.execute('DELETE FROM previews')
+            self._db.commit()
+            self._total_bytes = 0
+
+    def close(self):
+        with self._lock:
+            self._write_touched()
+            self._db.commit()
+            self._db.close()
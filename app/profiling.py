@@ -0,0 +1,108 @@
+"""
+Opt-in profiling of batch runs, for attaching to bug reports.
+
+`BatchProfiler.wrap()` profiles calls of a function with cProfile in
+whichever thread they run, optionally only every Nth call, and merges them
+into one pstats file for the batch.  `trace_memory()` records the
+tracemalloc peak of a block and dumps a snapshot of it.  Everything is
+written to one `<output>_profile_<timestamp>` directory.
+"""
+from contextlib import contextmanager
+from datetime import datetime
+import cProfile
+import os
+import pstats
+import threading
+import tracemalloc
+
+TRACEMALLOC_FRAMES = 25
+REPORT_LINES = 60
+
+
+def profile_dir_for(base_path):
+    """Timestamped profile directory next to `base_path`."""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return f"{os.path.normpath(base_path)}_profile_{timestamp}"
+
+
+class BatchProfiler:
+    def __init__(self, out_dir, sample_every=1):
+        self.out_dir = out_dir
+        self.sample_every = max(1, sample_every)
+        self._lock = threading.Lock()
+        self._stats = None
+        self._calls = 0
+        self._profiled = 0
+        self._skipped = 0
+        self._memory = []
+
+    def wrap(self, func):
+        """`func`, profiled on every `sample_every`th call."""
+        def profiled(*args, **kwargs):
+            with self._lock:
+                sampled = self._calls % self.sample_every == 0
+                self._calls += 1
+            if not sampled:
+                return func(*args, **kwargs)
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Python 3.12+ allows one active profiler per interpreter;
+                # calls overlapping a profiled one in another thread run as is
+                with self._lock:
+                    self._skipped += 1
+                return func(*args, **kwargs)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+                with self._lock:
+                    self._profiled += 1
+                    if self._stats is None:
+                        self._stats = pstats.Stats(profile)
+                    else:
+                        self._stats.add(profile)
+        return profiled
+
+    @contextmanager
+    def trace_memory(self, name):
+        """Record the peak traced memory of the block and snapshot it."""
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        try:
+            yield
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            os.makedirs(self.out_dir, exist_ok=True)
+            tracemalloc.take_snapshot().dump(
+                os.path.join(self.out_dir, f'{name}.tracemalloc'))
+            with self._lock:
+                self._memory.append((name, before, peak, current))
+            if started:
+                tracemalloc.stop()
+
+    def save(self):
+        """Write the collected profiles; returns the directory."""
+        os.makedirs(self.out_dir, exist_ok=True)
+        with self._lock:
+            stats, memory = self._stats, list(self._memory)
+            summary = (f'{self._profiled} of {self._calls} calls profiled '
+                       f'(every {self.sample_every}), {self._skipped} skipped '
+                       f'while another call was being profiled\n')
+        with open(os.path.join(self.out_dir, 'batch.txt'), 'w') as fh:
+            fh.write(summary)
+            if stats is not None:
+                stats.dump_stats(os.path.join(self.out_dir, 'batch.pstats'))
+                stats.stream = fh
+                stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(REPORT_LINES)
+        if memory:
+            with open(os.path.join(self.out_dir, 'memory.txt'), 'w') as fh:
+                for name, before, peak, after in memory:
+                    fh.write(f'{name}: peak {peak / (1 << 20):.1f} MiB '
+                             f'(before {before / (1 << 20):.1f} MiB, '
+                             f'after {after / (1 << 20):.1f} MiB)\n')
+        return self.out_dir
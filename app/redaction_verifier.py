@@ -0,0 +1,239 @@
+"""
+Post-redaction verification of de-identified slides.
+
+Only metadata and a handful of tiles are read: the IFD chain or MRXS index
+of the output is parsed again to check that the label can no longer be
+reached, the byte ranges the redaction blanked are checked to read back as
+zeros (or holes), and a few level 0 tiles are checked to still be present,
+and decoded where Pillow can, so a slide damaged by the redaction is caught.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from optparse import OptionParser
+import os
+import sys
+
+import anonymize_functions
+from anonymize_functions import (COMPRESSION, DEFAULT_POLICY, JPEG_SOI,
+                                 JPEG_TABLES, STRIP_BYTE_COUNTS, STRIP_OFFSETS,
+                                 TILE_BYTE_COUNTS, TILE_OFFSETS,
+                                 LabelNotFound, MrxsFile)
+
+PROG_DESCRIPTION = '''
+Check that de-identified slides no longer contain their label and still
+read correctly.
+'''.strip()
+
+DEFAULT_SAMPLES = 4
+CHUNK_SIZE = 1 << 20
+# Larger tiles (such as the single-strip levels of NDPI files) are only
+# checked for a valid header, not decoded
+MAX_DECODE_BYTES = 4 << 20
+HEADER_BYTES = 64 << 10
+
+TIFF_JPEG = 7
+TIFF_JP2K = (33003, 33005)
+J2K_SOC = b'\xff\x4f\xff\x51'
+
+
+def sample_indices(count, samples):
+    """Up to `samples` indices spread evenly over range(count)."""
+    if count <= samples:
+        return list(range(count))
+    if samples == 1:
+        return [0]
+    return sorted({i * (count - 1) // (samples - 1) for i in range(samples)})
+
+
+def _decode_problem(data, tables=None):
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    if tables:
+        # Abbreviated JPEG stream: splice in the shared tables
+        data = tables[:-2] + data[2:]
+    try:
+        with Image.open(BytesIO(data)) as image:
+            image.load()
+    except Exception as e:
+        return str(e) or type(e).__name__
+    return None
+
+
+def check_tile(fh, offset, length, file_size, compression=None, tables=None):
+    """Problem with the tile at `offset`, or None if it looks intact."""
+    if offset < 0 or offset + length > file_size:
+        return 'lies beyond the end of the file'
+    fh.seek(offset)
+    data = fh.read(length if length <= MAX_DECODE_BYTES else HEADER_BYTES)
+    if not data.strip(b'\0'):
+        return 'is blank'
+    if compression == TIFF_JPEG or data.startswith(JPEG_SOI):
+        if not data.startswith(JPEG_SOI):
+            return 'is not a JPEG stream'
+        if length <= MAX_DECODE_BYTES:
+            problem = _decode_problem(data, tables)
+            if problem:
+                return f'does not decode: {problem}'
+    elif compression in TIFF_JP2K and not data.startswith(J2K_SOC):
+        return 'is not a JPEG 2000 codestream'
+    return None
+
+
+def check_tiff_tiles(tf, samples=DEFAULT_SAMPLES):
+    """Spot-check tiles (or strips) of the first directory of a TiffFile."""
+    directory = tf.directories[0]
+    entries = directory.entries
+    if TILE_OFFSETS in entries:
+        offsets, counts = entries[TILE_OFFSETS], entries[TILE_BYTE_COUNTS]
+    elif STRIP_OFFSETS in entries:
+        offsets, counts = entries[STRIP_OFFSETS], entries[STRIP_BYTE_COUNTS]
+    else:
+        return ['Level 0 has no image data']
+    compression = entries[COMPRESSION].value()[0] if COMPRESSION in entries else None
+    tables = entries[JPEG_TABLES].value() if JPEG_TABLES in entries else None
+
+    problems = []
+    indices = sample_indices(offsets.count, samples)
+    for i, offset, length in zip(indices, offsets.items(indices), counts.items(indices)):
+        if length == 0:
+            # Sparse pyramids leave empty tiles
+            continue
+        offset = tf.near_pointer(directory._out_pointer_offset, offset)
+        problem = check_tile(tf._fh, offset, length, tf._file_size,
+                             compression, tables)
+        if problem:
+            problems.append(f'Level 0 tile {i} {problem}')
+    return problems
+
+
+def check_mrxs_index(filename, samples=DEFAULT_SAMPLES):
+    """Check that every nonhier record and a few tiles resolve."""
+    problems = []
+    mrxs = MrxsFile(filename)
+    for level in mrxs._level_list:
+        try:
+            path, offset, length = mrxs._get_data_location(level.record)
+            if offset + length > os.path.getsize(path):
+                raise IOError('data lies beyond the end of its file')
+        except Exception as e:
+            problems.append(f'Nonhier record {level.record} ({level.name}) '
+                            f'is unreadable: {str(e)}')
+    try:
+        locations = mrxs._get_hier_data_locations(0, samples)
+    except Exception as e:
+        return problems + [f'Hierarchical index is unreadable: {str(e)}']
+    for i, (path, offset, length) in enumerate(locations):
+        with open(path, 'rb') as fh:
+            problem = check_tile(fh, offset, length, os.path.getsize(path))
+        if problem:
+            problems.append(f'Level 0 tile {i} {problem}')
+    return problems
+
+
+def _range_is_blank(fh, offset, length):
+    fh.seek(offset)
+    while length > 0:
+        chunk = fh.read(min(length, CHUNK_SIZE))
+        if not chunk:
+            break
+        # Holes read back as zeros too
+        if chunk.count(0) != len(chunk):
+            return False
+        length -= len(chunk)
+    return True
+
+
+def check_redacted_ranges(plan, dst):
+    """Check that what `plan` removed from the source is gone from `dst`."""
+    problems = []
+    for path, out in plan.outputs(dst):
+        edits = plan.edits.get(path)
+        if edits is None or edits.contents is not None:
+            continue
+        name = os.path.basename(out)
+        size = os.path.getsize(out)
+        if edits.truncate is not None and size > edits.truncate:
+            problems.append(f'{name} was not truncated at {edits.truncate}')
+        with open(out, 'rb') as fh:
+            for offset, length in edits.zeros:
+                length = min(offset + length, size) - offset
+                if length > 0 and not _range_is_blank(fh, offset, length):
+                    problems.append(f'Redacted range at {offset} in {name} is not blank')
+    return problems
+
+
+def verify_output(dst, plan=None, samples=DEFAULT_SAMPLES, policy=DEFAULT_POLICY):
+    """
+    Problems found in the de-identified slide `dst`; an empty list means it
+    passed.  With the `plan` the source was redacted with, the ranges it
+    blanked are checked as well.  Nothing the redaction `policy` names may
+    be left, apart from directories given by number, which are covered by
+    the blanked ranges.
+    """
+    problems = []
+    tf = anonymize_functions.open_slide_file(dst)
+    try:
+        fmt = anonymize_functions.detect_format(dst, tf)
+        try:
+            fmt.plan(dst, tf, policy.by_name())
+            problems.append('Label is still reachable' if policy.label_only else
+                            f'An image to delete ({policy.describe()}) is still reachable')
+        except LabelNotFound:
+            pass
+        if tf is not None:
+            problems.extend(check_tiff_tiles(tf, samples))
+        else:
+            problems.extend(check_mrxs_index(dst, samples))
+    finally:
+        if tf is not None:
+            tf.close()
+    if plan is not None:
+        problems.extend(check_redacted_ranges(plan, dst))
+    return problems
+
+
+def _verify(filename, samples, policy=DEFAULT_POLICY):
+    try:
+        return verify_output(filename, samples=samples, policy=policy)
+    except Exception as e:
+        if anonymize_functions.DEBUG:
+            raise
+        return [str(e)]
+
+
+def _main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = OptionParser(usage='%prog [options] file [file...]',
+                          description=PROG_DESCRIPTION,
+                          version=anonymize_functions.PROG_VERSION)
+    parser.add_option('-j', '--jobs', type='int', metavar='N', default=8,
+                      help='number of files checked in parallel [%default]')
+    parser.add_option('-n', '--samples', type='int', metavar='N',
+                      default=DEFAULT_SAMPLES,
+                      help='level 0 tiles checked per file [%default]')
+    parser.add_option('-d', '--debug', action='store_true',
+                      help='show debugging information')
+    anonymize_functions.add_policy_options(parser)
+    opts, args = parser.parse_args(args)
+    if not args:
+        parser.error('Specify at least one file')
+
+    anonymize_functions.DEBUG = opts.debug
+    policy = anonymize_functions.policy_from_options(parser, opts)
+
+    exit_code = 0
+    with ThreadPoolExecutor(max_workers=max(1, opts.jobs)) as executor:
+        for filename, problems in zip(args, executor.map(
+                lambda filename: _verify(filename, opts.samples, policy), args)):
+            for problem in problems:
+                print(f'{filename}: {problem}', file=sys.stderr)
+                exit_code = 1
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
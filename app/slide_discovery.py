@@ -0,0 +1,115 @@
+"""
+Recursive discovery of slide files.
+
+Directories are read with os.scandir, so whether an entry is a file or a
+directory comes from the listing itself instead of a stat per entry, and
+slides are yielded as each directory is listed rather than after the whole
+tree has been walked.  An MRXS slide is found once, as its `.mrxs` file:
+the data directory of the same name next to it belongs to the slide and is
+not descended into.  On network filesystems, where every listing is a round
+trip, several directories can be listed in parallel.
+"""
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from fnmatch import fnmatch
+import os
+
+SLIDE_EXTENSIONS = ('.svs', '.ndpi', '.mrxs', '.tif', '.tiff')
+# Output folders of earlier batches only hold de-identified copies
+DEID_SUFFIX = '_DEID'
+
+
+def mrxs_data_dir(path):
+    """Data directory that belongs to the MRXS slide `path`."""
+    return os.path.splitext(path)[0]
+
+
+def _matches(relpath, patterns):
+    # Patterns match the path relative to the folder scanned, using '/',
+    # or the name alone
+    name = relpath.rpartition('/')[2]
+    return any(fnmatch(relpath, pattern) or fnmatch(name, pattern)
+               for pattern in patterns)
+
+
+def scan_directory(directory, relpath='', include=(), exclude=(),
+                   follow_symlinks=False):
+    """
+    One listing of `directory`, whose path relative to the folder being
+    scanned is `relpath`: the slide files in it and the (path, relpath)
+    of the subdirectories to descend into, both sorted by name.
+    """
+    with os.scandir(directory) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    mrxs_stems = {os.path.splitext(entry.name)[0] for entry in entries
+                  if entry.name.lower().endswith('.mrxs')}
+    files = []
+    subdirs = []
+    for entry in entries:
+        entry_relpath = relpath + entry.name
+        try:
+            if entry.is_dir(follow_symlinks=follow_symlinks):
+                if (entry.name in mrxs_stems or entry.name.endswith(DEID_SUFFIX)
+                        or _matches(entry_relpath, exclude)):
+                    continue
+                subdirs.append((entry.path, entry_relpath + '/'))
+            elif entry.name.lower().endswith(SLIDE_EXTENSIONS) and entry.is_file():
+                if include and not _matches(entry_relpath, include):
+                    continue
+                if _matches(entry_relpath, exclude):
+                    continue
+                files.append(entry.path)
+        except OSError:
+            # Vanished or unreadable while listing
+            continue
+    return files, subdirs
+
+
+def iter_slides(folder_path, recursive=True, include=(), exclude=(),
+                workers=1, onerror=None, follow_symlinks=False):
+    """
+    Yield slide files under `folder_path` as they are found.  `include`
+    and `exclude` are glob patterns matched against each path relative to
+    `folder_path` (with '/' separators) and against its name; excluded
+    directories are not descended into, nor are `_DEID` output folders.
+    With `workers` > 1, that many directories are listed at a time and
+    slides come in the order their directories were listed.  Like os.walk,
+    directories that cannot be listed are passed to `onerror(exc)` if given
+    and skipped.
+    """
+    scan_args = (include, exclude, follow_symlinks)
+    if workers <= 1:
+        stack = [(folder_path, '')]
+        while stack:
+            directory, relpath = stack.pop()
+            try:
+                files, subdirs = scan_directory(directory, relpath, *scan_args)
+            except OSError as e:
+                if onerror is not None:
+                    onerror(e)
+                continue
+            yield from files
+            if recursive:
+                stack.extend(reversed(subdirs))
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(scan_directory, folder_path, '', *scan_args)}
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        files, subdirs = future.result()
+                    except OSError as e:
+                        if onerror is not None:
+                            onerror(e)
+                        continue
+                    if recursive:
+                        for subdir in subdirs:
+                            pending.add(executor.submit(scan_directory, *subdir,
+                                                        *scan_args))
+                    yield from files
+        finally:
+            # Stopped early: don't list the rest of the tree
+            for future in pending:
+                future.cancel()
@@ -1,44 +1,100 @@
-from PySide6.QtWidgets import (QWidget, QVBoxLayout, QTableWidget, 
-                              QTableWidgetItem, QHeaderView, QPushButton, QDialog, QLabel, QProgressDialog)
-from PySide6.QtCore import Qt
+from PySide6.QtWidgets import (QVBoxLayout, QTableView, QHeaderView, QDialog, QLabel,
+                              QProgressDialog, QAbstractItemView, QApplication)
+from PySide6.QtCore import Qt, Signal
 from PySide6.QtGui import QPixmap
-import tiffslide
 import os
 from slide_metadata_dialog import SlideMetadataDialog
-from anonymize_slide import anonymize_slide
-import subprocess
-import hashlib
-import pandas as pd
-from datetime import datetime
+from slide_loader import FolderScanner, SlideLoader
+from preview_cache import PreviewCache
+from slide_pool import SlidePool
+from associated_images import AssociatedImages
+from slide_table_model import SlideTableModel, MetadataButtonDelegate
+from batch_deidentify import SlideJob, deid_folder_for, deid_filename, make_pipeline
+from anonymize_functions import RedactionPolicy
+from broker_writer import open_broker_writer
+from batch_journal import BROKER_RECORDED, BatchJournal, journal_path_for
+from batch_metrics import Metrics, metrics_paths_for, write_prometheus
+from profiling import BatchProfiler, profile_dir_for
+from contextlib import ExitStack
 
-class SlideListWidget(QTableWidget):
+class SlideListWidget(QTableView):
     # Add column names as class attributes
-    COLUMN_FILENAME = "Filename"
-    COLUMN_THUMBNAIL = "Thumbnail"
-    COLUMN_LABEL = "Label"
-    COLUMN_MACRO = "Macro"
-    COLUMN_METADATA = "Metadata"  # New column
-    COLUMNS = [COLUMN_FILENAME, COLUMN_THUMBNAIL, COLUMN_LABEL, COLUMN_MACRO, COLUMN_METADATA]
+    COLUMN_FILENAME = SlideTableModel.COLUMN_FILENAME
+    COLUMN_THUMBNAIL = SlideTableModel.COLUMN_THUMBNAIL
+    COLUMN_LABEL = SlideTableModel.COLUMN_LABEL
+    COLUMN_MACRO = SlideTableModel.COLUMN_MACRO
+    COLUMN_METADATA = SlideTableModel.COLUMN_METADATA
+    COLUMNS = SlideTableModel.COLUMNS
+
+    BUTTON_STYLE = """
+        QPushButton {
+            background-color: #0066CC;
+            color: white;
+            border: none;
+            padding: 0px 0px;
+            min-width: 100px;  /* Added min-width */
+            height: 30px;      /* Increased height */
+            margin: 0px;       /* Added margin */
+        }
+        QPushButton:hover {
+            background-color: #0052A3;
+        }
+    """
+
+    # Emitted while a folder is being opened
+    loadingProgress = Signal(int, int)  # done, total
+    loadingFinished = Signal()
 
     def __init__(self):
         super().__init__()
+        # Thumbnails of slides seen before are reused across sessions
+        try:
+            self.preview_cache = PreviewCache()
+        except Exception as e:
+            print(f"Preview cache unavailable: {str(e)}")
+            self.preview_cache = None
+        # Timings of folder listing and preview decoding, exported with each batch
+        self.metrics = Metrics()
+        # A few open slides shared by previews, dialogs and the broker
+        # capture, so open files stay bounded however many rows there are
+        self.slide_pool = SlidePool()
+        # Labels and macros are decoded once for the previews, the macro
+        # viewer and the secure data mapping file
+        self.associated_images = AssociatedImages(self.slide_pool)
+        self.loader = SlideLoader(self, cache=self.preview_cache, metrics=self.metrics,
+                                  pool=self.slide_pool, images=self.associated_images)
+        self.loader.set_wanted(self._is_wanted)
+        self.loader.loadsFinished.connect(self._on_loads_finished)
+        self.slide_model = SlideTableModel(self.loader, self)
+        self.setModel(self.slide_model)
+        # Rows are added as the folder and its subfolders are walked
+        self.scanner = FolderScanner(self, metrics=self.metrics)
+        self.scanner.slidesFound.connect(self._on_slides_found)
+        self.scanner.scanFinished.connect(self._on_scan_finished)
+        self._scan_root = None
+        # Paths of rows on screen; replaced wholesale so worker threads can read it
+        self._visible_paths = frozenset()
+        # Follows the profiling option of the last batch; folder loads after
+        # it are traced until their scan and visible previews are done
+        self.profiling = False
+        self._load_profile = None  # (profiler, ExitStack) of the load being traced
         self.setup_ui()
-        self.slides = []
-        
+
     def setup_ui(self):
         # Set up the table
-        self.setColumnCount(len(self.COLUMNS))
-        self.setHorizontalHeaderLabels(self.COLUMNS)
-        self.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)  # Disable editing
-        
+        self.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)  # Disable editing
+        self.setMouseTracking(True)
+        self.verticalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Fixed)
+        self.verticalHeader().setDefaultSectionSize(120)  # Adjusted for 100px image + padding
+
         # Style the table
         self.setStyleSheet("""
-            QTableWidget {
+            QTableView {
                 background-color: white;
                 gridline-color: #E5E5E5;
                 border: 1px solid #E5E5E5;
             }
-            QTableWidget::item {
+            QTableView::item {
                 padding: 5px;
             }
             QHeaderView::section {
@@ -47,226 +103,220 @@ class SlideListWidget(QTableWidget):
                 border: 1px solid #E5E5E5;
                 font-weight: bold;
             }
-            QPushButton {
-                background-color: #0066CC;
-                color: white;
-                border: none;
-                padding: 0px 0px;
-                min-width: 100px;  /* Added min-width */
-                height: 30px;      /* Increased height */
-                margin: 0px;       /* Added margin */
-            }
-            QPushButton:hover {
-                background-color: #0052A3;
-            }
         """)
 
+        # Fixed widths: sizing to contents would decode every row's previews
         header = self.horizontalHeader()
         header.setSectionResizeMode(0, QHeaderView.ResizeMode.Fixed)
         self.setColumnWidth(0, 200)  # Set filename column width to 200px
-        header.setSectionResizeMode(1, QHeaderView.ResizeMode.ResizeToContents)
-        header.setSectionResizeMode(2, QHeaderView.ResizeMode.ResizeToContents)
+        header.setSectionResizeMode(1, QHeaderView.ResizeMode.Interactive)
+        self.setColumnWidth(1, 310)
+        header.setSectionResizeMode(2, QHeaderView.ResizeMode.Interactive)
+        self.setColumnWidth(2, 310)
         header.setSectionResizeMode(3, QHeaderView.ResizeMode.Stretch)
         header.setSectionResizeMode(4, QHeaderView.ResizeMode.Fixed)
         self.setColumnWidth(4, 120)  # Set metadata column width to 120px
-        
+
+        # Paint the metadata button instead of creating a widget per row
+        self.metadata_delegate = MetadataButtonDelegate(self, self.BUTTON_STYLE)
+        self.metadata_delegate.clicked.connect(self.show_metadata)
+        self.setItemDelegateForColumn(4, self.metadata_delegate)
+
         # Enable sorting
         self.setSortingEnabled(True)
-        
+        self.sortByColumn(0, Qt.AscendingOrder)
+
         # Connect double-click signal
-        self.cellDoubleClicked.connect(self.handle_cell_double_click)
-        
+        self.doubleClicked.connect(lambda index: self.handle_cell_double_click(index.row(), index.column()))
+
     def load_slides(self, folder_path):
-        self.clear()
-        self.setHorizontalHeaderLabels(self.COLUMNS)  # Reset column headers after clearing
-        self.slides = []
-        self.setRowCount(0)
-        
-        # Find all SVS and NDPI files
-        for filename in os.listdir(folder_path):
-            if filename.lower().endswith(('.svs', '.ndpi', '.mrxs', '.tif', '.tiff')):
-                filepath = os.path.join(folder_path, filename)
-                try:
-                    slide = tiffslide.TiffSlide(filepath)
-                    self.slides.append(slide)
-                    self.add_slide_row(slide, filename)
-                except Exception as e:
-                    print(f"Error loading {filename}: {str(e)}")
-    
-    def add_slide_row(self, slide, filename):
-        row = self.rowCount()
-        self.insertRow(row)
-        self.setRowHeight(row, 120)  # Adjusted for 100px image + padding
-        
-        # Add filename first
-        self.setItem(row, 0, QTableWidgetItem(filename))
-        
-        # Add thumbnail with fixed height of 100
-        thumbnail = slide.get_thumbnail((1000, 100))  # Large width to maintain aspect ratio
-        pixmap = QPixmap.fromImage(thumbnail.toqimage())
-        pixmap = pixmap.scaled(pixmap.width(), 100, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-        thumbnail_item = QTableWidgetItem()
-        thumbnail_item.setData(Qt.DecorationRole, pixmap)
-        self.setItem(row, 1, thumbnail_item)
-        
-        # Add label and macro images if available
-        try:
-            label = slide.associated_images.get('label')
-            label_item = QTableWidgetItem()
-            if label:
-                label_pixmap = QPixmap.fromImage(label.toqimage())
-                label_pixmap = label_pixmap.scaled(300, 100, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-                label_item.setData(Qt.DecorationRole, label_pixmap)
-            self.setItem(row, 2, label_item)
-            
-            macro = slide.associated_images.get('macro')
-            macro_item = QTableWidgetItem()
-            if macro:
-                macro_pixmap = QPixmap.fromImage(macro.toqimage())
-                macro_pixmap = macro_pixmap.scaled(300, 100, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-                macro_item.setData(Qt.DecorationRole, macro_pixmap)
-            self.setItem(row, 3, macro_item)
-            
-            # Add metadata button with container widget for centering
-            container = QWidget()
-            layout = QVBoxLayout(container)
-            metadata_button = QPushButton("Show Metadata")
-            metadata_button.setFixedSize(100, 30)  # Set fixed size for the button
-            layout.addWidget(metadata_button)
-            layout.setAlignment(Qt.AlignCenter)
-            layout.setContentsMargins(5, 5, 5, 5)  # Added margins around the button
-            metadata_button.clicked.connect(lambda checked, r=row: self.show_metadata(r))
-            self.setCellWidget(row, 4, container)
-            
-        except Exception as e:
-            print(f"Error loading associated images for {filename}: {str(e)}")
-    
+        """
+        List the slides of a folder and its subfolders.  Rows appear while
+        the folder is still being scanned, and previews are decoded as rows
+        scroll into view.
+        """
+        self._finish_load_profile()
+        profiler = None
+        if self.profiling:
+            profiler = BatchProfiler(profile_dir_for(deid_folder_for(folder_path)))
+            stack = ExitStack()
+            # Traces the walk and the preview decoding on the loader's threads
+            stack.enter_context(profiler.trace_memory('load_slides'))
+            self._load_profile = (profiler, stack)
+            self.loader.profiler = profiler
+        self._scan_root = folder_path
+        self.slide_model.set_filepaths([])
+        self.slide_pool.clear()
+        self.associated_images.clear()
+        self.scanner.scan(folder_path, profiler)
+
+    def _on_slides_found(self, filepaths):
+        self.slide_model.add_filepaths(filepaths, self._scan_root)
+        self.loadingProgress.emit(len(self.slide_model.records), 0)  # total not known yet
+
+    def _on_scan_finished(self, count):
+        # Rows were added in the order they were found
+        header = self.horizontalHeader()
+        self.slide_model.sort(header.sortIndicatorSection(), header.sortIndicatorOrder())
+        self.loadingProgress.emit(count, count)
+        self.loadingFinished.emit()
+        if not self.loader.busy():
+            self._finish_load_profile()
+
+    def _on_loads_finished(self):
+        if not self.scanner.scanning:
+            self._finish_load_profile()
+
+    def _finish_load_profile(self):
+        if self._load_profile is None:
+            return
+        profiler, stack = self._load_profile
+        self._load_profile = None
+        self.loader.profiler = None
+        stack.close()
+        print(f"Profile saved to {profiler.save()}")
+
+    def close_caches(self):
+        """ Write out the preview cache and drop decoded slides; call on exit """
+        self.cancel_loading()
+        self.loader.pool.waitForDone()
+        if self.preview_cache is not None:
+            self.preview_cache.close()
+            self.preview_cache = None
+            self.loader.cache = None
+        self.associated_images.close()
+        self.slide_pool.clear()
+
+    def cancel_loading(self):
+        self.loader.cancel()
+        self._finish_load_profile()
+        if self.scanner.scanning:
+            # Keep the slides found so far
+            self.scanner.cancel()
+            self.loadingFinished.emit()
+
+    def paintEvent(self, event):
+        # Previews are requested while painting, so record what is on screen first
+        self._update_visible_paths()
+        super().paintEvent(event)
+
+    def _update_visible_paths(self):
+        first = self.rowAt(0)
+        if first < 0:
+            self._visible_paths = frozenset()
+            return
+        last = self.rowAt(self.viewport().height() - 1)
+        if last < 0:
+            last = self.slide_model.rowCount() - 1
+        self._visible_paths = frozenset(
+            self.slide_model.record(row).filepath for row in range(first, last + 1))
+
+    def _is_wanted(self, filepath):
+        # Called from loader threads
+        return filepath in self._visible_paths
+
     def show_metadata(self, row):
-        slide = self.slides[row]
-        dialog = SlideMetadataDialog(slide, self)
+        record = self.slide_model.record(row)
+        properties = record.properties
+        if properties is None:
+            properties = record.properties = self.slide_pool.properties(record.filepath)
+        dialog = SlideMetadataDialog(properties, self)
         dialog.exec()
-    
+
     def anonymize_all_slides(self, folder_path, options):
         # Create new folder for de-identified files
-        deid_folder = folder_path + "_DEID"
+        deid_folder = deid_folder_for(folder_path)
         if not os.path.exists(deid_folder):
             os.makedirs(deid_folder)
-        
-        # Initialize lists for honest broker file
-        broker_data = []
-        
+
+        # Slides an earlier, interrupted run finished are skipped
+        journal = BatchJournal(journal_path_for(deid_folder))
+
+        # Every slide in the folder, not only the rows fetched so far
+        jobs = [SlideJob(record.filepath,
+                         os.path.join(deid_folder, deid_filename(record.filename, options['encrypt_filename'])),
+                         journal, record.filename)
+                for record in self.slide_model.records]
+
         # Create progress dialog
-        progress = QProgressDialog("De-identifying slides...", "Cancel", 0, self.rowCount(), self)
+        progress = QProgressDialog("De-identifying slides...", "Cancel", 0, len(jobs), self)
         progress.setWindowTitle("Progress")
         progress.setWindowModality(Qt.WindowModal)
         progress.setMinimumDuration(0)  # Show immediately
-        
-        for row in range(self.rowCount()):
+
+        # Honest broker rows are written as slides finish, so a cancelled
+        # batch still maps every file that was copied
+        broker = None
+        if options['create_honest_broker']:
+            broker = open_broker_writer(deid_folder, options.get('broker_format', 'xlsx'))
+
+        # Step timings are written next to the output folder
+        events_path, prometheus_path = metrics_paths_for(deid_folder)
+        batch_metrics = Metrics(events_path)
+
+        profiler = None
+        self.profiling = bool(options.get('profile'))
+        if self.profiling:
+            profiler = BatchProfiler(profile_dir_for(deid_folder))
+
+        # Copies, label/macro capture and verification overlap across slides
+        policy = RedactionPolicy(macro=options.get('remove_macro', False))
+        pipeline = make_pipeline(capture=broker is not None, metrics=batch_metrics,
+                                 profiler=profiler, images=self.associated_images,
+                                 policy=policy)
+        save_broker = broker.close if broker is not None else None
+        add_row = broker.add_row if broker is not None else None
+        if profiler is not None and broker is not None:
+            add_row, save_broker = profiler.wrap(add_row), profiler.wrap(save_broker)
+
+        def on_idle():
+            QApplication.processEvents()
             if progress.wasCanceled():
-                break
-                
-            filename = self.item(row, 0).text()
-            progress.setLabelText(f"De-identifying: {filename}")
-            progress.setValue(row)
-            
-            src_path = os.path.join(folder_path, filename)
-            
-            # Generate new filename if encryption is enabled
-            if options['encrypt_filename']:
-                name, ext = os.path.splitext(filename)
-                hash_obj = hashlib.md5(name.encode())
-                new_filename = hash_obj.hexdigest() + ext
-            else:
-                new_filename = filename
-            
-            dst_path = os.path.join(deid_folder, new_filename)
-            
+                pipeline.cancel()
+
+        done = 0
+        broker_jobs = []
+        with ExitStack() as stack:
+            if profiler is not None:
+                # Rows are added as slides finish, so the broker build spans the run
+                stack.enter_context(profiler.trace_memory('broker_build'))
             try:
-                # Copy file to new location
-                import shutil
-                shutil.copy2(src_path, dst_path)
-                
-                # Get label and macro images if available
-                slide = self.slides[row]
-                label_img = slide.associated_images.get('label')
-                macro_img = slide.associated_images.get('macro')
-                
-                # Save images to PIL format for Excel
-                label_pil = label_img.convert('RGB') if label_img else None
-                macro_pil = macro_img.convert('RGB') if macro_img else None
-                
-                # Add to broker data
-                broker_data.append({
-                    'Original Filename': filename,
-                    'New Filename': new_filename,
-                    'Original Label Image': label_pil,
-                    'Original Macro Image': macro_pil
-                })
-                
-                # Anonymize the copied file
-                anonymize_slide(dst_path)
-                
-            except Exception as e:
-                print(f"Error anonymizing {filename}: {str(e)}")
-        
-        progress.setValue(self.rowCount())  # Ensure progress bar completes
-        
-        # Create honest broker file if enabled
-        if options['create_honest_broker'] and not progress.wasCanceled():
-            progress.setLabelText("Creating honest broker file...")
-            
-            # Create Excel workbook with images
-            from openpyxl import Workbook
-            from openpyxl.drawing.image import Image
-            from io import BytesIO
-            
-            wb = Workbook()
-            ws = wb.active
-            ws.title = "secure data mapping file"
-            
-            # Add headers
-            headers = ['Original Filename', 'New Filename', 'Original Label Image', 'Original Macro Image']
-            for col, header in enumerate(headers, 1):
-                ws.cell(row=1, column=col, value=header)
-            
-            # Add data and images
-            for row_idx, data in enumerate(broker_data, 2):
-                ws.cell(row=row_idx, column=1, value=data['Original Filename'])
-                ws.cell(row=row_idx, column=2, value=data['New Filename'])
-                
-                # Add label image
-                if data['Original Label Image']:
-                    img_buffer = BytesIO()
-                    data['Original Label Image'].save(img_buffer, format='PNG')
-                    img = Image(img_buffer)
-                    # Scale image to reasonable size
-                    scale_factor = min(300 / img.width, 100 / img.height)
-                    img.width = int(img.width * scale_factor)
-                    img.height = int(img.height * scale_factor)
-                    ws.add_image(img, f'C{row_idx}')
-                    ws.row_dimensions[row_idx].height = max(75, img.height)
-                
-                # Add macro image
-                if data['Original Macro Image']:
-                    img_buffer = BytesIO()
-                    data['Original Macro Image'].save(img_buffer, format='PNG')
-                    img = Image(img_buffer)
-                    # Scale image to reasonable size
-                    scale_factor = min(300 / img.width, 100 / img.height)
-                    img.width = int(img.width * scale_factor)
-                    img.height = int(img.height * scale_factor)
-                    ws.add_image(img, f'D{row_idx}')
-                    ws.row_dimensions[row_idx].height = max(75, img.height)
-            
-            # Adjust column widths
-            for col in ['A', 'B', 'C', 'D']:
-                ws.column_dimensions[col].width = 40
-            
-            # Save workbook
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            broker_path = os.path.join(deid_folder, "..", f"{deid_folder}_PHI_Secure_Data_Mapping_File_{timestamp}.xlsx")
-            wb.save(broker_path)
-    
+                for job in pipeline.run(jobs, on_idle=on_idle):
+                    done += 1
+                    filename = os.path.basename(job.src_path)
+                    progress.setLabelText(f"De-identifying: {filename}")
+                    progress.setValue(done)
+                    if progress.wasCanceled():
+                        pipeline.cancel()
+
+                    if not job.ok:
+                        if job.result['status'] == 'error':
+                            print(f"Error anonymizing {filename}: {job.result['error']}")
+                        continue
+
+                    if broker is not None and BROKER_RECORDED not in job.done:
+                        with batch_metrics.span('broker_encode', job.dst_path):
+                            add_row(job.name, os.path.basename(job.dst_path),
+                                    job.label, job.macro)
+                        broker_jobs.append(job)
+                        job.label = job.macro = None
+            finally:
+                progress.setValue(len(jobs))  # Ensure progress bar completes
+                try:
+                    if broker is not None:
+                        progress.setLabelText("Saving honest broker file...")
+                        with batch_metrics.span('broker_save', broker.path):
+                            save_broker()
+                        for job in broker_jobs:
+                            job.record(BROKER_RECORDED, broker=broker.path)
+                finally:
+                    journal.close()
+                    write_prometheus(prometheus_path, {**self.metrics.totals(),
+                                                       **batch_metrics.totals()})
+                    batch_metrics.close()
+        if profiler is not None:
+            print(f"Profile saved to {profiler.save()}")
+
     def handle_cell_double_click(self, row, column):
         # Only respond to metadata and macro columns
         if column == self.COLUMNS.index(self.COLUMN_METADATA):
@@ -274,21 +324,21 @@ class SlideListWidget(QTableWidget):
         elif column == self.COLUMNS.index(self.COLUMN_MACRO):
             self.show_macro_image(row)
         # All other columns will do nothing
-    
+
     def show_macro_image(self, row):
-        slide = self.slides[row]
-        macro = slide.associated_images.get('macro')
+        record = self.slide_model.record(row)
+        macro = self.associated_images.full(record.filepath, 'macro')
         if macro:
             dialog = QDialog(self)
             dialog.setWindowTitle("Macro Image")
             layout = QVBoxLayout(dialog)
-            
+
             # Convert macro image to QPixmap
             macro_pixmap = QPixmap.fromImage(macro.toqimage())
-            
+
             # Create label and set the image
             label = QLabel()
             label.setPixmap(macro_pixmap)
-            
+
             layout.addWidget(label)
-            dialog.exec() 
\ No newline at end of file
+            dialog.exec()
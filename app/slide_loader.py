@@ -0,0 +1,301 @@
+from PySide6.QtCore import QObject, QRunnable, QThreadPool, Signal, Qt, QBuffer, QByteArray, QIODevice
+from PySide6.QtGui import QImage
+import tiffslide
+from contextlib import ExitStack
+import os
+import time
+from preview_cache import CachedPreview
+from batch_metrics import NULL_METRICS
+from slide_discovery import iter_slides
+from thumbnails import read_thumbnail
+
+
+class LoadedSlide:
+    """ Preview images and properties of a slide, decoded off the GUI thread """
+    def __init__(self, filepath, properties, thumbnail, label, macro):
+        self.filepath = filepath
+        self.filename = os.path.basename(filepath)
+        self.properties = properties
+        self.thumbnail = thumbnail  # QImage, 100px tall
+        self.label = label          # QImage fitting 300x100, or None
+        self.macro = macro          # QImage fitting 300x100, or None
+
+
+def _preview(image, width, height):
+    qimage = image.toqimage()
+    return qimage.scaled(width, height, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+
+def _encode(qimage):
+    if qimage is None:
+        return None
+    data = QByteArray()
+    buffer = QBuffer(data)
+    buffer.open(QIODevice.WriteOnly)
+    qimage.save(buffer, "PNG")
+    return bytes(data)
+
+
+def _decode(data):
+    return QImage.fromData(data) if data else None
+
+
+def load_slide(filepath, cache=None, metrics=NULL_METRICS, pool=None, images=None):
+    """
+    Decode the previews of a slide; safe to call from a worker thread.
+    With a `slide_pool.SlidePool`, the handle is borrowed from it and its
+    properties are left in it.  With an `associated_images.AssociatedImages`,
+    the label and macro come from it, so they are decoded only once.  Only
+    the thumbnail and properties go through the persistent `cache`: label
+    and macro images identify the patient and are never written to disk.
+    """
+    cached = None
+    if cache is not None:
+        with metrics.span('preview_cache') as span:
+            cached = cache.get(filepath)
+            span['hit'] = cached is not None
+    label = macro = None
+    if cached is None or images is None:
+        with ExitStack() as stack:
+            with metrics.span('open'):
+                if pool is not None:
+                    slide = stack.enter_context(pool.slide(filepath))
+                else:
+                    slide = stack.enter_context(tiffslide.TiffSlide(filepath))
+            if cached is None:
+                span = stack.enter_context(metrics.span('thumbnail'))
+                properties = dict(slide.properties)
+                # Already 100px tall, from the smallest image that is large enough
+                thumbnail = read_thumbnail(slide, span=span).toqimage()
+            if images is None:
+                try:
+                    label = slide.associated_images.get('label')
+                    macro = slide.associated_images.get('macro')
+                except Exception as e:
+                    print(f"Error loading associated images for {os.path.basename(filepath)}: {str(e)}")
+    if cached is not None:
+        properties, thumbnail = cached.properties, _decode(cached.thumbnail)
+    if images is not None:
+        # After the handle went back to the pool, so the cache borrows it
+        try:
+            label, macro = images.display_pair(filepath)
+        except Exception as e:
+            print(f"Error loading associated images for {os.path.basename(filepath)}: {str(e)}")
+    label = _preview(label, 300, 100) if label else None
+    macro = _preview(macro, 300, 100) if macro else None
+    if pool is not None:
+        pool.remember_properties(filepath, properties)
+    if cache is not None and cached is None:
+        cache.put(filepath, CachedPreview(properties, _encode(thumbnail)))
+    return LoadedSlide(filepath, properties, thumbnail, label, macro)
+
+
+class _TaskSignals(QObject):
+    loaded = Signal(int, object)
+    failed = Signal(int, str, str)
+    skipped = Signal(int, str)
+
+
+class _LoadTask(QRunnable):
+    def __init__(self, generation, filepath, signals, wanted, cache, metrics, slide_pool,
+                 images, profiler):
+        super().__init__()
+        self.generation = generation
+        self.filepath = filepath
+        self.signals = signals
+        self.wanted = wanted
+        self.cache = cache
+        self.metrics = metrics
+        self.slide_pool = slide_pool
+        self.images = images
+        self.profiler = profiler
+
+    def run(self):
+        # Rows can scroll out of view while queued; don't decode those
+        if not self.wanted(self.filepath):
+            self.signals.skipped.emit(self.generation, self.filepath)
+            return
+        load = load_slide if self.profiler is None else self.profiler.wrap(load_slide)
+        try:
+            result = load(self.filepath, self.cache, self.metrics, self.slide_pool,
+                                self.images)
+        except Exception as e:
+            self.signals.failed.emit(self.generation, self.filepath, str(e))
+            return
+        self.signals.loaded.emit(self.generation, result)
+
+
+class SlideLoader(QObject):
+    """
+    Decodes slide previews on a thread pool as they are requested, going
+    through the persistent `cache` when one is given, borrowing handles
+    from `pool` (a `slide_pool.SlidePool`) and taking labels and macros
+    from `images` (an `associated_images.AssociatedImages`).  `slideLoaded`
+    and `slideFailed` fire on the GUI thread, and `loadsFinished` once
+    nothing requested is left to decode.  Timings go to `metrics`, and
+    decoding is profiled while `profiler` is set.
+    """
+    slideLoaded = Signal(object)
+    slideFailed = Signal(str, str)  # filepath, message
+    loadsFinished = Signal()
+
+    def __init__(self, parent=None, max_threads=None, cache=None, metrics=NULL_METRICS,
+                 pool=None, images=None):
+        super().__init__(parent)
+        self.cache = cache
+        self.metrics = metrics
+        self.slide_pool = pool
+        self.images = images
+        self.profiler = None
+        self.pool = QThreadPool(self)
+        if max_threads:
+            self.pool.setMaxThreadCount(max_threads)
+        self._signals = _TaskSignals()
+        self._signals.loaded.connect(self._on_loaded)
+        self._signals.failed.connect(self._on_failed)
+        self._signals.skipped.connect(self._on_skipped)
+        # Results from a cancelled load are dropped
+        self._generation = 0
+        self._pending = set()
+        self._wanted = lambda filepath: True
+
+    def set_wanted(self, wanted):
+        """ `wanted(filepath)` is checked from worker threads before decoding """
+        self._wanted = wanted
+
+    def request(self, filepath):
+        if filepath in self._pending:
+            return
+        self._pending.add(filepath)
+        self.pool.start(_LoadTask(self._generation, filepath, self._signals,
+                                  self._wanted, self.cache, self.metrics,
+                                  self.slide_pool, self.images, self.profiler))
+
+    def busy(self):
+        return bool(self._pending)
+
+    def cancel(self):
+        # Drop queued work; tasks already running finish but are ignored
+        self.pool.clear()
+        self._generation += 1
+        self._pending = set()
+
+    def _on_loaded(self, generation, result):
+        if generation != self._generation:
+            return
+        self._pending.discard(result.filepath)
+        self.slideLoaded.emit(result)
+        self._check_finished()
+
+    def _on_failed(self, generation, filepath, message):
+        if generation != self._generation:
+            return
+        self._pending.discard(filepath)
+        print(f"Error loading {os.path.basename(filepath)}: {message}")
+        self.slideFailed.emit(filepath, message)
+        self._check_finished()
+
+    def _on_skipped(self, generation, filepath):
+        if generation == self._generation:
+            self._pending.discard(filepath)
+            self._check_finished()
+
+    def _check_finished(self):
+        if not self._pending:
+            self.loadsFinished.emit()
+
+
+class _ScanSignals(QObject):
+    found = Signal(int, list)  # generation, filepaths
+    finished = Signal(int, int)  # generation, slides found
+
+
+class _ScanTask(QRunnable):
+    def __init__(self, generation, folder_path, scanner, profiler):
+        super().__init__()
+        self.generation = generation
+        self.folder_path = folder_path
+        self.scanner = scanner
+        self.profiler = profiler
+
+    def run(self):
+        if self.profiler is None:
+            self.scan()
+        else:
+            self.profiler.wrap(self.scan)()
+
+    def scan(self):
+        scanner = self.scanner
+        signals = scanner._signals
+        count = 0
+        batch = []
+        last_emit = time.monotonic()
+        cancelled = False
+        with scanner.metrics.span('discovery') as span:
+            for filepath in iter_slides(self.folder_path, workers=scanner.workers):
+                if self.generation != scanner._generation:
+                    # Leaving the loop closes the generator, stopping the walk
+                    cancelled = True
+                    break
+                batch.append(filepath)
+                count += 1
+                now = time.monotonic()
+                if (len(batch) >= FolderScanner.FOUND_BATCH
+                        or now - last_emit >= FolderScanner.FOUND_INTERVAL):
+                    signals.found.emit(self.generation, batch)
+                    batch = []
+                    last_emit = now
+            span['files'] = count
+        if cancelled:
+            return
+        if batch:
+            signals.found.emit(self.generation, batch)
+        signals.finished.emit(self.generation, count)
+
+
+class FolderScanner(QObject):
+    """
+    Finds the slides in a folder and its subfolders on a background thread.
+    `slidesFound` fires on the GUI thread with each batch of paths as the
+    walk goes, so rows can be shown and previewed before it has finished,
+    and `scanFinished` with the number found.  `workers` folders are
+    listed at a time.
+    """
+    slidesFound = Signal(list)
+    scanFinished = Signal(int)
+
+    # Paths are handed over in batches of this many, or this often
+    FOUND_BATCH = 256
+    FOUND_INTERVAL = 0.2
+
+    def __init__(self, parent=None, workers=1, metrics=NULL_METRICS):
+        super().__init__(parent)
+        self.workers = workers
+        self.metrics = metrics
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(1)
+        self._signals = _ScanSignals()
+        self._signals.found.connect(self._on_found)
+        self._signals.finished.connect(self._on_finished)
+        self._generation = 0
+        self.scanning = False
+
+    def scan(self, folder_path, profiler=None):
+        """ Start scanning `folder_path`, cancelling any scan in progress """
+        self.cancel()
+        self.scanning = True
+        self.pool.start(_ScanTask(self._generation, folder_path, self, profiler))
+
+    def cancel(self):
+        # The walk stops at its next slide; nothing more is reported
+        self._generation += 1
+        self.scanning = False
+
+    def _on_found(self, generation, filepaths):
+        if generation == self._generation:
+            self.slidesFound.emit(filepaths)
+
+    def _on_finished(self, generation, count):
+        if generation == self._generation:
+            self.scanning = False
+            self.scanFinished.emit(count)
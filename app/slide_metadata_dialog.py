@@ -2,9 +2,9 @@ from PySide6.QtWidgets import (QDialog, QVBoxLayout, QTextEdit,
                               QPushButton, QLabel)
 
 class SlideMetadataDialog(QDialog):
-    def __init__(self, slide, parent=None):
+    def __init__(self, properties, parent=None):
         super().__init__(parent)
-        self.slide = slide
+        self.properties = properties
         self.setup_ui()
         
     def setup_ui(self):
@@ -18,7 +18,7 @@ class SlideMetadataDialog(QDialog):
         metadata_text.setReadOnly(True)
         
         # Format metadata
-        metadata = self.slide.properties
+        metadata = self.properties
         formatted_text = "\n".join([f"{k}: {v}" for k, v in metadata.items()])
         metadata_text.setText(formatted_text)
         
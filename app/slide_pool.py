@@ -0,0 +1,120 @@
+"""
+Bounded pool of open slide handles.
+
+Opening a slide parses its TIFF structure, and an open TiffSlide holds a
+file descriptor and cached tiff/zarr structures, so handles should neither
+be opened for every use nor kept for every slide listed.  A few idle
+handles are kept in least-recently-used order and lent out exclusively for
+the body of a `with` block; slide properties, which are cheap to keep, are
+cached separately for many more slides.  Handles and properties are keyed
+by path, size and modification time, so a slide that changes on disk is
+opened again.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+import os
+import threading
+
+from preview_cache import file_key
+
+DEFAULT_MAX_OPEN = 8
+DEFAULT_MAX_PROPERTIES = 4096
+
+
+def open_tiffslide(filepath):
+    import tiffslide
+    return tiffslide.TiffSlide(filepath)
+
+
+class SlidePool:
+    """Thread-safe LRU of idle slide handles opened with `opener(filepath)`."""
+    def __init__(self, max_open=DEFAULT_MAX_OPEN,
+                 max_properties=DEFAULT_MAX_PROPERTIES, opener=open_tiffslide):
+        self.max_open = max(0, max_open)
+        self.max_properties = max(0, max_properties)
+        self._opener = opener
+        self._lock = threading.Lock()
+        self._idle = OrderedDict()        # file key -> idle handle
+        self._properties = OrderedDict()  # file key -> properties dict
+        self._keys = {}                   # absolute path -> current file key
+
+    def _current_key(self, filepath):
+        # Drops what is kept for an older version of the file
+        key = file_key(filepath)
+        path = os.path.abspath(filepath)
+        stale = None
+        with self._lock:
+            old_key = self._keys.get(path)
+            if old_key != key:
+                self._keys[path] = key
+                if old_key is not None:
+                    stale = self._idle.pop(old_key, None)
+                    self._properties.pop(old_key, None)
+        if stale is not None:
+            stale.close()
+        return key
+
+    @contextmanager
+    def slide(self, filepath):
+        """Lend an open handle of `filepath` for the body of a `with` block."""
+        key = self._current_key(filepath)
+        with self._lock:
+            slide = self._idle.pop(key, None)
+        if slide is None:
+            slide = self._opener(filepath)
+        try:
+            yield slide
+        except BaseException:
+            # The handle may be in a bad state; don't lend it again
+            slide.close()
+            raise
+        self._release(os.path.abspath(filepath), key, slide)
+
+    def _release(self, path, key, slide):
+        evicted = []
+        with self._lock:
+            if (key in self._idle or self.max_open == 0
+                    or self._keys.get(path) != key):
+                # A handle of the same file was returned first, or the
+                # file changed while this one was lent out
+                evicted.append(slide)
+            else:
+                self._idle[key] = slide
+                while len(self._idle) > self.max_open:
+                    evicted.append(self._idle.popitem(last=False)[1])
+        for slide in evicted:
+            slide.close()
+
+    def properties(self, filepath):
+        """Properties of `filepath`, opening it only if they are not cached."""
+        key = self._current_key(filepath)
+        with self._lock:
+            properties = self._properties.get(key)
+            if properties is not None:
+                self._properties.move_to_end(key)
+                return properties
+        with self.slide(filepath) as slide:
+            properties = dict(slide.properties)
+        self._remember(key, properties)
+        return properties
+
+    def remember_properties(self, filepath, properties):
+        """Cache properties read by a caller that had the slide open anyway."""
+        self._remember(self._current_key(filepath), properties)
+
+    def _remember(self, key, properties):
+        with self._lock:
+            self._properties[key] = properties
+            self._properties.move_to_end(key)
+            while len(self._properties) > self.max_properties:
+                self._properties.popitem(last=False)
+
+    def clear(self):
+        """Close every idle handle and forget cached properties."""
+        with self._lock:
+            idle = list(self._idle.values())
+            self._idle.clear()
+            self._properties.clear()
+            self._keys.clear()
+        for slide in idle:
+            slide.close()
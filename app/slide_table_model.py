@@ -0,0 +1,203 @@
+from PySide6.QtWidgets import QStyledItemDelegate, QStyleOptionButton, QStyle, QPushButton
+from PySide6.QtCore import Qt, QAbstractTableModel, QModelIndex, QEvent, QRect, Signal
+from PySide6.QtGui import QPixmap
+from collections import OrderedDict
+import os
+
+
+class SlideRecord:
+    """ One slide file; cheap to keep for every row """
+    __slots__ = ('filepath', 'filename', 'properties', 'error')
+
+    def __init__(self, filepath, root=None):
+        self.filepath = filepath
+        # Slides in subfolders are shown with their path below the folder opened
+        self.filename = os.path.relpath(filepath, root) if root else os.path.basename(filepath)
+        self.properties = None  # filled in when previews are first loaded
+        self.error = None
+
+
+class SlideTableModel(QAbstractTableModel):
+    """
+    Rows for every slide in a folder.  Rows are handed to the view in
+    batches as it scrolls, and previews are only decoded for rows the view
+    asks to paint; a bounded number of decoded previews is kept.
+    """
+    COLUMN_FILENAME = "Filename"
+    COLUMN_THUMBNAIL = "Thumbnail"
+    COLUMN_LABEL = "Label"
+    COLUMN_MACRO = "Macro"
+    COLUMN_METADATA = "Metadata"
+    COLUMNS = [COLUMN_FILENAME, COLUMN_THUMBNAIL, COLUMN_LABEL, COLUMN_MACRO, COLUMN_METADATA]
+
+    FETCH_BATCH = 256
+    PREVIEW_CACHE_ROWS = 256
+
+    def __init__(self, loader, parent=None):
+        super().__init__(parent)
+        self.loader = loader
+        self.loader.slideLoaded.connect(self._on_slide_loaded)
+        self.loader.slideFailed.connect(self._on_slide_failed)
+        self.records = []
+        self._fetched = 0
+        self._rows = {}  # filepath -> row
+        self._previews = OrderedDict()  # filepath -> (thumbnail, label, macro) pixmaps
+
+    def set_filepaths(self, filepaths):
+        self.loader.cancel()
+        self.beginResetModel()
+        self.records = [SlideRecord(filepath) for filepath in filepaths]
+        self._fetched = min(len(self.records), self.FETCH_BATCH)
+        self._previews.clear()
+        self._reindex()
+        self.endResetModel()
+
+    def add_filepaths(self, filepaths, root=None):
+        """ Append rows for slides found while a folder is still being scanned """
+        start = len(self.records)
+        self.records.extend(SlideRecord(filepath, root) for filepath in filepaths)
+        for row in range(start, len(self.records)):
+            self._rows[self.records[row].filepath] = row
+        # The first batch is shown at once; later rows are fetched on scrolling
+        count = min(len(self.records), self.FETCH_BATCH) - self._fetched
+        if count > 0:
+            self.beginInsertRows(QModelIndex(), self._fetched, self._fetched + count - 1)
+            self._fetched += count
+            self.endInsertRows()
+
+    def _reindex(self):
+        self._rows = {record.filepath: row for row, record in enumerate(self.records)}
+
+    def record(self, row):
+        return self.records[row]
+
+    # Lazy row population
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self._fetched
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.COLUMNS)
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self._fetched < len(self.records)
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
+            return
+        count = min(self.FETCH_BATCH, len(self.records) - self._fetched)
+        if count <= 0:
+            return
+        self.beginInsertRows(QModelIndex(), self._fetched, self._fetched + count - 1)
+        self._fetched += count
+        self.endInsertRows()
+
+    # Data
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.COLUMNS[section]
+        return None
+
+    def flags(self, index):
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        record = self.records[index.row()]
+        column = index.column()
+        if column == 0:
+            if role == Qt.DisplayRole:
+                return record.filename
+            if role == Qt.ToolTipRole and record.error:
+                return f"Error loading slide: {record.error}"
+        elif column in (1, 2, 3) and role == Qt.DecorationRole:
+            previews = self._preview(record)
+            if previews is not None:
+                return previews[column - 1]
+        return None
+
+    def _preview(self, record):
+        previews = self._previews.get(record.filepath)
+        if previews is not None:
+            self._previews.move_to_end(record.filepath)
+            return previews
+        if record.error is None:
+            self.loader.request(record.filepath)
+        return None
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        # Only filenames are sortable
+        if column != 0:
+            return
+        self.layoutAboutToBeChanged.emit()
+        self.records.sort(key=lambda record: record.filename.lower(),
+                          reverse=(order == Qt.DescendingOrder))
+        self._reindex()
+        self.layoutChanged.emit()
+
+    def _on_slide_loaded(self, loaded):
+        row = self._rows.get(loaded.filepath)
+        if row is None:
+            return
+        self.records[row].properties = loaded.properties
+        self._previews[loaded.filepath] = tuple(
+            QPixmap.fromImage(image) if image is not None else None
+            for image in (loaded.thumbnail, loaded.label, loaded.macro))
+        while len(self._previews) > self.PREVIEW_CACHE_ROWS:
+            self._previews.popitem(last=False)
+        if row < self._fetched:
+            self.dataChanged.emit(self.index(row, 1), self.index(row, 3), [Qt.DecorationRole])
+
+    def _on_slide_failed(self, filepath, message):
+        row = self._rows.get(filepath)
+        if row is None:
+            return
+        self.records[row].error = message
+        if row < self._fetched:
+            self.dataChanged.emit(self.index(row, 0), self.index(row, 0), [Qt.ToolTipRole])
+
+
+class MetadataButtonDelegate(QStyledItemDelegate):
+    """ Paints a "Show Metadata" button in every row without creating widgets """
+    clicked = Signal(int)  # row
+
+    BUTTON_WIDTH = 100
+    BUTTON_HEIGHT = 30
+
+    def __init__(self, parent=None, style_sheet=""):
+        super().__init__(parent)
+        # Styled but never shown; lets the stylesheet apply to painted buttons
+        self._button = QPushButton()
+        self._button.setStyleSheet(style_sheet)
+        self._pressed_row = None
+
+    def _button_rect(self, option):
+        rect = option.rect
+        return QRect(rect.x() + (rect.width() - self.BUTTON_WIDTH) // 2,
+                     rect.y() + (rect.height() - self.BUTTON_HEIGHT) // 2,
+                     self.BUTTON_WIDTH, self.BUTTON_HEIGHT)
+
+    def paint(self, painter, option, index):
+        button = QStyleOptionButton()
+        button.rect = self._button_rect(option)
+        button.text = "Show Metadata"
+        button.state = QStyle.State_Enabled | (option.state & QStyle.State_MouseOver)
+        if self._pressed_row == index.row():
+            button.state |= QStyle.State_Sunken
+        else:
+            button.state |= QStyle.State_Raised
+        self._button.style().drawControl(QStyle.CE_PushButton, button, painter, self._button)
+
+    def editorEvent(self, event, model, option, index):
+        if event.type() == QEvent.MouseButtonPress:
+            if self._button_rect(option).contains(event.position().toPoint()):
+                self._pressed_row = index.row()
+                return True
+        elif event.type() == QEvent.MouseButtonRelease:
+            pressed, self._pressed_row = self._pressed_row, None
+            if pressed == index.row() and self._button_rect(option).contains(event.position().toPoint()):
+                self.clicked.emit(index.row())
+                return True
+        return False
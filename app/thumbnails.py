@@ -0,0 +1,88 @@
+"""
+Slide thumbnails read from the smallest image that is large enough.
+
+A row preview is 100 pixels tall, but the smallest pyramid level of a slide
+is often thousands of pixels on a side, and generic thumbnailing resamples
+it with a high-quality filter and leaves a second rescale to Qt.  Here the
+embedded thumbnail directory (SVS) or the smallest pyramid level at least
+as large as the preview is decoded, so higher-resolution levels are never
+touched, and it is shrunk by an integer box filter in NumPy before a final
+resize of an image at most twice the preview size.
+"""
+import numpy as np
+
+THUMBNAIL_HEIGHT = 100
+MAX_THUMBNAIL_WIDTH = 1000  # Wide enough to keep the aspect ratio of most slides
+
+# Name of the embedded thumbnail series in tifffile
+EMBEDDED_THUMBNAIL = 'thumbnail'
+
+
+def thumbnail_size(width, height, max_width=MAX_THUMBNAIL_WIDTH, max_height=THUMBNAIL_HEIGHT):
+    """Size of a `width` x `height` image fitted into the thumbnail box."""
+    scale = min(max_width / width, max_height / height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _embedded_thumbnail(slide):
+    # tifffile series of the thumbnail directory, if the file has one
+    tiff = getattr(slide, 'ts_tifffile', None)
+    if tiff is None:
+        return None
+    for series in tiff.series:
+        if (series.name or '').lower() == EMBEDDED_THUMBNAIL:
+            return series
+    return None
+
+
+def box_reduce(array, factor):
+    """Shrink an (height, width[, samples]) uint8 array by an integer factor."""
+    if factor < 2:
+        return array
+    height = array.shape[0] // factor
+    width = array.shape[1] // factor
+    array = array[:height * factor, :width * factor]
+    blocks = array.reshape(height, factor, width, factor, *array.shape[2:])
+    total = blocks.sum(axis=(1, 3), dtype=np.uint32)
+    return ((total + factor * factor // 2) // (factor * factor)).astype(np.uint8)
+
+
+def read_thumbnail(slide, max_width=MAX_THUMBNAIL_WIDTH, max_height=THUMBNAIL_HEIGHT,
+                   span=None):
+    """
+    Thumbnail of a TiffSlide fitting `max_width` x `max_height`, as a PIL
+    image.  The source used is recorded in `span` (a metrics span) if given.
+    """
+    from PIL import Image
+
+    target = thumbnail_size(*slide.dimensions, max_width, max_height)
+    # Levels run from the largest; fall back to level 0 for tiny slides
+    levels = [level for level, (width, height) in enumerate(slide.level_dimensions)
+              if width >= target[0] and height >= target[1]] or [0]
+    level = levels[-1]
+    width, height = slide.level_dimensions[level]
+    series = _embedded_thumbnail(slide)
+    page = series.keyframe if series is not None else None
+    if (page is not None and page.imagewidth >= target[0] and page.imagelength >= target[1]
+            and page.imagewidth * page.imagelength < width * height):
+        source = EMBEDDED_THUMBNAIL
+        array = series.asarray()
+    else:
+        source = f'level {level}'
+        array = slide.read_region((0, 0), level, (width, height), as_array=True)
+    if span is not None:
+        span['source'] = source
+
+    array = np.asarray(array)
+    if array.ndim == 3 and array.shape[2] == 1:
+        array = array[:, :, 0]
+    if array.dtype == np.uint16:
+        # Only for display; keep the high byte
+        array = (array >> 8).astype(np.uint8)
+    factor = min(array.shape[0] // target[1], array.shape[1] // target[0])
+    image = Image.fromarray(box_reduce(array, factor))
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    if image.size != target:
+        image = image.resize(target, Image.Resampling.BILINEAR)
+    return image
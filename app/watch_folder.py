@@ -0,0 +1,466 @@
+"""
+Watch-folder service: de-identify slides as scanners write them.
+
+Watched folders are scanned once at startup and then followed with inotify
+on Linux, or by rescanning them every few seconds elsewhere and on network
+filesystems, where inotify does not see writes made by other machines.  A
+slide is queued once the size and modification time of its files (for
+MRXS, also those in its data folder) have stopped changing for a few
+seconds, and goes through the same pipeline as batch_deidentify.py.
+Mapping rows are written as slides finish, to a mapping file that is
+closed and replaced at a fixed interval.  Slides are journaled as in a
+batch, so a restarted service skips what it already did.
+"""
+from optparse import OptionParser
+import ctypes
+import errno
+import json
+import os
+import queue
+import select
+import signal
+import struct
+import sys
+import threading
+import time
+
+import anonymize_functions
+from batch_deidentify import (UNLABELED_ACTIONS, UNLABELED_COPY, deid_filename,
+                              deid_folder_for, run_batch)
+from batch_metrics import NULL_METRICS, Metrics, write_prometheus
+from broker_writer import BROKER_FORMATS, check_broker_format
+from slide_discovery import (DEID_SUFFIX, SLIDE_EXTENSIONS, _matches, iter_slides,
+                             mrxs_data_dir)
+
+PROG_DESCRIPTION = '''
+Watch folders and de-identify slides as soon as they have been written.
+'''.strip()
+
+# Seconds between checks of slides that are still being written
+TICK = 1.0
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+_EVENT = struct.Struct('iIII')
+READ_SIZE = 64 << 10
+
+
+def _deid_folder(directory):
+    return directory.endswith(DEID_SUFFIX)
+
+
+class InotifyWatcher:
+    """
+    Paths created or written under some folders, from inotify (Linux).
+    Subfolders for which `skip(path)` is true are not watched.
+    """
+    def __init__(self, folders, skip=_deid_folder):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify is only available on Linux')
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            inotify_init1 = libc.inotify_init1
+            self._add_watch = libc.inotify_add_watch
+        except (OSError, AttributeError):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        inotify_init1.argtypes = [ctypes.c_int]
+        inotify_init1.restype = ctypes.c_int
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._add_watch.restype = ctypes.c_int
+        self._fd = inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self._dirs = {}  # watch descriptor -> directory
+        self._skip = skip
+        try:
+            for folder in folders:
+                self._watch_tree(folder)
+        except BaseException:
+            self.close()
+            raise
+
+    def _watch_tree(self, folder):
+        for directory, subdirs, _ in os.walk(folder):
+            subdirs[:] = [name for name in subdirs
+                          if not self._skip(os.path.join(directory, name))]
+            wd = self._add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                e = ctypes.get_errno()
+                if e == errno.ENOSPC:
+                    raise OSError(e, 'Too many folders to watch; raise '
+                                  'fs.inotify.max_user_watches or use --poll')
+                # Removed since it was listed
+                continue
+            self._dirs[wd] = directory
+
+    def read(self, timeout):
+        """
+        Paths created or written within `timeout` seconds, including new
+        folders, or None if events were lost and everything must be
+        rescanned.
+        """
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return set()
+        changed = set()
+        lost = False
+        while True:
+            try:
+                buf = os.read(self._fd, READ_SIZE)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _, length = _EVENT.unpack_from(buf, offset)
+                start = offset + _EVENT.size
+                name = buf[start:start + length].rstrip(b'\0')
+                offset = start + length
+                if mask & IN_Q_OVERFLOW:
+                    lost = True
+                    continue
+                if mask & IN_IGNORED:
+                    self._dirs.pop(wd, None)
+                    continue
+                directory = self._dirs.get(wd)
+                if directory is None or not name:
+                    continue
+                path = os.path.join(directory, os.fsdecode(name))
+                if mask & IN_ISDIR:
+                    if self._skip(path):
+                        continue
+                    # Files may have been written before the watch was added,
+                    # so the new folder is reported for a scan as well
+                    self._watch_tree(path)
+                changed.add(path)
+        return None if lost else changed
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def slide_signature(path):
+    """
+    Sizes and modification times of the files of the slide `path`, or
+    None if it is gone.  A slide is complete once this stops changing.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    signature = [(st.st_size, st.st_mtime_ns)]
+    if path.lower().endswith('.mrxs'):
+        try:
+            with os.scandir(mrxs_data_dir(path)) as it:
+                for entry in it:
+                    if entry.is_file():
+                        entry_st = entry.stat()
+                        signature.append((entry.name, entry_st.st_size,
+                                          entry_st.st_mtime_ns))
+        except FileNotFoundError:
+            # Data folder not written yet
+            pass
+    return tuple(sorted(signature, key=str))
+
+
+def slide_for(path):
+    """Slide that the created or written `path` belongs to, or None."""
+    if path.lower().endswith(SLIDE_EXTENSIONS):
+        return path
+    # A file in, or the data folder of, an MRXS slide
+    for candidate in (path, os.path.dirname(path)):
+        if os.path.isfile(candidate + '.mrxs'):
+            return candidate + '.mrxs'
+    return None
+
+
+class FolderWatch:
+    """
+    Slides under `folders` that are ready to be de-identified.  Each call
+    of `poll()` waits for changes and returns the slides that have not
+    changed for `settle` seconds since they were first seen or last
+    returned.  Without inotify, or with `poll_interval` set, folders are
+    rescanned that often; with inotify they are also rescanned every
+    `rescan_interval` seconds in case events were missed.  Slides under
+    `ignore` (an output folder) are never returned, and `include` and
+    `exclude` filter slides reported by inotify the same way they filter
+    scans.
+    """
+    def __init__(self, folders, settle=3.0, poll_interval=None,
+                 rescan_interval=300.0, include=(), exclude=(),
+                 scan_workers=1, ignore=None):
+        self.folders = [os.path.abspath(folder) for folder in folders]
+        self.settle = settle
+        self.include = include
+        self.exclude = exclude
+        self.scan_workers = scan_workers
+        self.ignore = os.path.abspath(ignore) if ignore else None
+        self.watcher = None
+        if poll_interval is None:
+            try:
+                self.watcher = InotifyWatcher(self.folders, self._excluded_dir)
+            except OSError as e:
+                print(f'Polling instead of watching: {str(e)}', file=sys.stderr)
+                poll_interval = 5.0
+        self.scan_interval = poll_interval if self.watcher is None else rescan_interval
+        # Slide -> (signature, time it was last seen to change)
+        self.pending = {}
+        # Slide -> signature it had when it was last returned, while it is
+        # still in the folder
+        self.submitted = {}
+        self._last_scan = None
+
+    def root_of(self, path):
+        """Watched folder that `path` is in."""
+        for folder in self.folders:
+            if os.path.commonpath([folder, path]) == folder:
+                return folder
+        return None
+
+    def _relpath(self, path):
+        # Path relative to its watched folder with '/' separators, as
+        # include and exclude patterns are matched by iter_slides
+        root = self.root_of(path)
+        if root is None:
+            return None
+        return os.path.relpath(path, root).replace(os.sep, '/')
+
+    def _excluded_dir(self, directory):
+        """Whether a scan would not descend into `directory`."""
+        relpath = self._relpath(directory)
+        if relpath is None:
+            return True
+        if relpath == '.':
+            return False
+        parts = relpath.split('/')
+        return any(part.endswith(DEID_SUFFIX) or _matches('/'.join(parts[:i + 1]), self.exclude)
+                   for i, part in enumerate(parts))
+
+    def _wanted(self, path):
+        if self.ignore and os.path.commonpath([self.ignore, path]) == self.ignore:
+            return False
+        relpath = self._relpath(path)
+        if relpath is None or self._excluded_dir(os.path.dirname(path)):
+            return False
+        if self.include and not _matches(relpath, self.include):
+            return False
+        return not _matches(relpath, self.exclude)
+
+    def _add(self, slide):
+        slide = os.path.abspath(slide)
+        if slide not in self.pending and self._wanted(slide):
+            self.pending[slide] = (None, None)
+
+    def scan(self, folders=None):
+        for folder in folders or self.folders:
+            # Patterns are relative to the watched folder, so slides in a
+            # new subfolder are only filtered by _wanted()
+            patterns = ((self.include, self.exclude) if folder in self.folders
+                        else ((), ()))
+            for slide in iter_slides(folder, True, *patterns, self.scan_workers):
+                self._add(slide)
+        if folders is None:
+            # Rechecked with the rest, so slides moved away are forgotten
+            for slide in self.submitted:
+                self.pending.setdefault(slide, (None, None))
+        self._last_scan = time.monotonic()
+
+    def poll(self, timeout=TICK):
+        if self._last_scan is None or time.monotonic() - self._last_scan >= self.scan_interval:
+            self.scan()
+        if self.watcher is not None:
+            changed = self.watcher.read(timeout)
+            if changed is None:
+                self.scan()
+            else:
+                for path in changed:
+                    if os.path.isdir(path) and not os.path.isfile(path + '.mrxs'):
+                        self.scan([path])
+                        continue
+                    slide = slide_for(path)
+                    if slide is not None:
+                        self._add(slide)
+        else:
+            time.sleep(timeout)
+
+        now = time.monotonic()
+        ready = []
+        for slide, (signature, since) in list(self.pending.items()):
+            current = slide_signature(slide)
+            if current is None:
+                # Gone from the landing folder; forget it altogether
+                del self.pending[slide]
+                self.submitted.pop(slide, None)
+            elif current == self.submitted.get(slide):
+                # Unchanged since it was de-identified
+                del self.pending[slide]
+            elif current != signature:
+                self.pending[slide] = (current, now)
+            elif now - since >= self.settle:
+                del self.pending[slide]
+                self.submitted[slide] = current
+                ready.append(slide)
+        return ready
+
+    def close(self):
+        if self.watcher is not None:
+            self.watcher.close()
+
+
+def _main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = OptionParser(usage='%prog [options] folder [folder...]',
+                          description=PROG_DESCRIPTION,
+                          version=anonymize_functions.PROG_VERSION)
+    parser.add_option('-o', '--output', metavar='DIR',
+                      help='write all slides to DIR instead of <folder>_DEID')
+    parser.add_option('--settle', type='float', metavar='SECONDS', default=3.0,
+                      help='wait until a slide has not changed for SECONDS [%default]')
+    parser.add_option('--poll', type='float', metavar='SECONDS',
+                      help='rescan every SECONDS instead of using inotify '
+                      '(for network filesystems)')
+    parser.add_option('--rescan', type='float', metavar='SECONDS', default=300.0,
+                      help='with inotify, also rescan every SECONDS [%default]')
+    parser.add_option('--include', action='append', default=[], metavar='GLOB',
+                      help='only de-identify slides matching GLOB (repeatable)')
+    parser.add_option('--exclude', action='append', default=[], metavar='GLOB',
+                      help='skip slides and folders matching GLOB (repeatable)')
+    parser.add_option('--scan-workers', type='int', metavar='N', default=1,
+                      help='folders listed in parallel when scanning [%default]')
+    parser.add_option('-j', '--jobs', type='int', metavar='N', default=2,
+                      help='number of parallel copies [%default]')
+    parser.add_option('--capture-workers', type='int', metavar='N',
+                      help='number of label/macro decoders [CPU count]')
+    parser.add_option('--verify-workers', type='int', metavar='N', default=2,
+                      help='number of output verifiers [%default]')
+    parser.add_option('--threads', action='store_true',
+                      help='decode images in threads instead of processes')
+    parser.add_option('--keep-filenames', action='store_true',
+                      help='do not replace filenames with their MD5')
+    parser.add_option('--no-broker', action='store_true',
+                      help='do not write the secure data mapping file')
+    parser.add_option('--broker-format', type='choice', default='csv',
+                      choices=sorted(BROKER_FORMATS), metavar='FORMAT',
+                      help='mapping file format: %s [%%default]' % ', '.join(sorted(BROKER_FORMATS)))
+    parser.add_option('--broker-rotate', type='float', metavar='HOURS', default=24.0,
+                      help='start a new mapping file every HOURS [%default]')
+    parser.add_option('--unlabeled', type='choice', default=UNLABELED_COPY,
+                      choices=UNLABELED_ACTIONS, metavar='ACTION',
+                      help='for slides whose label is already gone: %s [%%default]'
+                      % ', '.join(UNLABELED_ACTIONS))
+    anonymize_functions.add_policy_options(parser)
+    parser.add_option('--metrics', metavar='FILE',
+                      help='append JSON-lines timings of every step to FILE')
+    parser.add_option('--prometheus', metavar='FILE',
+                      help='keep per-stage totals in FILE as a Prometheus textfile')
+    parser.add_option('-r', '--report', metavar='FILE', default='-',
+                      help='write JSON-lines results to FILE [stdout]')
+    parser.add_option('-s', '--sparse', action='store_true',
+                      help='leave holes for deleted images where supported')
+    parser.add_option('-d', '--debug', action='store_true',
+                      help='show debugging information')
+    opts, args = parser.parse_args(args)
+    if not args:
+        parser.error('Specify at least one folder')
+    for folder in args:
+        if not os.path.isdir(folder):
+            parser.error(f'Not a folder: {folder}')
+    if not opts.no_broker:
+        try:
+            check_broker_format(opts.broker_format)
+        except ValueError as e:
+            parser.error(str(e))
+
+    anonymize_functions.DEBUG = opts.debug
+    policy = anonymize_functions.policy_from_options(parser, opts)
+    metrics = Metrics(opts.metrics) if opts.metrics or opts.prometheus else NULL_METRICS
+    watch = FolderWatch(args, settle=opts.settle, poll_interval=opts.poll,
+                        rescan_interval=opts.rescan, include=opts.include,
+                        exclude=opts.exclude, scan_workers=opts.scan_workers,
+                        ignore=opts.output)
+
+    stop = threading.Event()
+    ready = queue.Queue()
+
+    def on_signal(signum, frame):
+        # Slides already queued are finished; nothing new is started
+        stop.set()
+
+    signal.signal(signal.SIGINT, on_signal)
+    signal.signal(signal.SIGTERM, on_signal)
+
+    def jobs():
+        while not stop.is_set():
+            try:
+                slide = ready.get(timeout=TICK)
+            except queue.Empty:
+                continue
+            root = watch.root_of(slide)
+            name = os.path.relpath(slide, root)
+            folder = opts.output or deid_folder_for(root)
+            yield (slide, os.path.join(folder, deid_filename(name, not opts.keep_filenames)),
+                   name)
+
+    report = sys.stdout if opts.report == '-' else open(opts.report, 'a')
+
+    def on_result(result):
+        report.write(json.dumps(result) + '\n')
+        report.flush()
+        if result['status'] == 'error':
+            print(f"{result['source']}: {result['error']}", file=sys.stderr)
+        if opts.prometheus:
+            write_prometheus(opts.prometheus, metrics.totals())
+
+    errors = []
+    broker_paths = []
+
+    def batch():
+        try:
+            _, paths = run_batch(
+                jobs(), copy_workers=opts.jobs, capture_workers=opts.capture_workers,
+                verify_workers=opts.verify_workers, use_threads=opts.threads,
+                create_honest_broker=not opts.no_broker, sparse=opts.sparse,
+                on_result=on_result, broker_format=opts.broker_format,
+                metrics=metrics, broker_rotate=opts.broker_rotate * 3600,
+                keep_results=False, interleave_window=1, unlabeled=opts.unlabeled,
+                policy=policy)
+            broker_paths.extend(paths)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    batch_thread = threading.Thread(target=batch, name='watch-batch')
+    batch_thread.start()
+    try:
+        while not stop.is_set():
+            for slide in watch.poll():
+                ready.put(slide)
+    finally:
+        stop.set()
+        batch_thread.join()
+        watch.close()
+        if report is not sys.stdout:
+            report.close()
+        if opts.prometheus:
+            write_prometheus(opts.prometheus, metrics.totals())
+        metrics.close()
+
+    for broker_path in broker_paths:
+        print(f"Secure data mapping file: {broker_path}", file=sys.stderr)
+    if errors:
+        raise errors[0]
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
@@ -0,0 +1,318 @@
+"""
+Benchmarks of the de-identification steps on synthetic slides.
+
+For each slide format a synthetic slide is generated (see
+synthetic_slides.py) and the steps the batch runs on it are timed:
+parsing the TIFF directories or MRXS index, dispatching to the format
+handler, planning the redaction, the single-pass copy and the in-place
+redaction.  Writing the secure data mapping file is timed separately.
+Each run is appended to a results file as one JSON line and compared with
+the last run of the same case, so regressions show up across versions.
+"""
+from optparse import OptionParser
+from statistics import median
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'app'))
+
+import anonymize_functions
+from anonymize_functions import MrxsFile
+from broker_writer import BROKER_FORMATS, open_broker_writer
+import synthetic_slides
+
+PROG_DESCRIPTION = '''
+Time parsing, format dispatch, redaction, copying and broker generation on
+synthetic whole-slide images and compare with earlier runs.
+'''.strip()
+
+CASES = ('svs', 'bigtiff', 'ndpi', 'mrxs', 'broker')
+STAGES = ('parse', 'dispatch', 'plan', 'copy', 'redact')
+DEFAULT_RESULTS = os.path.join(HERE, 'results.jsonl')
+# Differences below this are noise, however large the ratio
+NOISE_SECONDS = 0.002
+
+
+def generate(case, path, opts):
+    """Write the synthetic slide of `case` to `path`; returns its size."""
+    if case in ('svs', 'bigtiff'):
+        synthetic_slides.make_svs(path, levels=opts.levels, tiles=opts.tiles,
+                                  tile_bytes=opts.tile_bytes,
+                                  bigtiff=case == 'bigtiff')
+    elif case == 'ndpi':
+        synthetic_slides.make_ndpi(path, levels=opts.levels,
+                                   level_bytes=opts.tiles * opts.tile_bytes,
+                                   high_offset=int(opts.ndpi_offset_gb * (1 << 30)))
+    elif case == 'mrxs':
+        synthetic_slides.make_mrxs(path, tiles=opts.tiles,
+                                   tile_bytes=opts.tile_bytes,
+                                   data_files=opts.data_files)
+    size = os.path.getsize(path)
+    if case == 'mrxs':
+        dirname = os.path.splitext(path)[0]
+        size += sum(os.path.getsize(os.path.join(dirname, name))
+                    for name in os.listdir(dirname))
+    return size
+
+
+def _remove_slide(path):
+    if os.path.exists(path):
+        os.remove(path)
+    dirname = os.path.splitext(path)[0]
+    if os.path.isdir(dirname):
+        shutil.rmtree(dirname)
+
+
+def time_slide(case, work_dir, opts):
+    """Per-stage timings of one repeat on a freshly generated slide."""
+    src = os.path.join(work_dir, f'{case}_src.{"mrxs" if case == "mrxs" else case}')
+    dst = os.path.join(work_dir, f'{case}_dst.{"mrxs" if case == "mrxs" else case}')
+    _remove_slide(src)
+    _remove_slide(dst)
+    size = generate(case, src, opts)
+    timings = {}
+
+    start = time.perf_counter()
+    if case == 'mrxs':
+        MrxsFile(src)
+    tf = anonymize_functions.open_slide_file(src)
+    timings['parse'] = time.perf_counter() - start
+    try:
+        start = time.perf_counter()
+        fmt = anonymize_functions.detect_format(src, tf)
+        timings['dispatch'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        plan = fmt.plan(src, tf, opts.policy)
+        timings['plan'] = time.perf_counter() - start
+    finally:
+        if tf is not None:
+            tf.close()
+
+    # Sparse NDPI files would be materialized in full by the copy
+    if size <= opts.max_copy_mb * (1 << 20):
+        start = time.perf_counter()
+        plan.copy(dst, sparse=opts.sparse)
+        timings['copy'] = time.perf_counter() - start
+        _remove_slide(dst)
+
+    start = time.perf_counter()
+    plan.apply(sparse=opts.sparse)
+    timings['redact'] = time.perf_counter() - start
+    _remove_slide(src)
+    return size, timings
+
+
+def _associated_images():
+    try:
+        from PIL import Image
+    except ImportError:
+        return None, None
+    # Sizes of the label and macro of a typical SVS
+    return Image.new('RGB', (387, 463), 'white'), Image.new('RGB', (1280, 431), 'white')
+
+
+def time_broker(work_dir, opts):
+    """Timings of writing a mapping file of `opts.broker_rows` rows."""
+    label, macro = _associated_images()
+    deid_folder = os.path.join(work_dir, 'broker_DEID')
+    timings = {}
+    start = time.perf_counter()
+    writer = open_broker_writer(deid_folder, opts.broker_format)
+    try:
+        for i in range(opts.broker_rows):
+            writer.add_row(f'slide_{i:06d}.svs', f'{i:032x}.svs', label, macro)
+        timings['rows'] = time.perf_counter() - start
+        start = time.perf_counter()
+    finally:
+        writer.close()
+    timings['close'] = time.perf_counter() - start
+    for name in os.listdir(work_dir):
+        path = os.path.join(work_dir, name)
+        if name.startswith('broker_DEID'):
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+    return 0, timings
+
+
+def case_params(case, opts):
+    """Parameters that make runs of `case` comparable."""
+    if case == 'broker':
+        return dict(rows=opts.broker_rows, format=opts.broker_format)
+    params = dict(tiles=opts.tiles, tile_bytes=opts.tile_bytes,
+                  sparse=bool(opts.sparse))
+    if case != 'mrxs':
+        params['levels'] = opts.levels
+    if case == 'ndpi':
+        params['offset_gb'] = opts.ndpi_offset_gb
+    if case == 'mrxs':
+        params['data_files'] = opts.data_files
+    if not opts.policy.label_only:
+        params['policy'] = opts.policy.describe()
+    return params
+
+
+def run_case(case, work_dir, opts):
+    runs = []
+    size = 0
+    for _ in range(opts.repeat):
+        if case == 'broker':
+            size, timings = time_broker(work_dir, opts)
+        else:
+            size, timings = time_slide(case, work_dir, opts)
+        runs.append(timings)
+    stages = {}
+    for stage in runs[0]:
+        values = [timings[stage] for timings in runs]
+        stages[stage] = dict(median=round(median(values), 6),
+                             min=round(min(values), 6))
+    return dict(case=case, params=case_params(case, opts), bytes=size,
+                repeat=opts.repeat, stages=stages)
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=HERE, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_results(path):
+    results = []
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as fh:
+            for line in fh:
+                try:
+                    results.append(json.loads(line))
+                except ValueError:
+                    continue
+    return results
+
+
+def previous_result(results, result):
+    """Last earlier run of the same case with the same parameters."""
+    for earlier in reversed(results):
+        if (earlier.get('case') == result['case']
+                and earlier.get('params') == result['params']):
+            return earlier
+    return None
+
+
+def regressions(previous, result, threshold):
+    """Stages whose median got slower than `threshold` times before."""
+    found = []
+    for stage, timing in result['stages'].items():
+        before = previous['stages'].get(stage)
+        if before is None:
+            continue
+        if (timing['median'] > before['median'] * threshold
+                and timing['median'] - before['median'] > NOISE_SECONDS):
+            found.append((stage, before['median'], timing['median']))
+    return found
+
+
+def format_result(result, previous=None):
+    lines = [f"{result['case']} ({result['bytes'] / (1 << 20):.1f} MiB, "
+             f"{result['repeat']} runs)"]
+    for stage, timing in result['stages'].items():
+        line = f"  {stage:<10} {timing['median'] * 1000:10.2f} ms median " \
+               f"{timing['min'] * 1000:10.2f} ms min"
+        before = previous and previous['stages'].get(stage)
+        if before and before['median']:
+            line += f"  {timing['median'] / before['median']:6.2f}x " \
+                    f"vs {previous.get('revision') or previous.get('version')}"
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def _main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = OptionParser(usage='%prog [options] [case...]',
+                          description=PROG_DESCRIPTION,
+                          version=anonymize_functions.PROG_VERSION,
+                          epilog='Cases: ' + ', '.join(CASES) + ' (default: all)')
+    parser.add_option('-r', '--repeat', type='int', metavar='N', default=5,
+                      help='runs per case [%default]')
+    parser.add_option('--levels', type='int', metavar='N', default=4,
+                      help='pyramid levels (IFDs) of TIFF-based slides [%default]')
+    parser.add_option('--tiles', type='int', metavar='N', default=1024,
+                      help='level 0 tiles [%default]')
+    parser.add_option('--tile-bytes', type='int', metavar='N', default=16 << 10,
+                      help='bytes per tile [%default]')
+    parser.add_option('--data-files', type='int', metavar='N', default=4,
+                      help='MRXS data files [%default]')
+    parser.add_option('--ndpi-offset-gb', type='float', metavar='GB', default=5,
+                      help='place NDPI levels after the first beyond this '
+                      'offset in a sparse file; 0 to disable [%default]')
+    parser.add_option('--max-copy-mb', type='int', metavar='MB', default=1024,
+                      help='skip the copy of larger slides [%default]')
+    parser.add_option('-s', '--sparse', action='store_true',
+                      help='punch holes for deleted images')
+    parser.add_option('--broker-rows', type='int', metavar='N', default=1000,
+                      help='rows of the mapping file [%default]')
+    parser.add_option('--broker-format', choices=sorted(BROKER_FORMATS),
+                      default='csv', help='mapping file format: '
+                      + ', '.join(sorted(BROKER_FORMATS)) + ' [%default]')
+    anonymize_functions.add_policy_options(parser)
+    parser.add_option('--results', metavar='FILE', default=DEFAULT_RESULTS,
+                      help='append results to FILE [%default]')
+    parser.add_option('--no-save', action='store_true',
+                      help='only compare, do not append results')
+    parser.add_option('--threshold', type='float', metavar='RATIO', default=1.25,
+                      help='report stages slower than RATIO times the '
+                      'previous run as regressions [%default]')
+    parser.add_option('--work-dir', metavar='DIR',
+                      help='where to generate slides [temporary directory]')
+    opts, args = parser.parse_args(args)
+    cases = args or list(CASES)
+    for case in cases:
+        if case not in CASES:
+            parser.error(f'Unknown case: {case}')
+    if opts.repeat < 1:
+        parser.error('--repeat must be at least 1')
+    opts.policy = anonymize_functions.policy_from_options(parser, opts)
+
+    work_dir = tempfile.mkdtemp(prefix='wsi_deid_bench_', dir=opts.work_dir)
+    history = load_results(opts.results)
+    common = dict(time=time.time(), version=anonymize_functions.PROG_VERSION,
+                  revision=git_revision(), python=platform.python_version(),
+                  platform=platform.platform())
+    exit_code = 0
+    try:
+        for case in cases:
+            try:
+                result = dict(common, **run_case(case, work_dir, opts))
+            except ImportError as e:
+                print(f'{case}: skipped, {str(e)}', file=sys.stderr)
+                continue
+            previous = previous_result(history, result)
+            print(format_result(result, previous))
+            if previous is not None:
+                for stage, before, after in regressions(previous, result,
+                                                        opts.threshold):
+                    print(f'{case}: {stage} regressed from {before * 1000:.2f} ms '
+                          f'to {after * 1000:.2f} ms', file=sys.stderr)
+                    exit_code = 1
+            if not opts.no_save:
+                with open(opts.results, 'a', encoding='utf-8') as fh:
+                    fh.write(json.dumps(result) + '\n')
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
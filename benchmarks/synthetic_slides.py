@@ -0,0 +1,380 @@
+"""
+Synthetic whole-slide images for benchmarks.
+
+The files are structurally what the de-identifier expects from real
+scanners -- Aperio SVS with an LZW label strip (classic TIFF or BigTIFF),
+Hamamatsu NDPI with NDPI_MAGIC/NDPI_SOURCELENS tags and, optionally, image
+data past 4 GB in a sparse file, and 3DHISTECH MRXS with Slidedat.ini,
+index and data files -- but every image is the same tiny JPEG padded to
+size with filler, so they are cheap to generate, contain nothing sensitive
+and still decode.
+"""
+import os
+import struct
+
+# TIFF types
+ASCII = 2
+SHORT = 3
+LONG = 4
+FLOAT = 11
+LONG8 = 16
+
+# TIFF tags
+NEW_SUBFILE_TYPE = 254
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+COMPRESSION = 259
+IMAGE_DESCRIPTION = 270
+STRIP_OFFSETS = 273
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+TILE_WIDTH = 322
+TILE_LENGTH = 323
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+NDPI_MAGIC = 65420
+NDPI_SOURCELENS = 65421
+
+COMPRESSION_LZW = 5
+COMPRESSION_JPEG = 7
+
+JPEG_SOI = b'\xff\xd8'
+JPEG_EOI = b'\xff\xd9'
+JPEG_COM = b'\xff\xfe'
+MAX_SEGMENT = 0xffff + 2  # Marker and length included
+LZW_CLEARCODE = b'\x80'
+UTF8_BOM = b'\xef\xbb\xbf'
+
+TILE_SIZE = 256
+FILLER_SIZE = 1 << 20
+_filler = None
+_jpeg = None
+
+
+def filler(length, prefix=b'', suffix=b''):
+    """`length` bytes of incompressible filler framed by `prefix`/`suffix`."""
+    global _filler
+    if _filler is None:
+        _filler = os.urandom(FILLER_SIZE)
+    body = length - len(prefix) - len(suffix)
+    chunks = [_filler] * (body // FILLER_SIZE) + [_filler[:body % FILLER_SIZE]]
+    return prefix + b''.join(chunks) + suffix
+
+
+def tiny_jpeg():
+    """An 8x8 grey baseline JPEG, encoded once."""
+    global _jpeg
+    if _jpeg is None:
+        from io import BytesIO
+        from PIL import Image
+
+        buffer = BytesIO()
+        Image.new('RGB', (8, 8), (200, 200, 200)).save(buffer, format='JPEG', quality=70)
+        _jpeg = buffer.getvalue()
+    return _jpeg
+
+
+def jpeg_blob(length):
+    """
+    A decodable JPEG of `length` bytes (give or take a few for tiny ones):
+    the tiny JPEG with comment segments of filler after its SOI marker.
+    """
+    jpeg = tiny_jpeg()
+    padding = length - len(jpeg)
+    segments = []
+    while padding >= 4:
+        size = min(padding, MAX_SEGMENT)
+        if 0 < padding - size < 4:
+            # Leave room for one more segment
+            size -= 4
+        segments.append(filler(size, JPEG_COM + struct.pack('>H', size - 2)))
+        padding -= size
+    return JPEG_SOI + b''.join(segments) + jpeg[len(JPEG_SOI):]
+
+
+class TiffWriter:
+    """
+    Streams a TIFF, BigTIFF or NDPI-style TIFF to disk one directory at a
+    time; each directory's image data is written just before it.
+    """
+    def __init__(self, path, bigtiff=False, ndpi=False):
+        self._fh = open(path, 'wb')
+        self.bigtiff = bigtiff
+        self.ndpi = ndpi
+        if bigtiff:
+            self._fh.write(b'II' + struct.pack('<HHHQ', 43, 8, 0, 0))
+            self._next_pointer = (8, 'Q')
+        elif ndpi:
+            # Eight bytes of header pointer: files beyond 4 GB are read in
+            # NDPI mode from the start, smaller ones only use the low half
+            self._fh.write(b'II' + struct.pack('<HQ', 42, 0))
+            self._next_pointer = (4, 'Q')
+        else:
+            self._fh.write(b'II' + struct.pack('<HI', 42, 0))
+            self._next_pointer = (4, 'I')
+
+    def tell(self):
+        return self._fh.seek(0, 2)
+
+    def skip_to(self, offset):
+        """Leave a hole up to `offset`, making the file sparse."""
+        if offset > self.tell():
+            self._fh.truncate(offset)
+
+    def write_data(self, data):
+        offset = self.tell()
+        if offset % 2:
+            self._fh.write(b'\0')
+            offset += 1
+        self._fh.write(data)
+        return offset
+
+    def _offset_value(self, offsets):
+        if self.bigtiff:
+            return (LONG8, offsets)
+        # NDPI keeps only the low 32 bits of offsets
+        return (LONG, [offset & 0xffffffff for offset in offsets])
+
+    def add_directory(self, tags, strips=None, tiles=None):
+        """Write `strips` or `tiles` and a directory describing them."""
+        tags = dict(tags)
+        for blobs, offsets_tag, counts_tag in ((strips, STRIP_OFFSETS, STRIP_BYTE_COUNTS),
+                                               (tiles, TILE_OFFSETS, TILE_BYTE_COUNTS)):
+            if blobs:
+                offsets = [self.write_data(blob) for blob in blobs]
+                tags[offsets_tag] = self._offset_value(offsets)
+                tags[counts_tag] = (LONG8 if self.bigtiff else LONG,
+                                    [len(blob) for blob in blobs])
+
+        inline_size = 8 if self.bigtiff else 4
+        entries = []
+        for tag in sorted(tags):
+            type, values = tags[tag]
+            if type == ASCII:
+                data = values.encode('utf-8') + b'\0'
+                count = len(data)
+            else:
+                item = {SHORT: 'H', LONG: 'I', FLOAT: 'f', LONG8: 'Q'}[type]
+                data = struct.pack('<%d%s' % (len(values), item), *values)
+                count = len(values)
+            if len(data) <= inline_size:
+                value = data.ljust(inline_size, b'\0')
+            else:
+                offset = self.write_data(data)
+                if self.bigtiff:
+                    value = struct.pack('<Q', offset)
+                else:
+                    value = struct.pack('<I', offset & 0xffffffff)
+            entries.append((tag, type, count, value))
+
+        offset = self.write_data(b'')
+        if self.bigtiff:
+            table = struct.pack('<Q', len(entries)) + b''.join(
+                struct.pack('<HHQ', tag, type, count) + value
+                for tag, type, count, value in entries)
+        else:
+            table = struct.pack('<H', len(entries)) + b''.join(
+                struct.pack('<HHI', tag, type, count) + value
+                for tag, type, count, value in entries)
+        # NDPI switches to 64-bit next-directory pointers after the header
+        next_format = 'Q' if (self.bigtiff or self.ndpi) else 'I'
+        self._fh.write(table + struct.pack('<' + next_format, 0))
+
+        pointer_offset, pointer_format = self._next_pointer
+        self._fh.seek(pointer_offset)
+        if pointer_format == 'I':
+            offset_value = offset & 0xffffffff
+            if not self.ndpi and offset_value != offset:
+                raise ValueError('Directory beyond 4 GB in a classic TIFF')
+        else:
+            offset_value = offset
+        self._fh.write(struct.pack('<' + pointer_format, offset_value))
+        self._next_pointer = (offset + len(table), next_format)
+        self._fh.seek(0, 2)
+
+    def close(self):
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _dims(tile_count):
+    across = max(1, int(tile_count ** 0.5))
+    down = max(1, -(-tile_count // across))
+    return across * TILE_SIZE, down * TILE_SIZE
+
+
+def make_svs(path, levels=3, tiles=64, tile_bytes=16 << 10,
+             label_bytes=64 << 10, macro_bytes=128 << 10, bigtiff=False):
+    """
+    Aperio SVS: a tiled pyramid of `levels` levels (`tiles` tiles at level
+    0, a quarter as many per level after), a thumbnail, an LZW label split
+    into two strips and a JPEG macro.
+    """
+    description = 'Aperio Image Library v12.0.15\r\n'
+    with TiffWriter(path, bigtiff=bigtiff) as tw:
+        for level in range(levels):
+            count = max(1, tiles >> (2 * level))
+            width, height = _dims(count)
+            tw.add_directory({
+                NEW_SUBFILE_TYPE: (LONG, [0]),
+                IMAGE_WIDTH: (LONG, [width]),
+                IMAGE_LENGTH: (LONG, [height]),
+                COMPRESSION: (SHORT, [COMPRESSION_JPEG]),
+                TILE_WIDTH: (SHORT, [TILE_SIZE]),
+                TILE_LENGTH: (SHORT, [TILE_SIZE]),
+                IMAGE_DESCRIPTION: (ASCII, description +
+                    f'{width}x{height} [0,0 {width}x{height}] ({TILE_SIZE}x{TILE_SIZE}) '
+                    'JPEG/RGB Q=70|AppMag = 20|MPP = 0.5'),
+            }, tiles=[jpeg_blob(tile_bytes) for _ in range(count)])
+            if level == 0:
+                tw.add_directory({
+                    NEW_SUBFILE_TYPE: (LONG, [0]),
+                    IMAGE_WIDTH: (LONG, [768]),
+                    IMAGE_LENGTH: (LONG, [576]),
+                    COMPRESSION: (SHORT, [COMPRESSION_JPEG]),
+                    ROWS_PER_STRIP: (LONG, [576]),
+                    IMAGE_DESCRIPTION: (ASCII, description +
+                        f'{width}x{height} -> 768x576 - |AppMag = 20|MPP = 0.5'),
+                }, strips=[jpeg_blob(tile_bytes)])
+        tw.add_directory({
+            NEW_SUBFILE_TYPE: (LONG, [1]),
+            IMAGE_WIDTH: (LONG, [387]),
+            IMAGE_LENGTH: (LONG, [463]),
+            COMPRESSION: (SHORT, [COMPRESSION_LZW]),
+            ROWS_PER_STRIP: (LONG, [232]),
+            IMAGE_DESCRIPTION: (ASCII, description + 'label 387x463'),
+        }, strips=[filler(label_bytes // 2, LZW_CLEARCODE),
+                   filler(label_bytes - label_bytes // 2, LZW_CLEARCODE)])
+        tw.add_directory({
+            NEW_SUBFILE_TYPE: (LONG, [9]),
+            IMAGE_WIDTH: (LONG, [1280]),
+            IMAGE_LENGTH: (LONG, [431]),
+            COMPRESSION: (SHORT, [COMPRESSION_JPEG]),
+            ROWS_PER_STRIP: (LONG, [431]),
+            IMAGE_DESCRIPTION: (ASCII, description + 'macro 1280x431'),
+        }, strips=[jpeg_blob(macro_bytes)])
+
+
+def make_ndpi(path, levels=3, level_bytes=256 << 10, macro_bytes=128 << 10,
+              high_offset=5 << 30):
+    """
+    Hamamatsu NDPI: `levels` single-strip JPEG levels and a macro (source
+    lens -1).  With `high_offset`, everything after the first level is
+    placed beyond that offset in a sparse file, so 32-bit offsets wrap.
+    """
+    with TiffWriter(path, ndpi=True) as tw:
+        for level in range(levels):
+            if level == 1 and high_offset:
+                tw.skip_to(high_offset)
+            width, height = _dims(max(1, 64 >> (2 * level)))
+            tw.add_directory({
+                IMAGE_WIDTH: (LONG, [width]),
+                IMAGE_LENGTH: (LONG, [height]),
+                COMPRESSION: (SHORT, [COMPRESSION_JPEG]),
+                ROWS_PER_STRIP: (LONG, [height]),
+                NDPI_MAGIC: (LONG, [1]),
+                NDPI_SOURCELENS: (FLOAT, [20.0 / (4 ** level)]),
+            }, strips=[jpeg_blob(max(1024, level_bytes >> (2 * level)))])
+        tw.add_directory({
+            IMAGE_WIDTH: (LONG, [1191]),
+            IMAGE_LENGTH: (LONG, [408]),
+            COMPRESSION: (SHORT, [COMPRESSION_JPEG]),
+            ROWS_PER_STRIP: (LONG, [408]),
+            NDPI_MAGIC: (LONG, [1]),
+            NDPI_SOURCELENS: (FLOAT, [-1.0]),
+        }, strips=[jpeg_blob(macro_bytes)])
+
+
+MRXS_NONHIER = ('ScanDataLayer_SlideThumbnail', 'ScanDataLayer_SlideBarcode',
+                'ScanDataLayer_SlidePreview')
+
+
+def make_mrxs(path, tiles=64, tile_bytes=16 << 10, data_files=2,
+              label_bytes=64 << 10, label_at_end=False):
+    """
+    3DHISTECH MRXS: `path` plus a directory holding Slidedat.ini, Index.dat
+    and `data_files` data files with `tiles` level 0 tiles and the
+    thumbnail, barcode (label) and preview images.
+    """
+    dirname = os.path.splitext(path)[0]
+    os.makedirs(dirname, exist_ok=True)
+    with open(path, 'wb') as fh:
+        fh.write(b'')
+
+    # Data files: tiles round-robin, nonhier images in the first file
+    datafiles = [f'Data{i:04d}.dat' for i in range(data_files)]
+    contents = [bytearray(b'\0' * 64) for _ in datafiles]
+    tile_locations = []
+    nonhier_locations = {}
+
+    def place(fileno, blob):
+        position = len(contents[fileno])
+        contents[fileno] += blob
+        return position, len(blob), fileno
+
+    nonhier_blobs = {
+        'ScanDataLayer_SlideThumbnail': jpeg_blob(tile_bytes),
+        'ScanDataLayer_SlideBarcode': jpeg_blob(label_bytes),
+        'ScanDataLayer_SlidePreview': jpeg_blob(4 * tile_bytes),
+    }
+    for name in MRXS_NONHIER:
+        if not (label_at_end and name == 'ScanDataLayer_SlideBarcode'):
+            nonhier_locations[name] = place(0, nonhier_blobs[name])
+    for i in range(tiles):
+        tile_locations.append((i,) + place(i % data_files, jpeg_blob(tile_bytes)))
+    if label_at_end:
+        name = 'ScanDataLayer_SlideBarcode'
+        nonhier_locations[name] = place(0, nonhier_blobs[name])
+    for name, data in zip(datafiles, contents):
+        with open(os.path.join(dirname, name), 'wb') as fh:
+            fh.write(data)
+
+    # Index: version and slide id, hier and nonhier roots at 37 and 41
+    index = bytearray(b'01.02' + b'0' * 32 + b'\0' * 8)
+
+    def append(fmt, *values):
+        position = len(index)
+        index.extend(struct.pack(fmt, *values))
+        return position
+
+    hier_page = append('<ii', len(tile_locations), 0)
+    for image, position, size, fileno in tile_locations:
+        append('<4i', image, position, size, fileno)
+    hier_head = append('<ii', 0, hier_page)
+    hier_table = append('<i', hier_head)
+    nonhier_heads = []
+    for name in MRXS_NONHIER:
+        position, size, fileno = nonhier_locations[name]
+        page = append('<7i', 1, 0, 0, 0, position, size, fileno)
+        nonhier_heads.append(append('<ii', 0, page))
+    nonhier_table = append('<%di' % len(nonhier_heads), *nonhier_heads)
+    struct.pack_into('<ii', index, 37, hier_table, nonhier_table)
+    with open(os.path.join(dirname, 'Index.dat'), 'wb') as fh:
+        fh.write(index)
+
+    # Slidedat.ini, CRLF line endings and a BOM like the scanner writes
+    width, height = _dims(tiles)
+    lines = ['[GENERAL]', 'SLIDE_VERSION = 1.8',
+             'SLIDE_ID = 00000000000000000000000000000000',
+             f'IMAGENUMBER_X = {width // TILE_SIZE}',
+             f'IMAGENUMBER_Y = {height // TILE_SIZE}',
+             '[HIERARCHICAL]', 'INDEXFILE = Index.dat',
+             'HIER_COUNT = 1', 'HIER_0_NAME = Slide zoom level', 'HIER_0_COUNT = 1',
+             'HIER_0_VAL_0 = ZoomLevel_0', 'HIER_0_VAL_0_SECTION = LAYER_0_LEVEL_0_SECTION',
+             'NONHIER_COUNT = 1', 'NONHIER_0_NAME = Scan data layer',
+             f'NONHIER_0_COUNT = {len(MRXS_NONHIER)}']
+    for i, name in enumerate(MRXS_NONHIER):
+        lines += [f'NONHIER_0_VAL_{i} = {name}',
+                  f'NONHIER_0_VAL_{i}_SECTION = NONHIERLAYER_0_LEVEL_{i}_SECTION']
+    lines += ['[LAYER_0_LEVEL_0_SECTION]', 'IMAGE_FORMAT = JPEG']
+    for i in range(len(MRXS_NONHIER)):
+        lines += [f'[NONHIERLAYER_0_LEVEL_{i}_SECTION]', 'IMAGE_FORMAT = JPEG']
+    lines += ['[DATAFILE]', f'FILE_COUNT = {len(datafiles)}']
+    lines += [f'FILE_{i} = {name}' for i, name in enumerate(datafiles)]
+    with open(os.path.join(dirname, 'Slidedat.ini'), 'wb') as fh:
+        fh.write(UTF8_BOM + ('\r\n'.join(lines) + '\r\n').encode('utf-8'))
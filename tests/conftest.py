@@ -0,0 +1,91 @@
+"""
+Shared fixtures: the app modules are imported by their top-level names, as
+the GUI and the command-line tools do, and slides are generated with the
+benchmarks' synthetic slide writer.
+"""
+import os
+import shutil
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'app'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import synthetic_slides
+
+EXTENSIONS = {'svs': '.svs', 'bigtiff': '.svs', 'ndpi': '.ndpi', 'mrxs': '.mrxs'}
+CHUNK_SIZE = 8 << 20
+
+
+def make_slide(kind, path, **kwargs):
+    """Write a small synthetic slide of `kind` (see EXTENSIONS) to `path`."""
+    if kind in ('svs', 'bigtiff'):
+        kwargs.setdefault('tiles', 16)
+        kwargs.setdefault('tile_bytes', 4 << 10)
+        synthetic_slides.make_svs(path, bigtiff=kind == 'bigtiff', **kwargs)
+    elif kind == 'ndpi':
+        kwargs.setdefault('level_bytes', 64 << 10)
+        kwargs.setdefault('high_offset', 0)
+        synthetic_slides.make_ndpi(path, **kwargs)
+    elif kind == 'mrxs':
+        kwargs.setdefault('tiles', 16)
+        kwargs.setdefault('tile_bytes', 4 << 10)
+        synthetic_slides.make_mrxs(path, **kwargs)
+    else:
+        raise ValueError(kind)
+    return path
+
+
+def slide_files(path):
+    """Files of the slide `path`, relative to its folder."""
+    names = [os.path.basename(path)]
+    if path.endswith('.mrxs'):
+        dirname = os.path.splitext(path)[0]
+        names += [os.path.join(os.path.basename(dirname), name)
+                  for name in sorted(os.listdir(dirname))]
+    return names
+
+
+def copy_slide(src, dst):
+    shutil.copyfile(src, dst)
+    if src.endswith('.mrxs'):
+        shutil.copytree(os.path.splitext(src)[0], os.path.splitext(dst)[0])
+    return dst
+
+
+def same_contents(a, b):
+    """Whether files `a` and `b` read back the same, holes included."""
+    if os.path.getsize(a) != os.path.getsize(b):
+        return False
+    with open(a, 'rb') as fa, open(b, 'rb') as fb:
+        while True:
+            chunk = fa.read(CHUNK_SIZE)
+            if chunk != fb.read(CHUNK_SIZE):
+                return False
+            if not chunk:
+                return True
+
+
+def assert_same_slide(a, b):
+    files_a, files_b = slide_files(a), slide_files(b)
+    assert [os.path.splitext(name)[1] for name in files_a] == \
+        [os.path.splitext(name)[1] for name in files_b]
+    for name_a, name_b in zip(files_a, files_b):
+        path_a = os.path.join(os.path.dirname(a), name_a)
+        path_b = os.path.join(os.path.dirname(b), name_b)
+        assert same_contents(path_a, path_b), f'{name_a} differs from {name_b}'
+
+
+@pytest.fixture
+def slide(tmp_path):
+    """`slide(kind, name=None, **kwargs)` writes a synthetic slide in a
+    `slides` folder of the test's temporary directory."""
+    folder = tmp_path / 'slides'
+    folder.mkdir()
+
+    def make(kind, name=None, **kwargs):
+        name = name or kind + EXTENSIONS[kind]
+        return make_slide(kind, str(folder / name), **kwargs)
+    return make
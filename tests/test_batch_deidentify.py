@@ -0,0 +1,67 @@
+"""The headless batch: every slide of a folder copied, redacted and verified."""
+import json
+import os
+
+import pytest
+
+import batch_deidentify
+from batch_deidentify import deid_folder_for, iter_jobs, run_batch
+
+from conftest import EXTENSIONS
+
+KINDS = ('svs', 'bigtiff', 'ndpi', 'mrxs')
+
+
+@pytest.fixture
+def folder(slide):
+    paths = [slide(kind, f'{kind}_slide{EXTENSIONS[kind]}') for kind in KINDS]
+    return os.path.dirname(paths[0])
+
+
+def read_report(path):
+    with open(path) as fh:
+        return [json.loads(line) for line in fh]
+
+
+def test_cli_deidentifies_folder(folder, tmp_path):
+    report = str(tmp_path / 'report.jsonl')
+    assert batch_deidentify.main([folder, '--no-broker', '--threads', '-r', report]) == 0
+
+    results = read_report(report)
+    assert len(results) == len(KINDS)
+    for result in results:
+        assert result['status'] == 'ok', result
+        assert result['verified']
+        assert result['label'] == 'present'
+        assert os.path.dirname(result['destination']) == deid_folder_for(folder)
+        assert os.path.exists(result['destination'])
+    assert sorted(result['format'] for result in results) == ['MRXS', 'NDPI', 'SVS', 'SVS']
+
+
+def test_cli_writes_mapping_file(folder, tmp_path):
+    report = str(tmp_path / 'report.jsonl')
+    assert batch_deidentify.main([folder, '--threads', '--broker-format', 'csv',
+                                  '-r', report]) == 0
+    parent = os.path.dirname(folder)
+    index, = [name for name in os.listdir(parent) if name.endswith('.csv')]
+    with open(os.path.join(parent, index), encoding='utf-8') as fh:
+        rows = fh.read().splitlines()
+    # Header and one row per slide
+    assert len(rows) == 1 + len(KINDS)
+
+
+def test_failed_slide_does_not_stop_batch(folder, tmp_path):
+    with open(os.path.join(folder, 'broken.svs'), 'wb') as fh:
+        fh.write(b'not a slide')
+    results, _ = run_batch(iter_jobs([folder]), use_threads=True,
+                           create_honest_broker=False)
+    statuses = {os.path.basename(r['source']): r['status'] for r in results}
+    assert statuses.pop('broken.svs') == 'error'
+    assert set(statuses.values()) == {'ok'}
+
+
+def test_dry_run_writes_nothing(folder, tmp_path):
+    report = str(tmp_path / 'report.jsonl')
+    assert batch_deidentify.main([folder, '--dry-run', '-r', report]) == 0
+    assert not os.path.exists(deid_folder_for(folder))
+    assert {result['status'] for result in read_report(report)} == {'ok'}
@@ -0,0 +1,103 @@
+"""Resuming batches from their journal."""
+import json
+import os
+
+from batch_deidentify import iter_jobs, run_batch
+from batch_journal import (BROKER_RECORDED, REDACTED, VERIFIED, BatchJournal,
+                           journal_path_for)
+
+from conftest import EXTENSIONS
+
+KINDS = ('svs', 'ndpi', 'mrxs')
+
+
+def make_folder(slide):
+    paths = [slide(kind, f'{kind}_slide{EXTENSIONS[kind]}') for kind in KINDS]
+    return os.path.dirname(paths[0])
+
+
+def batch(folder, **kwargs):
+    kwargs.setdefault('create_honest_broker', False)
+    results, _ = run_batch(iter_jobs([folder]), use_threads=True, **kwargs)
+    return {os.path.basename(result['source']): result for result in results}
+
+
+def test_resume_skips_finished_slides(slide):
+    folder = make_folder(slide)
+    first = batch(folder)
+    assert all(result['resumed'] is None for result in first.values())
+    mtimes = {name: os.stat(result['destination']).st_mtime_ns
+              for name, result in first.items()}
+
+    second = batch(folder)
+    for name, result in second.items():
+        assert result['status'] == 'ok'
+        assert result['resumed'] == [REDACTED, VERIFIED]
+        assert result['verified']
+        assert os.stat(result['destination']).st_mtime_ns == mtimes[name]
+        # Reported as in the run that did the work
+        for field in ('format', 'label', 'transfer'):
+            assert result[field] == first[name][field]
+
+
+def test_restart_redoes_everything(slide):
+    folder = make_folder(slide)
+    batch(folder)
+    results = batch(folder, resume=False)
+    assert all(result['resumed'] is None for result in results.values())
+
+
+def test_missing_output_is_redone(slide):
+    folder = make_folder(slide)
+    first = batch(folder)
+    os.remove(first['svs_slide.svs']['destination'])
+    second = batch(folder)
+    assert second['svs_slide.svs']['resumed'] is None
+    assert os.path.exists(second['svs_slide.svs']['destination'])
+    assert second['ndpi_slide.ndpi']['resumed'] == [REDACTED, VERIFIED]
+
+
+def test_changed_source_is_redone(slide):
+    folder = make_folder(slide)
+    batch(folder)
+    slide('svs', 'svs_slide.svs', tiles=4)
+    second = batch(folder)
+    assert second['svs_slide.svs']['resumed'] is None
+    assert second['ndpi_slide.ndpi']['resumed'] == [REDACTED, VERIFIED]
+
+
+def test_broker_is_not_rewritten_for_recorded_slides(slide):
+    folder = make_folder(slide)
+    batch(folder, create_honest_broker=True, broker_format='csv')
+    results, broker_paths = run_batch(iter_jobs([folder]), use_threads=True,
+                                      broker_format='csv')
+    assert broker_paths == []
+    assert all(BROKER_RECORDED in result['resumed'] for result in results)
+
+
+def test_journal_ignores_partial_line(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    src, dst = str(tmp_path / 'a.svs'), str(tmp_path / 'out.svs')
+    for name in (src, dst):
+        with open(name, 'wb') as fh:
+            fh.write(b'slide')
+    journal = BatchJournal(path)
+    key = journal.source_key(src)
+    journal.record(src, dst, key, REDACTED, format='SVS', label='present')
+    journal.close()
+    with open(path, 'a') as fh:
+        # Cut off by a crash in the middle of the next record
+        fh.write(json.dumps(dict(source=src, destination=dst, key=key,
+                                 state=VERIFIED))[:30])
+
+    journal = BatchJournal(path)
+    assert journal.states(src, dst, key) == {REDACTED}
+    assert journal.details(src, dst, key) == {'format': 'SVS', 'label': 'present'}
+    journal.close()
+
+
+def test_journal_next_to_output(slide):
+    folder = make_folder(slide)
+    results = batch(folder)
+    deid_folder = os.path.dirname(next(iter(results.values()))['destination'])
+    assert os.path.exists(journal_path_for(deid_folder))
@@ -0,0 +1,112 @@
+"""Label probes, slides without a label and redaction policies."""
+import json
+import os
+
+import pytest
+
+import anonymize_functions
+import batch_deidentify
+from anonymize_functions import (LABEL_PRESENT, LABEL_REMOVED, LABEL_UNDETECTABLE,
+                                 LabelNotFound, RedactionPolicy)
+from batch_deidentify import (UNLABELED_COPY, UNLABELED_FAIL, UNLABELED_SKIP,
+                              deid_folder_for, plan_slide)
+from redaction_verifier import verify_output
+
+from conftest import EXTENSIONS, assert_same_slide
+
+KINDS = ('svs', 'bigtiff', 'ndpi', 'mrxs')
+
+
+def redacted(slide, kind, policy=anonymize_functions.DEFAULT_POLICY):
+    """A slide of `kind` already de-identified under `policy`, in a folder
+    of its own."""
+    src = slide(kind, f'original{EXTENSIONS[kind]}')
+    folder = os.path.join(os.path.dirname(os.path.dirname(src)), 'landing')
+    os.makedirs(folder, exist_ok=True)
+    dst = os.path.join(folder, f'{kind}_slide{EXTENSIONS[kind]}')
+    anonymize_functions.copy_redacted(src, dst, policy=policy)
+    return dst
+
+
+@pytest.mark.parametrize('kind', KINDS)
+def test_probe(slide, kind):
+    probe = anonymize_functions.probe_label(slide(kind))
+    assert (probe.format, probe.label, probe.macro) == (
+        {'bigtiff': 'SVS'}.get(kind, kind.upper()), LABEL_PRESENT, True)
+    assert anonymize_functions.probe_label(redacted(slide, kind)).label == LABEL_REMOVED
+
+
+def test_probe_unrecognized_file(tmp_path):
+    path = str(tmp_path / 'broken.svs')
+    with open(path, 'wb') as fh:
+        fh.write(b'not a slide')
+    probe = anonymize_functions.probe_label(path)
+    assert probe.label == LABEL_UNDETECTABLE
+    assert probe.error
+
+
+@pytest.mark.parametrize('kind', KINDS)
+def test_plan_unlabeled_slide(slide, kind):
+    path = redacted(slide, kind)
+    probe, plan = plan_slide(path, UNLABELED_SKIP)
+    assert probe.label == LABEL_REMOVED and plan is None
+    with pytest.raises(LabelNotFound):
+        plan_slide(path, UNLABELED_FAIL)
+    _, plan = plan_slide(path, UNLABELED_COPY)
+    assert not plan.edits
+
+
+def run_cli(folder, tmp_path, *args):
+    report = str(tmp_path / 'report.jsonl')
+    status = batch_deidentify.main([folder, '--no-broker', '--threads', '-r', report,
+                                    *args])
+    with open(report) as fh:
+        return status, [json.loads(line) for line in fh]
+
+
+def test_unlabeled_skip(slide, tmp_path):
+    folder = os.path.dirname(redacted(slide, 'svs'))
+    status, results = run_cli(folder, tmp_path, '--unlabeled', 'skip')
+    assert status == 0
+    assert [result['status'] for result in results] == ['skipped']
+    assert not os.listdir(deid_folder_for(folder))
+
+
+def test_unlabeled_fail(slide, tmp_path):
+    folder = os.path.dirname(redacted(slide, 'ndpi'))
+    status, results = run_cli(folder, tmp_path, '--unlabeled', 'fail')
+    assert status == 1
+    assert [result['status'] for result in results] == ['error']
+    assert not os.listdir(deid_folder_for(folder))
+
+
+def test_unlabeled_copy(slide, tmp_path):
+    src = redacted(slide, 'mrxs')
+    status, results = run_cli(os.path.dirname(src), tmp_path)
+    assert status == 0
+    result, = results
+    assert result['status'] == 'ok' and result['label'] == LABEL_REMOVED
+    assert_same_slide(src, result['destination'])
+
+
+@pytest.mark.parametrize('kind', ('svs', 'mrxs'))
+def test_macro_policy(slide, tmp_path, kind):
+    policy = RedactionPolicy(macro=True)
+    dst = redacted(slide, kind, policy)
+    probe = anonymize_functions.probe_label(dst)
+    assert probe.label == LABEL_REMOVED and probe.macro is False
+    assert verify_output(dst, policy=policy) == []
+    # A label-only redaction leaves the macro, which the policy catches
+    label_only = redacted(slide, kind)
+    assert verify_output(label_only, policy=policy) != []
+
+
+def test_policy_applies_to_unlabeled_slides(slide, tmp_path):
+    # The label is gone but the macro is not, so the slide is not skipped
+    folder = os.path.dirname(redacted(slide, 'svs'))
+    status, results = run_cli(folder, tmp_path, '--unlabeled', 'skip',
+                              '--delete', 'label,macro')
+    assert status == 0
+    result, = results
+    assert result['status'] == 'ok'
+    assert anonymize_functions.probe_label(result['destination']).macro is False
@@ -0,0 +1,98 @@
+"""Planned single-pass copies against in-place redaction, and verification."""
+import os
+import shutil
+
+import pytest
+
+import anonymize_functions
+from anonymize_functions import (MRXS_LABEL, MRXS_MACRO, MRXS_THUMBNAIL,
+                                 LabelNotFound, MrxsFile, RedactionPlan)
+from redaction_verifier import verify_output
+
+from conftest import EXTENSIONS, assert_same_slide, copy_slide
+
+FORMATS = ('svs', 'bigtiff', 'ndpi', 'mrxs')
+WRAP_OFFSET = 5 << 30
+
+
+def redact_both_ways(src, tmp_path, sparse=False):
+    """Output of copy_redacted() and a copy of `src` redacted in place."""
+    ext = os.path.splitext(src)[1]
+    copied = str(tmp_path / ('copied' + ext))
+    in_place = copy_slide(src, str(tmp_path / ('in_place' + ext)))
+    anonymize_functions.copy_redacted(src, copied, sparse=sparse)
+    args = ['-s', in_place] if sparse else [in_place]
+    assert anonymize_functions._main(args) == 0
+    return copied, in_place
+
+
+@pytest.mark.parametrize('sparse', [False, True], ids=['dense', 'sparse'])
+@pytest.mark.parametrize('kind', FORMATS)
+def test_copy_matches_in_place(slide, tmp_path, kind, sparse):
+    src = slide(kind)
+    copied, in_place = redact_both_ways(src, tmp_path, sparse)
+    assert_same_slide(copied, in_place)
+    assert verify_output(copied) == []
+
+
+def test_copy_matches_in_place_beyond_4gb(slide, tmp_path):
+    # NDPI offsets wrap at 4 GB; the file is sparse, but the copy is not
+    if shutil.disk_usage(str(tmp_path)).free < 3 * WRAP_OFFSET:
+        pytest.skip('not enough free space for a copy past 4 GB')
+    src = slide('ndpi', high_offset=WRAP_OFFSET)
+    copied, in_place = redact_both_ways(src, tmp_path, sparse=True)
+    assert os.path.getsize(copied) > 1 << 32
+    assert_same_slide(copied, in_place)
+    assert verify_output(copied) == []
+
+
+@pytest.mark.parametrize('kind', FORMATS)
+def test_verify_rejects_unredacted_source(slide, kind):
+    problems = verify_output(slide(kind))
+    assert 'Label is still reachable' in problems
+
+
+def test_verify_rejects_blanked_tiles(slide, tmp_path):
+    src = slide('svs')
+    dst = str(tmp_path / 'out.svs')
+    plan = anonymize_functions.copy_redacted(src, dst)
+    with anonymize_functions.TiffFile(dst) as tf:
+        entries = tf.directories[0].entries
+        offset = entries[anonymize_functions.TILE_OFFSETS].value()[0]
+        length = entries[anonymize_functions.TILE_BYTE_COUNTS].value()[0]
+    with open(dst, 'r+b') as fh:
+        fh.seek(offset)
+        fh.write(b'\0' * length)
+    assert any('is blank' in problem for problem in verify_output(dst, plan))
+
+
+def test_mrxs_delete_levels(slide, tmp_path):
+    src = slide('mrxs')
+    dst = str(tmp_path / 'out.mrxs')
+    plan = RedactionPlan(src, 'MRXS')
+    # Barcode and preview are not adjacent once the thumbnail stays
+    MrxsFile(src).delete_levels([MRXS_LABEL, MRXS_MACRO], plan)
+    plan.copy(dst)
+
+    mrxs = MrxsFile(dst)
+    assert not mrxs.has_level(*MRXS_LABEL)
+    assert not mrxs.has_level(*MRXS_MACRO)
+    assert mrxs.has_level(*MRXS_THUMBNAIL)
+    assert MrxsFile(src).has_level(*MRXS_LABEL)
+    policy = anonymize_functions.RedactionPolicy(macro=True)
+    assert verify_output(dst, plan, policy=policy) == []
+
+    # Deleting them one at a time in place ends up the same
+    in_place = copy_slide(src, str(tmp_path / 'in_place.mrxs'))
+    MrxsFile(in_place).delete_level(*MRXS_MACRO)
+    MrxsFile(in_place).delete_level(*MRXS_LABEL)
+    assert_same_slide(dst, in_place)
+
+
+@pytest.mark.parametrize('kind', FORMATS)
+def test_second_redaction_finds_no_label(slide, tmp_path, kind):
+    src = slide(kind)
+    dst = str(tmp_path / ('out' + EXTENSIONS[kind]))
+    anonymize_functions.copy_redacted(src, dst)
+    with pytest.raises(LabelNotFound):
+        anonymize_functions.plan_redaction(dst)